@@ -0,0 +1,119 @@
+import sys, os, io
+import time
+import json
+import argparse
+import requests
+
+from concurrent.futures import ThreadPoolExecutor
+
+"""
+load test for the reference service, measuring end-to-end throughput and tail latency
+
+to measure offline, run the service with REFERENCE_SERVICE_SOLRQUERY_URL pointing to the solr stand-in,
+ie, with recorded responses and a lognormal latency
+
+    $ python referencesrv/solrstandin.py -r recordings.jsonl -l '{"distribution": "lognormal", "mu": 3.5, "sigma": 0.5}'
+
+and then
+
+    $ python benchmark_reference_service.py -i references.txt -c 8 -s http://localhost:9983
+
+where with -s the backend latency as served by the stand-in is reported as well
+"""
+
+
+def percentile(sorted_values, percent):
+    """
+    nearest rank percentile of an already sorted list
+
+    :param sorted_values:
+    :param percent:
+    :return:
+    """
+    if not sorted_values:
+        return 0
+    index = max(0, min(len(sorted_values) - 1, int(round(percent / 100.0 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def resolve(url, token, references):
+    """
+    sends one batch of references to be resolved
+
+    :param url:
+    :param token:
+    :param references:
+    :return: duration in ms, status code, number of resolved references
+    """
+    start_time = time.time()
+    response = requests.post(
+        url=url,
+        headers={'Authorization': 'Bearer ' + token,
+                 'Content-Type': 'application/json',
+                 'Accept': 'application/json'},
+        data=json.dumps({'reference': references})
+    )
+    duration = (time.time() - start_time) * 1000
+    resolved = 0
+    if response.status_code == 200:
+        resolved = sum(1 for result in json.loads(response.content)['resolved']
+                       if not result['bibcode'].startswith('.'))
+    return duration, response.status_code, resolved
+
+
+def run(url, token, references, batch_size, concurrency):
+    """
+    sends all references in batches, concurrency batches at a time
+
+    :param url:
+    :param token:
+    :param references:
+    :param batch_size:
+    :param concurrency:
+    :return:
+    """
+    batches = [references[i:i + batch_size] for i in range(0, len(references), batch_size)]
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda batch: resolve(url, token, batch), batches))
+    elapsed = time.time() - start_time
+
+    durations = sorted(result[0] for result in results)
+    errors = sum(1 for result in results if result[1] != 200)
+    resolved = sum(result[2] for result in results)
+    return {
+        'references': len(references),
+        'resolved': resolved,
+        'requests': len(batches),
+        'errors': errors,
+        'seconds': round(elapsed, 2),
+        'references_per_second': round(len(references) / elapsed, 2),
+        'request_latency_ms': {
+            'p50': round(percentile(durations, 50), 1),
+            'p95': round(percentile(durations, 95), 1),
+            'p99': round(percentile(durations, 99), 1),
+            'max': round(durations[-1], 1) if durations else 0,
+        }
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Load test for reference service')
+    parser.add_argument('-i', '--input', required=True, help='the path to input file containing list of text references, one per line.')
+    parser.add_argument('-u', '--url', default='http://localhost:5000/text', help='the text endpoint of the service')
+    parser.add_argument('-t', '--token', default='', help='authorization token')
+    parser.add_argument('-b', '--batch', type=int, default=16, help='number of references per request')
+    parser.add_argument('-c', '--concurrency', type=int, default=4, help='number of requests sent concurrently')
+    parser.add_argument('-s', '--standin', help='url of the solr stand-in, to include the backend latency it served')
+    args = parser.parse_args()
+
+    with io.open(os.path.join(os.getcwd(), args.input), 'r', encoding="utf-8") as f:
+        references = [reference.strip() for reference in f if reference.strip()]
+
+    if args.standin:
+        requests.delete(args.standin + '/stats')
+    result = run(args.url, args.token, references, args.batch, args.concurrency)
+    if args.standin:
+        result['backend'] = json.loads(requests.get(args.standin + '/stats').content)
+    print(json.dumps(result, indent=2))
+    sys.exit(0)
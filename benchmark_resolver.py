@@ -0,0 +1,500 @@
+import sys, os, io
+import time
+import json
+import argparse
+import random
+import tracemalloc
+import threading
+import logging
+import unidecode
+import regex as re
+
+from werkzeug.serving import make_server
+
+import referencesrv.app as app
+from referencesrv import solrstandin
+from referencesrv.resolver.solve import solve_reference
+from referencesrv.resolver.hypotheses import Hypotheses
+from referencesrv.resolver.sourcematchers import load_source_matcher
+from referencesrv.resolver.authors import count_matching_authors
+from referencesrv.resolver.common import Evidences, get_scoring_context
+from referencesrv.resolver.journalfield import cook_reference_pub, cook_title_string, has_thesis_indicators, has_word, \
+    normalize_words, string_similarity, compute_pubstring_statistics
+from referencesrv.resolver.similarity import tokenize_title, tokenize_pub, get_title_tokens, get_title_similarity
+
+"""
+benchmarks of the resolver, run in process, with solr replaced by the local stand-in
+
+    $ python benchmark_resolver.py filters -i parsed_references.jsonl
+
+resolves the parsed references (one json object per line, as sent to the xml endpoint) twice against the stand-in,
+with and without filter queries, and reports the backend latency as modeled by the stand-in clause cost
+
+    $ python benchmark_resolver.py authors -s 1000
+
+matches synthetic reference author lists against ADS author lists of collaboration size, and reports the time per match
+
+    $ python benchmark_resolver.py pubs -i referencesrv/parser/training_files/arxiv.raw
+
+normalizes the reference strings as publication strings and titles, with the patterns built on each call as they were,
+and with the normalizer of the app, checks that the results are the same, and reports the time of each
+
+    $ python benchmark_resolver.py evidences -c 200
+
+scores made up candidates the way a hypothesis does, memoized components added to the evidences of each candidate,
+which are then ranked and inspected, and reports the time and the memory allocated per hypothesis
+
+    $ python benchmark_resolver.py similarity -i referencesrv/parser/training_files/arxiv.raw
+
+scores the tagged titles and journals of the training references against one another, a reference against itself,
+with half of its words missing, or with a word misspelled being a match, with the current string comparison and with
+the token set one, and reports how often the two are on the same side of the thresholds, and the time of each
+"""
+
+
+def read_parsed_references(filename):
+    """
+
+    :param filename:
+    :return:
+    """
+    with io.open(os.path.join(os.getcwd(), filename), 'r', encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def start_standin(config, port):
+    """
+    runs the solr stand-in in a background thread
+
+    :param config:
+    :param port:
+    :return: the server, to shut it down
+    """
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', port, solrstandin.create_app(**config), threaded=True)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def resolve_all(application, parsed_references):
+    """
+    resolves the parsed references, and returns how many resolved and how long it took
+
+    :param application:
+    :param parsed_references:
+    :return:
+    """
+    resolved = 0
+    start_time = time.time()
+    with application.test_request_context():
+        for parsed_reference in parsed_references:
+            try:
+                solution = solve_reference(Hypotheses(parsed_reference))
+                if not str(solution).startswith('0.0'):
+                    resolved += 1
+            except Exception:
+                pass
+    return resolved, time.time() - start_time
+
+
+def benchmark_filters(args):
+    """
+    compares the backend latency with and without filter queries
+
+    :param args:
+    :return:
+    """
+    parsed_references = read_parsed_references(args.input)
+    standin_config = {
+        'SOLR_STANDIN_RECORDINGS': args.recordings,
+        'SOLR_STANDIN_SEED': 0,
+        'SOLR_STANDIN_LATENCY': json.loads(args.latency),
+        'SOLR_STANDIN_CLAUSE_COST': json.loads(args.clause_cost),
+    }
+    server = start_standin(standin_config, args.port)
+    standin = server.app
+
+    results = {}
+    try:
+        for filter_queries in (False, True):
+            application = app.create_app(**{
+                'REFERENCE_SERVICE_LIVE': False,
+                'REFERENCE_SERVICE_SOLRQUERY_URL': 'http://127.0.0.1:%d/v1/search/query' % args.port,
+                'REFERENCE_SERVICE_SOLR_FILTER_QUERIES': filter_queries,
+            })
+            # the models are not needed, only the source matcher, then query the stand-in
+            application.config['REFERENCE_SERVICE_LIVE'] = True
+            with application.app_context():
+                application.extensions['source_matcher'] = load_source_matcher()
+            standin.extensions['stats'].reset()
+            standin.extensions['filter_cache'].clear()
+            for _ in range(args.repeat):
+                resolved, duration = resolve_all(application, parsed_references)
+            stats = standin.extensions['stats'].get()
+            results['fq' if filter_queries else 'q'] = {
+                'resolved': resolved,
+                'seconds': round(duration, 2),
+                'queries': stats['queries'],
+                'filter_cache': stats['filter_cache'],
+                'backend_latency_ms': stats['latency_ms'],
+            }
+    finally:
+        server.shutdown()
+    return results
+
+
+def make_last_name(rng):
+    """
+    returns a made up last name, of two to four syllables
+
+    :param rng:
+    :return:
+    """
+    syllables = ['ab', 'ber', 'ca', 'dos', 'el', 'fer', 'gu', 'ho', 'ik', 'jo', 'kam', 'li', 'mar', 'no', 'ov',
+                 'pe', 'qui', 'ros', 'sa', 'tin', 'ul', 'vas', 'wen', 'xi', 'yu', 'zak']
+    return ''.join(rng.choice(syllables) for _ in range(rng.randint(2, 4)))
+
+
+def make_author_lists(rng, size, misspelled):
+    """
+    returns an ADS author list of size authors, and the reference author string citing it,
+    with the first tenth of the authors, misspelled ones among them, and et al.
+
+    :param rng:
+    :param size:
+    :param misspelled: fraction of the reference authors that are misspelled
+    :return:
+    """
+    last_names = [make_last_name(rng) for _ in range(size)]
+    ads_authors = ['%s, %s' % (last_name, rng.choice('abcdefghijklmnopqrstuvwxyz')) for last_name in last_names]
+    ref_authors = []
+    for last_name in last_names[:max(1, size // 10)]:
+        if rng.random() < misspelled:
+            position = rng.randrange(len(last_name))
+            last_name = last_name[:position] + rng.choice('aeiou') + last_name[position + 1:]
+        ref_authors.append('%s, %s.' % (last_name.capitalize(), rng.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ')))
+    return ads_authors, ', '.join(ref_authors) + ' et al.'
+
+
+def benchmark_authors(args):
+    """
+    times matching reference author lists with ADS author lists of collaboration size,
+    for the same collaboration, and for a different one, where every ADS author is checked for misspellings
+
+    :param args:
+    :return:
+    """
+    rng = random.Random(args.seed)
+    ads_authors, ref_authors = make_author_lists(rng, args.size, args.misspelled)
+    other_ads_authors, _ = make_author_lists(rng, args.size, args.misspelled)
+
+    application = app.create_app(**{'REFERENCE_SERVICE_LIVE': False})
+    results = {}
+    with application.app_context():
+        compared_max = get_scoring_context().authors_compared_max
+        for case, candidate in (('same', ads_authors), ('different', other_ads_authors)):
+            start_time = time.time()
+            for _ in range(args.repeat):
+                counts = count_matching_authors(ref_authors, candidate, compared_max, candidate[0])
+            results[case] = {
+                'counts': counts,
+                'ms_per_match': round((time.time() - start_time) * 1000 / args.repeat, 3),
+            }
+    return results
+
+
+def read_reference_strings(filename):
+    """
+    returns the reference strings of a raw training file, the comment line following each "% --n" marker,
+    the other lines being the tagged tokens of the reference
+
+    :param filename:
+    :return:
+    """
+    reference_strings = []
+    with io.open(os.path.join(os.getcwd(), filename), 'r', encoding="utf-8") as f:
+        lines = f.read().splitlines()
+    for marker, line in zip(lines, lines[1:]):
+        if re.match(r'% --\s*\d+\s*$', marker) and line.startswith('% ') and line[2:].strip():
+            reference_strings.append(line[2:].strip())
+    return reference_strings
+
+
+def normalize_per_call(config, reference_string):
+    """
+    normalizes reference_string the way it was done before the normalizer, building the patterns on each call
+
+    :param config:
+    :param reference_string:
+    :return:
+    """
+    stop_words = re.compile("\b({})\b".format("|".join(config["REFERENCE_SERVICE_STOP_WORDS"])))
+    elements = stop_words.sub(" ", reference_string.lower()).split()
+    cooked_pub = " ".join(config["JOURNAL_ABBREVIATION"].get(e, e) for e in elements).replace("&", "and")
+    cooked_title = " ".join(p for p in re.sub(r"[^\w]+", " ", reference_string).split()
+                            if p not in config["REFERENCE_SERVICE_STOP_WORDS"] and len(p) > 5)
+    stuff_to_match = unidecode.unidecode(reference_string).lower()
+    thesis = any(thesis_word[:-1] in stuff_to_match if thesis_word.endswith("*") else has_word(stuff_to_match, thesis_word)
+                 for thesis_word in config['THESIS_INDICATOR_WORDS'])
+    return cooked_pub, cooked_title, thesis
+
+
+def normalize(reference_string):
+    """
+    normalizes reference_string with the normalizer of the app
+
+    :param reference_string:
+    :return:
+    """
+    return cook_reference_pub(reference_string.lower()), cook_title_string(reference_string), has_thesis_indicators(reference_string)
+
+
+def benchmark_pubs(args):
+    """
+    times normalizing reference strings as publication strings and titles, with the patterns built
+    on each call, and with the normalizer of the app, the first pass of which fills its caches
+
+    :param args:
+    :return:
+    """
+    reference_strings = read_reference_strings(args.input)
+    application = app.create_app(**{'REFERENCE_SERVICE_LIVE': False})
+    results = {'references': len(reference_strings)}
+    with application.app_context():
+        start_time = time.time()
+        for _ in range(args.repeat):
+            expected = [normalize_per_call(application.config, reference_string) for reference_string in reference_strings]
+        results['per_call_seconds'] = round((time.time() - start_time) / args.repeat, 4)
+        for case in ('cold', 'warm'):
+            start_time = time.time()
+            normalized = [normalize(reference_string) for reference_string in reference_strings]
+            results['%s_seconds' % case] = round(time.time() - start_time, 4)
+        results['identical'] = normalized == expected
+    return results
+
+
+def make_candidate_scores(rng, candidates):
+    """
+    returns made up scores of the authors, title, and publication components, and of year, volume, and page
+
+    :param rng:
+    :param candidates: number of candidates
+    :return:
+    """
+    return [([round(rng.uniform(-1, 1), 2) for _ in range(3)], [rng.choice([-1, 0, 0.5, 1]) for _ in range(3)])
+            for _ in range(candidates)]
+
+
+def score_candidates(context, candidate_scores):
+    """
+    returns the evidences of the candidates of one hypothesis ranked, and what the resolver inspects of them,
+    the authors, title, and publication components as taken from the evidence memo, and the rest added directly
+
+    :param context: ScoringContext
+    :param candidate_scores: see make_candidate_scores
+    :return:
+    """
+    scored = []
+    for component_scores, field_scores in candidate_scores:
+        evidences = Evidences(context)
+        for score, label in zip(component_scores, ['authors', 'title', 'pubstring']):
+            component = Evidences(context)
+            component.add_evidence(score, label)
+            evidences + component
+        for score, label in zip(field_scores, ['year', 'volume', 'page']):
+            evidences.add_evidence(score, label)
+        scored.append(evidences)
+    ranked = sorted(scored, reverse=True)
+    inspected = [(evidences.get_score(), evidences.has_veto(), evidences.single_veto_from('page')) for evidences in ranked]
+    return ranked, inspected
+
+
+def benchmark_evidences(args):
+    """
+    times scoring the candidates of hypotheses, and measures the memory it allocates
+
+    :param args:
+    :return:
+    """
+    application = app.create_app(**{'REFERENCE_SERVICE_LIVE': False})
+    with application.app_context():
+        context = get_scoring_context()
+        candidate_scores = make_candidate_scores(random.Random(args.seed), args.candidates)
+        start_time = time.process_time()
+        for _ in range(args.repeat):
+            score_candidates(context, candidate_scores)
+        cpu = time.process_time() - start_time
+
+        tracemalloc.start()
+        ranked, inspected = score_candidates(context, candidate_scores)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return {
+        'candidates': args.candidates,
+        'ms_per_hypothesis': round(cpu * 1000 / args.repeat, 3),
+        'kb_per_hypothesis': round(peak / 1024., 1),
+        'top': str(ranked[0]),
+    }
+
+
+def read_labeled_references(filename):
+    """
+    returns the titles and the journals of the references of a raw training file, their tagged tokens joined
+
+    :param filename:
+    :return:
+    """
+    references = []
+    with io.open(os.path.join(os.getcwd(), filename), 'r', encoding="utf-8") as f:
+        for line in f:
+            if re.match(r'% --\s*\d+\s*$', line):
+                references.append({'TITLE': [], 'JOURNAL': []})
+            elif references and '\t' in line and not line.startswith('%'):
+                tag, token = line.strip().split('\t', 1)
+                if tag in references[-1]:
+                    references[-1][tag].append(token)
+    titles = [' '.join(reference['TITLE']) for reference in references if reference['TITLE']]
+    journals = [' '.join(reference['JOURNAL']) for reference in references if reference['JOURNAL']]
+    return titles, journals
+
+
+def make_title_pairs(titles):
+    """
+    returns (reference title, ADS title, is match) for each title against itself, with the second half of
+    its words missing, as a subtitle is, and with a word misspelled, all matches, and against the other titles
+
+    :param titles:
+    :return:
+    """
+    pairs = []
+    for i, ads_title in enumerate(titles):
+        words = ads_title.split()
+        pairs.append((ads_title, ads_title, True))
+        if len(words) > 1:
+            pairs.append((' '.join(words[:(len(words) + 1) // 2]), ads_title, True))
+            pairs.append((' '.join(words[:-1] + [words[-1][:-1] + 'x']), ads_title, True))
+        pairs.extend((ref_title, ads_title, False) for j, ref_title in enumerate(titles) if j != i)
+    return pairs
+
+
+def make_pub_pairs(journals):
+    """
+    returns (reference journal, ADS journal, is match) for each pair of journals, a match if they are the same
+
+    :param journals:
+    :return:
+    """
+    return [(ref_journal, ads_journal, ref_journal == ads_journal) for ref_journal in journals for ads_journal in journals]
+
+
+def compare_scores(pairs, current_scores, token_scores, seconds):
+    """
+    returns how the token scores of the pairs compare with the current ones: how often they are on the same side
+    of the thresholds, their mean difference, the means over matches and non matches, and the time per thousand pairs
+
+    :param pairs:
+    :param current_scores:
+    :param token_scores:
+    :param seconds: (current, token) seconds to score the pairs
+    :return:
+    """
+    matches = [is_match for _, _, is_match in pairs]
+    mean = lambda scores: round(sum(scores) / float(len(scores)), 3) if scores else None
+    results = {'pairs': len(pairs), 'matches': sum(matches)}
+    for threshold in [0, 0.5]:
+        results['agreement_above_%s' % threshold] = mean([float((current > threshold) == (token > threshold))
+                                                          for current, token in zip(current_scores, token_scores)])
+    results['mean_absolute_difference'] = mean([abs(current - token) for current, token in zip(current_scores, token_scores)])
+    for name, scores, elapsed in [('current', current_scores, seconds[0]), ('token', token_scores, seconds[1])]:
+        results[name] = {
+            'mean_of_matches': mean([score for score, is_match in zip(scores, matches) if is_match]),
+            'mean_of_non_matches': mean([score for score, is_match in zip(scores, matches) if not is_match]),
+            'ms_per_1000_pairs': round(elapsed * 1000000 / len(pairs), 3),
+        }
+    return results
+
+
+def benchmark_similarity(args):
+    """
+    scores the titles and the journals of the training references against one another with the current string
+    comparison and with the token set one, as add_title_evidence and compute_pubstring_statistics do with the
+    features of the documents, and compares the scores and the time taken
+
+    :param args:
+    :return:
+    """
+    titles, journals = read_labeled_references(args.input)
+    title_pairs, pub_pairs = make_title_pairs(titles), make_pub_pairs(journals)
+    application = app.create_app(**{'REFERENCE_SERVICE_LIVE': False})
+    with application.app_context():
+        context = get_scoring_context()
+        min_score, pub_normalizer = context.min_score, context.pub_normalizer
+        normalized_titles = {title: normalize_words(title) for title in titles}
+        title_tokens = {title: tokenize_title(title) for title in titles}
+        cooked_pubs = {journal: cook_reference_pub(journal.lower() + ' ') for journal in journals}
+        pub_tokens = {journal: tokenize_pub(cooked_pubs[journal]) for journal in journals}
+        pub_score = lambda statistics: (statistics[0] - 2 * statistics[1]) / float(statistics[0]) if statistics[0] else 0
+
+        timed = []
+        for score_pair, pairs in [
+                (lambda ref, ads: string_similarity(ref, ads, min_score, normalized_titles[ads]), title_pairs),
+                (lambda ref, ads: get_title_similarity(get_title_tokens(ref), title_tokens[ads], min_score), title_pairs),
+                (lambda ref, ads: pub_score(compute_pubstring_statistics(ref, ads, '', pub_normalizer, cooked_pubs[ads])), pub_pairs),
+                (lambda ref, ads: pub_score(compute_pubstring_statistics(ref, ads, '', pub_normalizer, cooked_pubs[ads], pub_tokens[ads])), pub_pairs)]:
+            scores = [score_pair(ref, ads) for ref, ads, _ in pairs]
+            start_time = time.process_time()
+            for _ in range(args.repeat):
+                for ref, ads, _ in pairs:
+                    score_pair(ref, ads)
+            timed.append((scores, (time.process_time() - start_time) / args.repeat))
+
+    return {
+        'titles': compare_scores(title_pairs, timed[0][0], timed[1][0], (timed[0][1], timed[1][1])),
+        'pubs': compare_scores(pub_pairs, timed[2][0], timed[3][0], (timed[2][1], timed[3][1])),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmarks of the resolver')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    filters = subparsers.add_parser('filters', help='backend latency with and without filter queries')
+    filters.add_argument('-i', '--input', required=True, help='json lines file of parsed references')
+    filters.add_argument('-r', '--recordings', help='json lines file of recorded solr responses, otherwise synthetic')
+    filters.add_argument('-p', '--port', type=int, default=9983, help='port for the stand-in')
+    filters.add_argument('-n', '--repeat', type=int, default=2, help='number of times to resolve the references, '
+                                                                      'the filter cache is warm after the first')
+    filters.add_argument('-l', '--latency', default='{"distribution": "fixed", "ms": 1}', help='base latency of the stand-in')
+    filters.add_argument('-c', '--clause-cost', default='{"q_ms": 2.0, "fq_miss_ms": 2.0, "fq_hit_ms": 0.1, "filter_cache_size": 512}',
+                         help='clause cost model of the stand-in')
+    filters.set_defaults(func=benchmark_filters)
+
+    authors = subparsers.add_parser('authors', help='matching author lists of collaboration size')
+    authors.add_argument('-s', '--size', type=int, default=1000, help='number of ADS authors')
+    authors.add_argument('-m', '--misspelled', type=float, default=0.1, help='fraction of misspelled reference authors')
+    authors.add_argument('-n', '--repeat', type=int, default=20, help='number of times to match each list')
+    authors.add_argument('--seed', type=int, default=0, help='seed of the made up author lists')
+    authors.set_defaults(func=benchmark_authors)
+
+    pubs = subparsers.add_parser('pubs', help='normalizing publication strings and titles')
+    pubs.add_argument('-i', '--input', default='referencesrv/parser/training_files/arxiv.raw', help='raw training file of reference strings')
+    pubs.add_argument('-n', '--repeat', type=int, default=3, help='number of times to normalize with the patterns built on each call')
+    pubs.set_defaults(func=benchmark_pubs)
+
+    evidences = subparsers.add_parser('evidences', help='scoring and ranking the candidates of hypotheses')
+    evidences.add_argument('-c', '--candidates', type=int, default=200, help='number of candidates of each hypothesis')
+    evidences.add_argument('-n', '--repeat', type=int, default=200, help='number of hypotheses')
+    evidences.add_argument('--seed', type=int, default=0, help='seed of the made up evidences')
+    evidences.set_defaults(func=benchmark_evidences)
+
+    similarity = subparsers.add_parser('similarity', help='comparing titles and journals as strings and as token sets')
+    similarity.add_argument('-i', '--input', default='referencesrv/parser/training_files/arxiv.raw', help='raw training file of tagged references')
+    similarity.add_argument('-n', '--repeat', type=int, default=5, help='number of times to score the pairs')
+    similarity.set_defaults(func=benchmark_similarity)
+
+    args = parser.parse_args()
+    print(json.dumps(args.func(args), indent=2))
+    sys.exit(0)
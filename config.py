@@ -16,6 +16,68 @@ REFERENCE_SERVICE_QUERY_FIELDS_SOLR = "author,[fields author=10]author_norm,[fie
                                       "year,title,pub,pub_raw,aff_raw,[fields aff_raw=1],scix_id," \
                                       "volume,issue,page,page_range,bibstem,bibcode,identifier,doi,doctype"
 
+# timeout in seconds of each request to solr
+REFERENCE_SERVICE_SOLR_TIMEOUT = 10
+# requests to solr with parameters longer than this many characters, ie, with long author lists, are sent as POST
+REFERENCE_SERVICE_SOLR_POST_LENGTH = 4096
+# if a request to solr has not returned after this percentile of the recent latencies, a second, hedged, request
+# is sent and whichever returns first is used, set to None to not hedge
+REFERENCE_SERVICE_SOLR_HEDGE_PERCENTILE = 95
+# number of recent latencies kept, and how many are needed before hedging starts
+REFERENCE_SERVICE_SOLR_LATENCY_WINDOW = 1000
+REFERENCE_SERVICE_SOLR_HEDGE_MIN_SAMPLES = 100
+# number of threads sending the hedged requests
+REFERENCE_SERVICE_SOLR_HEDGE_WORKERS = 16
+# number of retries on connection errors, timeouts, 429 and 5xx responses,
+# waiting a random time up to backoff * 2^attempt seconds, capped at backoff max, between attempts
+REFERENCE_SERVICE_SOLR_RETRIES = 2
+REFERENCE_SERVICE_SOLR_RETRY_BACKOFF = 0.1
+REFERENCE_SERVICE_SOLR_RETRY_BACKOFF_MAX = 2
+# number of consecutive failures after which requests to solr fail fast,
+# and for how many seconds, before one trial request is let through
+REFERENCE_SERVICE_SOLR_BREAKER_THRESHOLD = 5
+REFERENCE_SERVICE_SOLR_BREAKER_COOLDOWN = 30
+
+# two-phase retrieval, first query for bibcodes only, then fetch in full only the records
+# not already in the document cache, that keeps the records massaged, keyed by bibcode
+REFERENCE_SERVICE_SOLR_TWO_PHASE = False
+# maximum number of records in the document cache, and how many seconds they are kept
+REFERENCE_SERVICE_DOCUMENT_CACHE_SIZE = 50000
+REFERENCE_SERVICE_DOCUMENT_CACHE_TTL = 3600
+
+# send the exact, non-scoring constraints of the hypotheses as separate filter queries, that solr
+# can cache in its filter cache, and keep only the fuzzy and textual constraints in the query
+REFERENCE_SERVICE_SOLR_FILTER_QUERIES = False
+# hint keys that are sent as filter queries
+REFERENCE_SERVICE_SOLR_FILTER_KEYS = ['year', 'year~', 'year_max', 'doctype', 'bibstem']
+
+# optional local index of identifiers (doi, arXiv id, ascl id, bibcode and alternate bibcodes) to
+# the canonical bibcode and scix_id, consulted before solr for the identifier hypotheses
+# the index is a SQLite file built from the export file, which has one json document per line
+# with the fields bibcode, scix_id, identifier, and doi, leave the index None to not use it
+REFERENCE_SERVICE_IDENTIFIER_INDEX = None
+REFERENCE_SERVICE_IDENTIFIER_EXPORT = None
+# number of bytes of the index file to memory map
+REFERENCE_SERVICE_IDENTIFIER_INDEX_MMAP_SIZE = 1024 * 1024 * 1024
+
+# optional list of bibcodes, canonical and alternate ones, one per line, loaded in memory to match
+# the wildcard bibcodes of the fielded-bibcode hypotheses, so that solr is queried for the matching
+# bibcodes only, or not at all, leave it None to send the wildcards to solr
+REFERENCE_SERVICE_BIBCODE_LIST = None
+
+# optional table of the first and last volume and page of each bibstem in each year, built from
+# REFERENCE_SERVICE_BIBCODE_LIST, to not query for the bibstem, year, volume, and page combinations
+# that cannot exist, leave it None to query for all
+REFERENCE_SERVICE_VOLUME_RANGES = None
+# number of volumes a reference can be off the range of the year and still be queried for
+REFERENCE_SERVICE_VOLUME_RANGES_SLACK = 1
+
+# the search backend the hypotheses are queried against, either solr, or local for an in-process
+# index built from a dump of records, one json document per line with the fields of
+# REFERENCE_SERVICE_QUERY_FIELDS_SOLR, to reprocess references offline or test against a snapshot
+REFERENCE_SERVICE_SEARCH_BACKEND = 'solr'
+REFERENCE_SERVICE_LOCAL_INDEX_DUMP = None
+
 # maximum references that can be resolved in one call
 REFERENCE_SERVICE_MAX_REFERENCE = 16
 
@@ -70,10 +132,43 @@ MISSING_VOLUME_FACTORY = 0.4
 # letter, or a P for the pink pages) and the other doesn't.
 NO_LETTER_DEMERIT = -0.3
 
+# compare titles and publication strings on their sets of words, see resolver/similarity.py,
+# rather than scanning the strings for each word, the scores are on the same scale, so are the thresholds
+REFERENCE_SERVICE_TOKEN_SIMILARITY = False
+
 # minimal score a solution needs to be accepted on the first round
 # of resolving.
 MIN_SCORE_FIRST_ROUND = 0.7
 
+# number of best scored solr records kept for each hypothesis to choose from
+REFERENCE_SERVICE_TOP_CANDIDATES = 10
+
+# budget of a single reference, once it has sent this many queries to solr, or they have taken this many
+# seconds altogether, no more hypotheses are tried, and the reference is resolved from the ties stashed so far,
+# if any, either 0 is no limit, and both are by default, since hypotheses late in the chain that resolve
+# would fail once it is used up, ie, 12 queries and 10 seconds
+REFERENCE_SERVICE_QUERY_BUDGET_QUERIES = 0
+REFERENCE_SERVICE_QUERY_BUDGET_SECONDS = 0
+
+# half widths of the year windows of the approximate year hypothesis, tried narrowest first,
+# a wider window is tried only if no record in the narrower one scored, the narrow ones only when the year
+# of the citing paper or the table of volume ranges bounds the year, otherwise just the widest, empty is 5
+REFERENCE_SERVICE_YEAR_WINDOWS = [1, 5]
+
+# when a query of a hypothesis returns too many records, it is refined with this many more of the input fields
+# not in the query yet, one at a time, before giving up on the hypothesis
+REFERENCE_SERVICE_OVERFLOW_REFINEMENTS = 2
+
+# when the year of the citing paper is known, the cited records can be published at most this many years later,
+# to allow for references to papers in press
+REFERENCE_SERVICE_CITING_YEAR_SLACK = 1
+
+# the author clauses of a query are limited to the first author and this many authors altogether,
+# the ones with the most distinctive names, so that collaboration papers do not produce huge queries
+REFERENCE_SERVICE_QUERY_AUTHORS_MAX = 8
+# number of the reference authors each ADS author is compared with to detect misspellings
+REFERENCE_SERVICE_AUTHORS_COMPARED_MAX = 100
+
 # A list of keys that should be joined with blanks if multiple strings
 # in a list come back from solr.  Note that you probably need to
 # change scoring functions if ever multiple volumes, pages, years,
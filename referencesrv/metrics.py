@@ -0,0 +1,93 @@
+"""
+Process wide counters and gauges of the service, ie, solr requests, retries, and circuit breaker state.
+
+They are returned by the metrics endpoint as a flat json object, with dotted names.
+
+Counters of the current request only, to be logged along with its timing, are kept in flask g.
+"""
+
+import threading
+
+from flask import g, has_app_context
+
+
+class Metrics(object):
+    """
+    thread-safe counters and gauges
+    """
+    def __init__(self):
+        """
+
+        """
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+
+    def incr(self, name, value=1):
+        """
+        increments a counter
+
+        :param name:
+        :param value:
+        :return:
+        """
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set(self, name, value):
+        """
+        sets a gauge to its current value
+
+        :param name:
+        :param value:
+        :return:
+        """
+        with self.lock:
+            self.gauges[name] = value
+
+    def get(self):
+        """
+        returns a snapshot of all counters and gauges
+
+        :return:
+        """
+        with self.lock:
+            snapshot = dict(self.counters)
+            snapshot.update(self.gauges)
+        return snapshot
+
+    def reset(self):
+        """
+
+        :return:
+        """
+        with self.lock:
+            self.counters = {}
+            self.gauges = {}
+
+
+METRICS = Metrics()
+
+
+def incr_request_metric(name, value=1):
+    """
+    increments a counter of the current request, if there is one
+
+    :param name:
+    :param value:
+    :return:
+    """
+    if has_app_context():
+        request_metrics = g.setdefault('request_metrics', {})
+        request_metrics[name] = request_metrics.get(name, 0) + value
+
+
+def get_request_metrics():
+    """
+    returns the counters of the current request
+
+    :return:
+    """
+    if has_app_context():
+        return g.get('request_metrics', {})
+    return {}
@@ -6,9 +6,12 @@ import regex as re
 import editdistance
 import unidecode
 
-from flask import current_app
+from collections import Counter
+from functools import lru_cache
+from itertools import chain
 
 from referencesrv.resolver.common import Undecidable
+from referencesrv.resolver.memoize import memoized
 
 # all author lists coming in need to be case-folded
 # replaced van(?: der) with van|van der
@@ -52,6 +55,10 @@ SINGLE_WORD_EXTRACTOR = re.compile(r"\w+")
 
 FIRST_CAPTIAL = re.compile(r"^([^A-Z0-9\"""]*[A-Z])")
 
+# the number of author strings, and of ADS last name lists, kept normalized and tokenized,
+# the same few come back for every hypothesis of a reference, and for every candidate of the queries
+AUTHOR_LISTS_CACHE_SIZE = 4096
+
 REMOVE_AND = re.compile(r"(,?\s+and\s+)", re.IGNORECASE)
 COMMA_BEFORE_AND = re.compile(r"(,)?(\s+and)", re.IGNORECASE)
 
@@ -78,6 +85,7 @@ def get_length_matched_authors(ref_string, matches):
         count += 1
     return count
 
+@memoized('authors.author_pattern', AUTHOR_LISTS_CACHE_SIZE)
 def get_author_pattern(ref_string):
     """
     returns a pattern matching authors in ref_string.
@@ -319,6 +327,7 @@ def normalize_single_author(author_string):
     return unidecode.unidecode(author_string).replace("-", " ").lower()
 
 
+@memoized('authors.normalized', AUTHOR_LISTS_CACHE_SIZE)
 def normalize_author_list(author_string, initials=True):
     """
     tries to bring author_string in the form AuthorLast1; AuthorLast2
@@ -344,6 +353,7 @@ def normalize_author_list(author_string, initials=True):
     return author_string
 
 
+@memoized('authors.first_author', AUTHOR_LISTS_CACHE_SIZE)
 def get_first_author(author_string, initials=False):
     """
     returns the last name of the first author in author_string.
@@ -392,7 +402,166 @@ def get_author_last_name_only(author_string):
         return [single_name.lower() for name in LAST_NAME_PAT.findall(author_string) for single_name in name.split()][1::2]
 
 
-def count_matching_authors(ref_authors, ads_authors, ads_first_author=None):
+def get_distinctive_authors(authors, max_authors):
+    """
+    returns a deterministic sample of at most max_authors of the authors to query with,
+    the first author, and the ones with the longest last names, that are the most distinctive
+    in the absence of name frequencies, in their original order
+
+    since all the authors queried need to match, querying fewer never loses the record
+
+    :param authors: list of normalized authors
+    :param max_authors: None or 0 to keep all
+    :return:
+    """
+    if not max_authors or len(authors) <= max_authors:
+        return authors
+    others = sorted(range(1, len(authors)), key=lambda i: (-len(authors[i].split(',')[0]), i))[:max_authors - 1]
+    return [authors[0]] + [authors[i] for i in sorted(others)]
+
+
+def get_ads_last_name(ads_author):
+    """
+    returns the last name of an ADS-normalized author, lower cased, with hyphens as blanks
+
+    :param ads_author:
+    :return:
+    """
+    return ads_author.split(',')[0].strip().lower().replace('-', ' ')
+
+
+# up to this many reference last names are compared for misspellings without filtering them by bigrams first
+SHORT_LIST_SIZE = 16
+
+
+@lru_cache(maxsize=None)
+def get_misspelling_threshold(n_max):
+    """
+    returns the largest edit distance between two last names, the longer of them n_max long,
+    that is still a misspelling, ie, a difference of less than 30%
+
+    :param n_max:
+    :return:
+    """
+    return max([distance for distance in range(n_max + 1) if (n_max - float(distance)) / n_max > 0.7], default=-1)
+
+
+def get_bigrams(name):
+    """
+    returns the set of the pairs of consecutive characters of name
+
+    :param name:
+    :return:
+    """
+    return {name[i:i + 2] for i in range(len(name) - 1)}
+
+
+class ReferenceAuthors(object):
+    """
+    the last names of a reference author string, tokenized once for matching them with ADS author lists:
+
+        last_names, in the order of the reference, and joined,
+        cooked, the author string the ADS last names are looked up in,
+        exact, the last names found as they are in cooked, to match ADS last names with a set lookup,
+        compared, the last names compared for misspellings, with their lengths, grouped by length,
+            and indexed by their bigrams.
+    """
+    __slots__ = ('last_names', 'joined', 'cooked', 'exact', 'compared', 'lengths', 'by_length', 'by_bigram')
+
+    def __init__(self, ref_authors, compared_max):
+        """
+
+        :param ref_authors: reference author string
+        :param compared_max: number of the reference authors compared for misspellings
+        """
+        self.last_names = get_author_last_name_only(ref_authors)
+        self.joined = '; '.join(self.last_names)
+        self.cooked = EXTRAS_PAT.sub('', ref_authors.lower().replace('.', ' '))
+        self.exact = frozenset(last_name for last_name in self.last_names if last_name in self.cooked)
+        # a long list of reference authors, ie, of a collaboration, is checked for misspellings up to a point
+        self.compared = self.last_names[:compared_max]
+        self.lengths = [len(last_name) for last_name in self.compared]
+        self.by_length = {}
+        self.by_bigram = {}
+        for i, last_name in enumerate(self.compared):
+            self.by_length.setdefault(len(last_name), []).append(i)
+            for bigram in get_bigrams(last_name):
+                self.by_bigram.setdefault(bigram, []).append(i)
+
+    def is_matching(self, ads_last_name):
+        """
+        returns True if ads_last_name is in the reference author string, or its last word is, if it has several
+
+        :param ads_last_name:
+        :return:
+        """
+        if ads_last_name in self.exact or ads_last_name in self.cooked:
+            return True
+        return " " in ads_last_name and ads_last_name.split()[-1] in self.cooked
+
+    def get_misspelled(self, ads_last_name):
+        """
+        returns the first reference last name that ads_last_name is a misspelling of, None if there is none
+
+        the edit distance is computed only for the last names that can be within the threshold,
+        ie, that are of a length close enough, and that share enough bigrams with ads_last_name,
+        since each edit changes at most two of the bigrams
+
+        :param ads_last_name:
+        :return:
+        """
+        ads_length = len(ads_last_name)
+        thresholds = {}
+        for length, indices in self.by_length.items():
+            n_max = max(ads_length, length)
+            # the edit distance is at least the difference in length, skip if that alone is too much
+            if n_max - abs(ads_length - length) <= 0.7 * n_max:
+                continue
+            thresholds[length] = get_misspelling_threshold(n_max)
+        if not thresholds:
+            return None
+
+        if sum(len(self.by_length[length]) for length in thresholds) <= SHORT_LIST_SIZE:
+            candidates = [i for length in thresholds for i in self.by_length[length]]
+        else:
+            bigrams = get_bigrams(ads_last_name)
+            required = {length: len(bigrams) - 2 * threshold for length, threshold in thresholds.items()}
+            candidates = [i for length in thresholds if required[length] <= 0 for i in self.by_length[length]]
+            shared = Counter(chain.from_iterable(self.by_bigram.get(bigram, ()) for bigram in bigrams))
+            for i, count in shared.items():
+                if 0 < required.get(self.lengths[i], 0) <= count:
+                    candidates.append(i)
+
+        for i in sorted(candidates):
+            if editdistance.eval(ads_last_name, self.compared[i]) <= thresholds[self.lengths[i]]:
+                return self.compared[i]
+        return None
+
+
+@memoized('authors.reference_authors', AUTHOR_LISTS_CACHE_SIZE)
+def get_reference_authors(ref_authors, compared_max):
+    """
+    returns the tokenized reference author string, see ReferenceAuthors
+
+    :param ref_authors:
+    :param compared_max:
+    :return:
+    """
+    return ReferenceAuthors(ref_authors, compared_max)
+
+
+@memoized('authors.last_names_pattern', AUTHOR_LISTS_CACHE_SIZE)
+def get_last_names_pattern(ads_last_names):
+    """
+    returns the compiled pattern matching any of the ADS last names
+
+    :param ads_last_names: tuple of ADS last names
+    :return:
+    """
+    return re.compile("|".join(ads_last_names))
+
+
+def count_matching_authors(ref_authors, ads_authors, compared_max, ads_first_author=None, ads_last_names=None):
     """
     returns statistics on the authors matching between ref_authors
     and ads_authors.
@@ -408,9 +577,14 @@ def count_matching_authors(ref_authors, ads_authors, ads_first_author=None):
     No initials verification takes place here, case is folded, everything
     is supposed to have been dumbed down to ASCII by ADS conventions.
 
+    The ADS last names found in the reference are matched first, and only the rest
+    are compared with the reference last names of similar length for misspellings.
+
     :param ref_authors:
     :param ads_authors:
+    :param compared_max: the number of reference authors compared, see get_reference_authors
     :param ads_first_author:
+    :param ads_last_names: the last names of ads_authors, if already computed, see features
     :return:
     """
     if not ads_authors:
@@ -419,11 +593,10 @@ def count_matching_authors(ref_authors, ads_authors, ads_first_author=None):
     matching_authors, missing_in_ref, first_author_missing = 0, 0, False
 
     # clean up ADS authors to only contain surnames and be lowercased
-    ads_authors_lastname = [a.split(',')[0].strip().lower().replace('-', ' ')
-                            for a in ads_authors]
+    ads_authors_lastname = ads_last_names if ads_last_names is not None else [get_ads_last_name(a) for a in ads_authors]
 
-    ref_authors_lastname = get_author_last_name_only(ref_authors)
-    ref_authors = EXTRAS_PAT.sub('', ref_authors.lower().replace('.', ' '))
+    reference_authors = get_reference_authors(ref_authors, compared_max)
+    ref_authors = reference_authors.cooked
 
     if ads_first_author is None:
         ads_first_author = ads_authors_lastname[0]
@@ -434,28 +607,22 @@ def count_matching_authors(ref_authors, ads_authors, ads_first_author=None):
 
     different = []
     for ads_auth in ads_authors_lastname:
-        if ads_auth in ref_authors or (" " in ads_auth and ads_auth.split()[-1] in ref_authors):
+        if reference_authors.is_matching(ads_auth):
             matching_authors += 1
         else:
             # see if there is actually no match (check for misspelling here)
             # difference of <30% is indication of misspelling
-            misspelled = False
-            for ref_auth in ref_authors_lastname:
-                N_max = max(len(ads_auth), len(ref_auth))
-                distance = (N_max - float(editdistance.eval(ads_auth, ref_auth))) / N_max
-                if distance > 0.7:
-                    different.append(ref_auth)
-                    misspelled = True
-                    break
-            if not misspelled:
+            misspelled = reference_authors.get_misspelled(ads_auth)
+            if misspelled is not None:
+                different.append(misspelled)
+            else:
                 missing_in_ref += 1
 
     # Now try to figure out if the reference has additional authors
     # (we assume ADS author lists are complete)
-    ads_authors_lastname_pattern = "|".join(ads_authors_lastname)
-
-    if ref_authors_lastname:
-        wordsNotInADS = SINGLE_WORD_EXTRACTOR.findall(re.sub(ads_authors_lastname_pattern, "", '; '.join(ref_authors_lastname)))
+    if reference_authors.last_names:
+        ads_authors_lastname_pattern = get_last_names_pattern(tuple(ads_authors_lastname))
+        wordsNotInADS = SINGLE_WORD_EXTRACTOR.findall(ads_authors_lastname_pattern.sub("", reference_authors.joined))
         # remove recognized misspelled authors
         wordsNotInADS = [word for word in wordsNotInADS if word not in different]
         missing_in_ads = len(wordsNotInADS)
@@ -465,7 +632,7 @@ def count_matching_authors(ref_authors, ads_authors, ads_first_author=None):
     return (missing_in_ref, missing_in_ads, matching_authors, first_author_missing)
 
 
-def add_author_evidence(evidences, ref_authors, ads_authors, ads_first_author, has_etal=False):
+def add_author_evidence(evidences, ref_authors, ads_authors, ads_first_author, has_etal=False, ads_last_names=None):
     """
     adds an evidence for ref_authors matching ads_authors.
 
@@ -481,6 +648,7 @@ def add_author_evidence(evidences, ref_authors, ads_authors, ads_first_author, h
     :param ads_authors:
     :param ads_first_author:
     :param has_etal:
+    :param ads_last_names: the last names of ads_authors, if already computed, see features
     :return:
     """
     ref_authors = ref_authors.replace('-', ' ')
@@ -490,7 +658,8 @@ def add_author_evidence(evidences, ref_authors, ads_authors, ads_first_author, h
     if len(ref_authors) == 0 or len(ads_authors) == 0:
         return
     (missing_in_ref, missing_in_ads, matching_authors, first_author_missing
-     ) = count_matching_authors(ref_authors, ads_authors, ads_first_author)
+     ) = count_matching_authors(ref_authors, ads_authors, evidences.context.authors_compared_max,
+                                ads_first_author, ads_last_names)
 
     if has_etal:
         normalizer = float(matching_authors + missing_in_ads)
@@ -499,12 +668,12 @@ def add_author_evidence(evidences, ref_authors, ads_authors, ads_first_author, h
 
     # if the first author is missing, apply the factor by which matching authors are discounted
     if first_author_missing:
-        matching_authors *= current_app.config['MISSING_FIRST_AUTHOR_FACTOR']
+        matching_authors *= evidences.context.missing_first_author_factor
 
     if normalizer != 0:
         score = round((matching_authors - missing_in_ads) / normalizer, 2)
     else:
         score = 0
 
-    evidences.add_evidence(max(current_app.config['EVIDENCE_SCORE_RANGE'][0], min(current_app.config['EVIDENCE_SCORE_RANGE'][1], score)), "authors")
+    evidences.add_evidence(max(evidences.min_score, min(evidences.max_score, score)), "authors")
 
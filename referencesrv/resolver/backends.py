@@ -0,0 +1,401 @@
+"""
+Search backends the querier sends the queries of the hypotheses to.
+
+A backend returns the number of records matching a query built by solve.make_solr_query,
+and the records with the fields asked for, and looks records up by bibcode:
+
+    RemoteSolr, the ADS search API,
+    StaticBackend, the canned records of solrtestdata, used when the service is not live,
+    LocalIndex, an in-process index built from a dump of records, for offline reprocessing
+    without the rate limits and latency of the API, and for tests on realistic candidate sets.
+
+The local index understands the subset of the solr syntax the resolver generates, that is,
+clauses of field:value joined by AND, where value is a term, a phrase, an approximate phrase,
+a group of terms joined by either AND or OR, or a range, and ? and * are wildcards.
+"""
+
+import io
+import json
+import time
+import traceback
+
+import regex as re
+import editdistance
+import unidecode
+
+from flask import current_app
+
+from referencesrv.resolver.identifierindex import normalize_identifier
+from referencesrv.resolver.solrtestdata import get_test_data
+
+
+class SearchBackend(object):
+    """
+    the interface of the search backends
+    """
+    def search(self, query, filters=None, fields=None, rows=None):
+        """
+        returns the number of records matching the query and all the filter queries, and the first rows of them
+
+        :param query:
+        :param filters: list of filter queries
+        :param fields: the fields to return, as the solr fl parameter
+        :param rows:
+        :return: num_found, list of records
+        """
+        raise NotImplementedError
+
+    def lookup(self, bibcodes, fields=None):
+        """
+        returns the records of the bibcodes
+
+        :param bibcodes:
+        :param fields: the fields to return, as the solr fl parameter
+        :return:
+        """
+        raise NotImplementedError
+
+
+class RemoteSolr(SearchBackend):
+    """
+    the ADS search API, through the querier that takes care of retries, hedging, and the circuit breaker
+    """
+    def __init__(self, querier):
+        """
+
+        :param querier:
+        """
+        self.querier = querier
+
+    def search(self, query, filters=None, fields=None, rows=None):
+        """
+
+        :param query:
+        :param filters:
+        :param fields:
+        :param rows:
+        :return:
+        """
+        params = self.querier.make_params(query, filters)
+        if fields:
+            params['fl'] = fields
+        if rows:
+            params['rows'] = str(rows)
+        from_solr = self.querier.get_from_solr(params)
+        return from_solr['response'].get('numFound', 0), from_solr['response']['docs']
+
+    def lookup(self, bibcodes, fields=None):
+        """
+
+        :param bibcodes:
+        :param fields:
+        :return:
+        """
+        from_solr = self.querier.get_from_solr({
+            'fl': fields or self.querier.query_fields,
+            'rows': str(len(bibcodes)),
+            'q': 'bibcode:(%s)' % ' OR '.join('"%s"' % bibcode for bibcode in bibcodes),
+        })
+        return from_solr['response']['docs']
+
+
+class StaticBackend(SearchBackend):
+    """
+    the canned records of solrtestdata, whatever the query
+    """
+    def search(self, query, filters=None, fields=None, rows=None):
+        """
+
+        :param query:
+        :param filters:
+        :param fields:
+        :param rows:
+        :return:
+        """
+        from_solr = get_test_data()
+        return from_solr['response'].get('numFound', 0), from_solr['response']['docs']
+
+    def lookup(self, bibcodes, fields=None):
+        """
+
+        :param bibcodes:
+        :param fields:
+        :return:
+        """
+        return [doc for doc in get_test_data()['response']['docs'] if doc['bibcode'] in bibcodes]
+
+
+# a clause of the query, field:value, where value is a phrase, a group, a range, or a term
+# an unquoted value runs to the next operator or clause, since make_solr_condition writes the publication unquoted,
+# ie, pub:Astrophysical Journal
+CLAUSE_PAT = re.compile(r'(?P<field>[\w*]+):(?P<value>"(?:[^"\\]|\\.)*"~?|\((?:[^()"\\]|\\.|"(?:[^"\\]|\\.)*")*\)|\[[^\]]*\]|'
+                        r'(?:[^\s\\()]|\\.)+(?:\s+(?!(?:AND|OR)\b|[\w*]+:)(?:[^\s\\()]|\\.)+)*)')
+# a term of a group
+TERM_PAT = re.compile(r'"(?:[^"\\]|\\.)*"|(?:[^\s"()\\]|\\.)+')
+# the [fields name=count] limits of the fl parameter
+FIELD_LIMITS_PAT = re.compile(r'\[fields ([^\]]+)\]')
+WORD_PAT = re.compile(r'\w+')
+
+AUTHOR_FIELDS = ['author', 'author_norm', 'first_author', 'first_author_norm']
+WILDCARD_FIELDS = ['identifier', 'bibstem', 'volume', 'issue', 'page', 'doctype', 'doi']
+
+
+def normalize(value):
+    """
+    returns value folded the way the author_norm of ADS is, ascii, lowercase, hyphens as blanks
+
+    :param value:
+    :return:
+    """
+    return unidecode.unidecode(value).replace('-', ' ').lower().strip()
+
+
+def get_last_name(author):
+    """
+
+    :param author: normalized author
+    :return:
+    """
+    return author.split(',')[0].strip()
+
+
+def get_wildcard_pattern(term, ignore_case=True):
+    """
+    returns the regular expression for a term with ? and * wildcards
+
+    :param term:
+    :param ignore_case: False for the identifiers, since bibcodes are case sensitive
+    :return:
+    """
+    return re.compile('^%s$' % re.escape(term).replace(r'\?', '.').replace(r'\*', '.*'), re.IGNORECASE if ignore_case else 0)
+
+
+def get_field_limits(fields):
+    """
+    returns the fields of a solr fl parameter, with the number of values to return of each, None for all
+
+    :param fields: ie, author,[fields author=10],year
+    :return:
+    """
+    limits = {name.strip(): None for name in FIELD_LIMITS_PAT.sub(',', fields).split(',') if name.strip()}
+    for field_limits in FIELD_LIMITS_PAT.findall(fields):
+        for field_limit in field_limits.split(','):
+            name, count = field_limit.split('=')
+            limits[name.strip()] = int(count)
+    return limits
+
+
+def parse_query(query):
+    """
+    returns the clauses of a query as tuples of (field, kind, terms, operator, approximate),
+    where kind is one of phrase, group, range, or term
+
+    :param query:
+    :return:
+    """
+    clauses = []
+    for match in CLAUSE_PAT.finditer(query):
+        field, value = match.group('field'), match.group('value')
+        if value.startswith('"'):
+            approximate = value.endswith('~')
+            clauses.append((field, 'phrase', [value.rstrip('~')[1:-1].replace('\\', '')], 'AND', approximate))
+        elif value.startswith('('):
+            tokens = TERM_PAT.findall(value[1:-1])
+            terms = [token.strip('"').replace('\\', '') for token in tokens if token not in ('AND', 'OR', 'or')]
+            operator = 'OR' if any(token in ('OR', 'or') for token in tokens) else 'AND'
+            clauses.append((field, 'group', terms, operator, False))
+        elif value.startswith('['):
+            clauses.append((field, 'range', [bound.strip() for bound in value[1:-1].split(' TO ')], 'AND', False))
+        else:
+            clauses.append((field, 'term', [value.replace('\\', '')], 'AND', False))
+    return clauses
+
+
+class LocalIndex(SearchBackend):
+    """
+    the records of a dump in memory, with the ones of each year, author last name, and
+    identifier indexed, to find the candidates of a query before matching all of its clauses
+    """
+    def __init__(self, docs):
+        """
+
+        :param docs: iterable of records with the fields of REFERENCE_SERVICE_QUERY_FIELDS_SOLR
+        """
+        self.docs = []
+        self.by_bibcode = {}
+        self.by_year = {}
+        self.by_author = {}
+        self.by_identifier = {}
+        for doc in docs:
+            index = len(self.docs)
+            self.docs.append(doc)
+            self.by_bibcode[doc['bibcode']] = index
+            self.by_year.setdefault(str(doc.get('year', '')), set()).add(index)
+            for author in doc.get('author_norm', []):
+                self.by_author.setdefault(get_last_name(normalize(author)), set()).add(index)
+            for identifier in doc.get('identifier', []) + [doc['bibcode']]:
+                self.by_identifier.setdefault(normalize_identifier(identifier), set()).add(index)
+
+    def __len__(self):
+        """
+
+        :return:
+        """
+        return len(self.docs)
+
+    def get_candidates(self, clause):
+        """
+        returns the indices of the records that can match the clause, None if the clause is not indexed
+
+        :param clause:
+        :return:
+        """
+        field, kind, terms, operator, approximate = clause
+        if approximate or any('?' in term or '*' in term for term in terms):
+            return None
+        if field == 'year':
+            if kind == 'range':
+                low, high = terms
+                return set().union(*[indices for year, indices in self.by_year.items() if year.isdigit() and
+                                     (low == '*' or int(year) >= int(low)) and (high == '*' or int(year) <= int(high))])
+            return set().union(*[self.by_year.get(term, set()) for term in terms])
+        if field in AUTHOR_FIELDS:
+            # for all the authors to match, the records of one of them are enough
+            terms = terms[:1] if operator == 'AND' else terms
+            return set().union(*[self.by_author.get(get_last_name(normalize(term)), set()) for term in terms])
+        if field == 'identifier':
+            terms = terms[:1] if operator == 'AND' else terms
+            return set().union(*[self.by_identifier.get(normalize_identifier(term), set()) for term in terms])
+        return None
+
+    def match_term(self, doc, field, term, approximate):
+        """
+        returns True if a term matches the field of the record
+
+        :param doc:
+        :param field:
+        :param term:
+        :param approximate:
+        :return:
+        """
+        if field in AUTHOR_FIELDS:
+            if field.startswith('first_author'):
+                authors = [normalize(doc.get('first_author_norm', ''))]
+            else:
+                authors = [normalize(author) for author in doc.get('author_norm', [])]
+            term = normalize(term)
+            if approximate:
+                last_name = get_last_name(term)
+                return any(1 - float(editdistance.eval(last_name, get_last_name(author))) / max(len(last_name), len(get_last_name(author)), 1) > 0.7
+                           for author in authors)
+            if ',' in term:
+                return any(author.startswith(term) for author in authors)
+            return any(get_last_name(author) == term for author in authors)
+
+        values = doc.get(field, [])
+        if not isinstance(values, list):
+            values = [values]
+        if field == 'identifier':
+            pattern = get_wildcard_pattern(normalize_identifier(term), ignore_case=False)
+            return any(pattern.match(normalize_identifier(value)) for value in values + [doc['bibcode']])
+        if field in WILDCARD_FIELDS:
+            pattern = get_wildcard_pattern(term)
+            return any(pattern.match(str(value)) for value in values)
+
+        # text fields, ie, title and pub, all the words need to be there
+        words = set(WORD_PAT.findall(normalize(' '.join(str(value) for value in values))))
+        return all(word in words for word in WORD_PAT.findall(normalize(term)))
+
+    def match_clause(self, doc, clause):
+        """
+        returns True if the record matches the clause
+
+        :param doc:
+        :param clause:
+        :return:
+        """
+        field, kind, terms, operator, approximate = clause
+        if field == '*':
+            return True
+        if kind == 'range':
+            low, high = terms
+            try:
+                value = int(str(doc.get(field, ''))[:4])
+            except ValueError:
+                return False
+            return (low == '*' or value >= int(low)) and (high == '*' or value <= int(high))
+        matches = (self.match_term(doc, field, term, approximate) for term in terms)
+        if operator == 'OR':
+            return any(matches)
+        return all(matches)
+
+    def project(self, doc, limits):
+        """
+        returns the fields of the record asked for
+
+        :param doc:
+        :param limits: see get_field_limits
+        :return:
+        """
+        projected = {}
+        for name, count in limits.items():
+            if name in doc:
+                value = doc[name]
+                projected[name] = value[:count] if count and isinstance(value, list) else value
+        return projected
+
+    def search(self, query, filters=None, fields=None, rows=None):
+        """
+
+        :param query:
+        :param filters:
+        :param fields:
+        :param rows:
+        :return:
+        """
+        clauses = parse_query(' AND '.join([query] + (filters or [])))
+        # start from the smallest set of candidates of the indexed clauses
+        candidates = None
+        for clause in clauses:
+            indices = self.get_candidates(clause)
+            if indices is not None and (candidates is None or len(indices) < len(candidates)):
+                candidates = indices
+        if candidates is None:
+            candidates = range(len(self.docs))
+
+        matched = [index for index in sorted(candidates)
+                   if all(self.match_clause(self.docs[index], clause) for clause in clauses)]
+        limits = get_field_limits(fields or current_app.config['REFERENCE_SERVICE_QUERY_FIELDS_SOLR'])
+        return len(matched), [self.project(self.docs[index], limits) for index in matched[:rows]]
+
+    def lookup(self, bibcodes, fields=None):
+        """
+
+        :param bibcodes:
+        :param fields:
+        :return:
+        """
+        limits = get_field_limits(fields or current_app.config['REFERENCE_SERVICE_QUERY_FIELDS_SOLR'])
+        return [self.project(self.docs[self.by_bibcode[bibcode]], limits) for bibcode in bibcodes if bibcode in self.by_bibcode]
+
+
+def load_local_index():
+    """
+    builds the local index from the dump of records, if one has been configured
+
+    :return: LocalIndex object, or None if there is no dump
+    """
+    dump_file = current_app.config.get('REFERENCE_SERVICE_LOCAL_INDEX_DUMP', None)
+    if not dump_file:
+        return None
+    try:
+        start_time = time.time()
+        with io.open(dump_file, 'r', encoding='utf-8') as f:
+            local_index = LocalIndex(json.loads(line) for line in f if line.strip())
+        current_app.logger.info("loaded local index from %s with %d records in %s ms." % (
+            dump_file, len(local_index), (time.time() - start_time) * 1000))
+        return local_index
+    except Exception as e:
+        current_app.logger.error('Exception: %s' % (str(e)))
+        current_app.logger.error(traceback.format_exc())
+        return None
@@ -0,0 +1,86 @@
+"""
+An optional in-memory index of bibcodes, to turn the bibcode patterns built from
+the fields of a reference, with ? as the wildcard, into the bibcodes matching them.
+
+The solr query of the fielded-bibcode hypotheses then becomes an exact lookup of
+these bibcodes, or is not sent at all when no bibcode matches. Solr remains the
+fallback for the patterns the index cannot narrow down.
+
+The bibcode list has one bibcode per line, canonical and alternate bibcodes alike.
+"""
+
+import bisect
+import time
+import traceback
+
+from flask import current_app
+
+
+class BibcodeIndex(object):
+    """
+    the bibcodes sorted, to find the ones of a year and journal by bisection, and grouped
+    by year, volume, and page, for the patterns with a wildcard journal.
+    """
+
+    def __init__(self, bibcodes):
+        """
+
+        :param bibcodes: iterable of bibcodes
+        """
+        self.bibcodes = sorted(set(bibcode.strip() for bibcode in bibcodes if len(bibcode.strip()) == 19))
+        self.by_volume_page = {}
+        for bibcode in self.bibcodes:
+            self.by_volume_page.setdefault(bibcode[:4] + bibcode[9:18], []).append(bibcode)
+
+    def __len__(self):
+        """
+
+        :return:
+        """
+        return len(self.bibcodes)
+
+    def match(self, pattern):
+        """
+        returns the bibcodes matching pattern, where ? matches any character,
+        None if the pattern is too broad for the index to narrow it down
+
+        :param pattern:
+        :return:
+        """
+        if len(pattern) != 19:
+            return None
+        prefix = pattern.split('?', 1)[0]
+        # year and journal are known
+        if len(prefix) >= 9:
+            start = bisect.bisect_left(self.bibcodes, prefix)
+            end = bisect.bisect_right(self.bibcodes, prefix + '\U0010ffff', lo=start)
+            candidates = self.bibcodes[start:end]
+        # year, volume, and page are known
+        elif '?' not in pattern[:4] and '?' not in pattern[9:18]:
+            candidates = self.by_volume_page.get(pattern[:4] + pattern[9:18], [])
+        else:
+            return None
+        return [bibcode for bibcode in candidates
+                if all(p == '?' or p == c for p, c in zip(pattern, bibcode))]
+
+
+def load_bibcode_index():
+    """
+    load the bibcode index from the bibcode list if one has been configured
+
+    :return: BibcodeIndex object, or None if there is no bibcode list
+    """
+    bibcode_list = current_app.config.get('REFERENCE_SERVICE_BIBCODE_LIST', None)
+    if not bibcode_list:
+        return None
+    try:
+        start_time = time.time()
+        with open(bibcode_list, 'r') as f:
+            bibcode_index = BibcodeIndex(f)
+        current_app.logger.info("loaded bibcode index from %s with %d bibcodes in %s ms." % (
+            bibcode_list, len(bibcode_index), (time.time() - start_time) * 1000))
+        return bibcode_index
+    except Exception as e:
+        current_app.logger.error('Exception: %s' % (str(e)))
+        current_app.logger.error(traceback.format_exc())
+        return None
@@ -1,3 +1,4 @@
+import logging
 import traceback
 
 from flask import current_app
@@ -6,6 +7,12 @@ from numbers import Real
 from decimal import Decimal
 from itertools import tee, filterfalse
 
+from referencesrv.resolver.pubnormalizer import PubNormalizer
+
+
+# the scoring logs without the app, so that it can be used outside of it
+logger = logging.getLogger(__name__)
+
 
 class DeferredSourceMatcher(object):
     """
@@ -28,6 +35,102 @@ class DeferredSourceMatcher(object):
 SOURCE_MATCHER = DeferredSourceMatcher()
 
 
+class ScoringContext(object):
+    """
+    the scoring thresholds and weights of the configuration as plain attributes, so that the
+    scoring functions do not look them up in the config of the app for each candidate they score,
+    and can be used outside of the app as well.
+
+    It is frozen, to be shared by all the resolutions, and is built once per configuration,
+    see get_scoring_context. The hypotheses carry it as their scoring_context detail, and the
+    evidences they are scored with carry it along.
+
+    It carries the normalizer of publication strings and titles too, built from the lists of the
+    config, which are not expected to change while the app runs, and so are not part of the key.
+    """
+    # the settings of the config the context is built from
+    CONFIG_KEYS = ('EVIDENCE_SCORE_RANGE', 'MIN_SCORE_FIRST_ROUND', 'REFERENCE_SERVICE_TOP_CANDIDATES',
+                   'REFERENCE_SERVICE_MAX_RECORDS_SOLR', 'MISSING_VOLUME_FACTORY', 'MISSING_FIRST_AUTHOR_FACTOR',
+                   'NO_LETTER_DEMERIT', 'REFERENCE_SERVICE_AUTHORS_COMPARED_MAX', 'REFERENCE_SERVICE_CITING_YEAR_SLACK',
+                   'REFERENCE_SERVICE_VOLUME_RANGES_SLACK', 'REFERENCE_SERVICE_TOKEN_SIMILARITY')
+
+    __slots__ = ('min_score', 'max_score', 'min_score_first_round', 'top_candidates', 'max_records',
+                 'missing_volume_factor', 'missing_first_author_factor', 'no_letter_demerit', 'authors_compared_max',
+                 'citing_year_slack', 'volume_ranges_slack', 'token_similarity', 'pub_normalizer', 'key')
+
+    def __init__(self, config):
+        """
+
+        :param config: the config of the app, or a dict with the same keys
+        """
+        values = [
+            ('min_score', config['EVIDENCE_SCORE_RANGE'][0]),
+            ('max_score', config['EVIDENCE_SCORE_RANGE'][1]),
+            ('min_score_first_round', config['MIN_SCORE_FIRST_ROUND']),
+            ('top_candidates', config['REFERENCE_SERVICE_TOP_CANDIDATES']),
+            ('max_records', config['REFERENCE_SERVICE_MAX_RECORDS_SOLR']),
+            ('missing_volume_factor', config['MISSING_VOLUME_FACTORY']),
+            ('missing_first_author_factor', config['MISSING_FIRST_AUTHOR_FACTOR']),
+            ('no_letter_demerit', config['NO_LETTER_DEMERIT']),
+            ('authors_compared_max', config['REFERENCE_SERVICE_AUTHORS_COMPARED_MAX']),
+            ('citing_year_slack', config['REFERENCE_SERVICE_CITING_YEAR_SLACK']),
+            ('volume_ranges_slack', config['REFERENCE_SERVICE_VOLUME_RANGES_SLACK']),
+            ('token_similarity', config['REFERENCE_SERVICE_TOKEN_SIMILARITY']),
+        ]
+        for name, value in values:
+            object.__setattr__(self, name, value)
+        object.__setattr__(self, 'pub_normalizer', PubNormalizer(config))
+        object.__setattr__(self, 'key', get_scoring_config_key(config))
+
+    def __setattr__(self, name, value):
+        """
+
+        :param name:
+        :param value:
+        :return:
+        """
+        raise AttributeError("ScoringContext is frozen, %s cannot be set"%name)
+
+    def __eq__(self, other):
+        """
+
+        :param other:
+        :return:
+        """
+        return isinstance(other, ScoringContext) and self.key == other.key
+
+    def __hash__(self):
+        """
+
+        :return:
+        """
+        return hash(self.key)
+
+
+def get_scoring_config_key(config):
+    """
+    returns the values of the settings the scoring context is built from, as a tuple to compare
+
+    :param config:
+    :return:
+    """
+    return tuple(tuple(config[name]) if isinstance(config[name], list) else config[name]
+                 for name in ScoringContext.CONFIG_KEYS)
+
+
+def get_scoring_context():
+    """
+    returns the scoring context of the config of the app, building it only if the config has changed
+
+    :return:
+    """
+    key = get_scoring_config_key(current_app.config)
+    current = current_app.extensions.get('scoring_context', None)
+    if current is None or current.key != key:
+        current = current_app.extensions['scoring_context'] = ScoringContext(current_app.config)
+    return current
+
+
 class Evidences(object):
     """
     a measure of confidence of a match.
@@ -48,17 +151,30 @@ class Evidences(object):
 
     These evidences stand in as scores in that, when compared, they
     are ordered according to what get_score returns.
+
+    There are many of these in the resolution of a reference, one per candidate
+    and component, so they are slotted, and keep the sum of the evidences, and
+    the number and position of the vetoes as they are added.
     """
-    def __init__(self):
+    __slots__ = ('evidences', 'labels', 'index', 'score', 'vetoes', 'veto', 'context', 'min_score', 'max_score')
+
+    def __init__(self, context):
         """
 
+        :param context: ScoringContext, see Hypothesis.get_scoring_context
         """
         self.evidences = []
         self.labels = []
-        # _score is cached; None means "not computed yet or invalid"
-        self.score = None
-        self.min_score = current_app.config['EVIDENCE_SCORE_RANGE'][0]
-        self.max_score = current_app.config['EVIDENCE_SCORE_RANGE'][1]
+        # the position of the evidence of each label, the last one if the label is there more than once
+        self.index = {}
+        # the sum of the evidences, added up in the order they came in, as sum would
+        self.score = 0
+        # the number of evidences that are not positive, and the position of the last one
+        self.vetoes = 0
+        self.veto = None
+        self.context = context
+        self.min_score = self.context.min_score
+        self.max_score = self.context.max_score
 
     def __lt__(self, other):
         """
@@ -66,6 +182,8 @@ class Evidences(object):
         :param other:
         :return:
         """
+        if other.__class__ is Evidences and self.evidences and other.evidences:
+            return self.score < other.score
         try:
             return self.get_score() < other.get_score()
         except (AttributeError, TypeError):
@@ -79,6 +197,8 @@ class Evidences(object):
         :param other:
         :return:
         """
+        if other.__class__ is Evidences and self.evidences and other.evidences:
+            return self.score <= other.score
         try:
             return self.get_score() <= other.get_score()
         except (AttributeError, TypeError):
@@ -92,6 +212,8 @@ class Evidences(object):
         :param other:
         :return:
         """
+        if other.__class__ is Evidences and self.evidences and other.evidences:
+            return self.score > other.score
         try:
             return self.get_score() > other.get_score()
         except (AttributeError, TypeError):
@@ -105,6 +227,8 @@ class Evidences(object):
         :param other:
         :return:
         """
+        if other.__class__ is Evidences and self.evidences and other.evidences:
+            return self.score >= other.score
         try:
             return self.get_score() >= other.get_score()
         except (AttributeError, TypeError):
@@ -118,6 +242,8 @@ class Evidences(object):
         :param other:
         :return:
         """
+        if other.__class__ is Evidences and self.evidences and other.evidences:
+            return self.score == other.score
         try:
             return self.get_score() == other.get_score()
         except (AttributeError, TypeError):
@@ -145,11 +271,17 @@ class Evidences(object):
         :param other:
         :return:
         """
+        offset = len(self.evidences)
         for ev in other.evidences:
             assert self.min_score <= ev <= self.max_score
-        self.score = None
-        self.evidences += other.evidences
-        self.labels +=other.labels
+            if ev <= 0:
+                self.vetoes += 1
+                self.veto = len(self.evidences)
+            self.evidences.append(ev)
+            self.score += ev
+        self.labels += other.labels
+        for position, label in enumerate(other.labels):
+            self.index[label] = offset + position
         return self
 
     def sum(self):
@@ -157,7 +289,7 @@ class Evidences(object):
 
         :return:
         """
-        return sum(self.evidences)
+        return self.score
 
     def avg(self):
         """
@@ -178,9 +310,13 @@ class Evidences(object):
         :return:
         """
         assert self.min_score <= evidence <= self.max_score
-        self.score = None
+        if evidence <= 0:
+            self.vetoes += 1
+            self.veto = len(self.evidences)
+        self.index[label] = len(self.evidences)
         self.evidences.append(evidence)
         self.labels.append(label)
+        self.score += evidence
 
     def get_score(self):
         """
@@ -190,10 +326,8 @@ class Evidences(object):
         :return:
         """
         if not self.evidences:
-            current_app.logger.error('No evidence, rejecting')
+            logger.error('No evidence, rejecting')
             return 0
-        if self.score is None:
-            self.score = sum(self.evidences)
         return self.score
 
     def has_veto(self):
@@ -202,10 +336,7 @@ class Evidences(object):
 
         :return:
         """
-        for e in self.evidences:
-            if e<=0:
-                return True
-        return False
+        return self.vetoes > 0
 
     def single_veto_from(self, field_label):
         """
@@ -215,9 +346,8 @@ class Evidences(object):
         :param field_label:
         :return:
         """
-        neg_inds = [ind for ind, ev in enumerate(self.evidences) if ev<=0]
-        if len(neg_inds)==1:
-            return (self.labels[neg_inds[0]]==field_label)
+        if self.vetoes==1:
+            return (self.labels[self.veto]==field_label)
         return False
 
     def count_votes(self):
@@ -226,7 +356,6 @@ class Evidences(object):
 
         :return:
         """
-        d = dict(zip(self.labels, self.evidences))
         combinations = [
             ['authors', 'pubstring', 'volume', 'year'],
             ['authors', 'year', 'page']
@@ -234,7 +363,7 @@ class Evidences(object):
         for fields in combinations:
             vote = 0
             for term in fields:
-                if term in d and d[term] == current_app.config['EVIDENCE_SCORE_RANGE'][1]:
+                if self[term] == self.max_score:
                     vote += 1
             if vote == len(fields):
                 return True
@@ -248,10 +377,179 @@ class Evidences(object):
         :param label:
         :return:
         """
-        if label in self.labels:
-            d = dict(zip(self.labels, self.evidences))
-            return d[label]
-        return None
+        position = self.index.get(label, None)
+        if position is None:
+            return None
+        return self.evidences[position]
+
+
+class EvidenceMemo(object):
+    """
+    evidence components already computed during the resolution of one reference.
+
+    The hypotheses of a reference often get the same records back, and compare them
+    against the same input fields, so the components (authors, title, publication)
+    are keyed by what they were computed from, that is, the name of the component,
+    the input values, and the bibcode of the record.
+    """
+    def __init__(self):
+        """
+
+        """
+        self.components = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        returns the Evidences of the component, None if not computed yet
+
+        :param key:
+        :return:
+        """
+        component = self.components.get(key, None)
+        if component is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return component
+
+    def put(self, key, component):
+        """
+
+        :param key:
+        :param component: Evidences
+        :return:
+        """
+        self.components[key] = component
+
+
+class QueryBudget(object):
+    """
+    the solr queries one reference is allowed before its resolution is cut short.
+
+    A limit of 0 or None is no limit. The query in flight is never interrupted,
+    the budget is checked before each hypothesis.
+    """
+    def __init__(self, max_queries, max_seconds):
+        """
+
+        :param max_queries:
+        :param max_seconds:
+        """
+        self.max_queries = max_queries
+        self.max_seconds = max_seconds
+        self.queries = 0
+        self.seconds = 0.0
+
+    def spend(self, duration, queries=1):
+        """
+        accounts for a query to solr
+
+        :param duration: in seconds
+        :param queries: the number of requests the query took, ie, two with the lookup of two-phase querying
+        :return:
+        """
+        self.queries += queries
+        self.seconds += duration
+
+    def is_exceeded(self):
+        """
+
+        :return:
+        """
+        if self.max_queries and self.queries >= self.max_queries:
+            return True
+        if self.max_seconds and self.seconds >= self.max_seconds:
+            return True
+        return False
+
+    def __str__(self):
+        """
+
+        :return:
+        """
+        return '%d queries in %.2f seconds'%(self.queries, self.seconds)
+
+
+class ResolutionTrace(object):
+    """
+    an account of how one reference was resolved, returned by the explain endpoint.
+
+    Each hypothesis tried is an entry with its hints, the query sent to solr and
+    what came back, the evidences of the candidates scored, and the reason it
+    was accepted or rejected.
+    """
+    def __init__(self, parsed=None):
+        """
+
+        :param parsed: the fields the reference was parsed into
+        """
+        self.parsed = parsed
+        self.hypotheses = []
+        self.result = None
+
+    def start_hypothesis(self, hypothesis):
+        """
+        adds an entry for the hypothesis, the following calls fill it in
+
+        :param hypothesis:
+        :return:
+        """
+        self.hypotheses.append({'name': hypothesis.name, 'hints': dict(hypothesis.hints)})
+
+    def add_query(self, query, filters, num_found, duration):
+        """
+
+        :param query:
+        :param filters:
+        :param num_found: None if solr was not queried
+        :param duration: in seconds
+        :return:
+        """
+        # keep the queries that overflowed and were refined
+        entry = self.hypotheses[-1]
+        if 'query' in entry:
+            entry.setdefault('overflowed', []).append({key: entry[key] for key in ['query', 'filters', 'num_found', 'ms']})
+        entry.update({'query': query, 'filters': filters or [],
+                                    'num_found': num_found, 'ms': round(duration * 1000, 3)})
+
+    def add_hydration(self, hydration):
+        """
+
+        :param hydration: the lookup of the records of the query in two-phase mode, the number of bibcodes
+            looked up, the time in ms, and the bibcodes not returned, if any, see Querier.hydrate
+        :return:
+        """
+        self.hypotheses[-1]['hydration'] = hydration
+
+    def add_candidates(self, candidates):
+        """
+
+        :param candidates: pairs of (evidences, solution)
+        :return:
+        """
+        self.hypotheses[-1]['candidates'] = [{'bibcode': solution.get('bibcode', None),
+                                              'scix_id': solution.get('scix_id', None),
+                                              'score': evidences.get_score(),
+                                              'evidences': str(evidences)}
+                                             for evidences, solution in candidates]
+
+    def set_outcome(self, outcome, reason):
+        """
+
+        :param outcome: accepted, undecidable, or rejected
+        :param reason:
+        :return:
+        """
+        self.hypotheses[-1].update({'outcome': outcome, 'reason': reason})
+
+    def as_dict(self):
+        """
+
+        :return:
+        """
+        return {'parsed': self.parsed, 'hypotheses': self.hypotheses, 'result': self.result}
 
 
 class Solution(object):
@@ -346,6 +644,17 @@ class Hypothesis(object):
             return self.details.get(detail_name)
         return None
 
+    def get_scoring_context(self):
+        """
+        returns the scoring context the resolution passed along, see solve.solve_reference
+
+        :return:
+        """
+        context = self.details.get('scoring_context', None)
+        if context is None:
+            raise ValueError("Hypothesis %s was not given a scoring context"%self.name)
+        return context
+
     def get_hint(self, hint_name):
         """
 
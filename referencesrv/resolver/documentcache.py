@@ -0,0 +1,92 @@
+"""
+A bounded, expiring, in-process cache of documents, ie, solr records already massaged by the querier, keyed by bibcode.
+
+The same popular records come back from many hypotheses and many references, so in the two-phase
+retrieval only the records not in the cache are fetched in full from solr.
+"""
+
+import threading
+import time
+
+from collections import OrderedDict
+
+from flask import current_app
+
+from referencesrv.metrics import METRICS
+
+
+class DocumentCache(object):
+    """
+    least recently used cache with a time to live, safe to share among threads
+    """
+    def __init__(self, max_size, ttl, name='document_cache'):
+        """
+
+        :param max_size: maximum number of entries, the least recently used are evicted beyond that
+        :param ttl: number of seconds an entry is valid for
+        :param name: prefix of the metrics of this cache
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.name = name
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+        returns the cached value, None if not cached or expired
+
+        :param key:
+        :return:
+        """
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is not None:
+                if entry[0] > time.time():
+                    self.entries.move_to_end(key)
+                    METRICS.incr('%s.hits' % self.name)
+                    return entry[1]
+                del self.entries[key]
+        METRICS.incr('%s.misses' % self.name)
+        return None
+
+    def put(self, key, value):
+        """
+
+        :param key:
+        :param value:
+        :return:
+        """
+        with self.lock:
+            self.entries[key] = (time.time() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                METRICS.incr('%s.evictions' % self.name)
+            METRICS.set('%s.size' % self.name, len(self.entries))
+
+    def clear(self):
+        """
+
+        :return:
+        """
+        with self.lock:
+            self.entries.clear()
+            METRICS.set('%s.size' % self.name, 0)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def get_document_cache():
+    """
+    returns the process wide cache of massaged solr records, creating it on first use
+
+    :return:
+    """
+    document_cache = current_app.extensions.get('document_cache', None)
+    if document_cache is None:
+        document_cache = DocumentCache(current_app.config['REFERENCE_SERVICE_DOCUMENT_CACHE_SIZE'],
+                                       current_app.config['REFERENCE_SERVICE_DOCUMENT_CACHE_TTL'])
+        current_app.extensions['document_cache'] = document_cache
+    return document_cache
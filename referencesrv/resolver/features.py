@@ -0,0 +1,130 @@
+"""
+The features of a document, ie, a solr record massaged by the querier, normalized the way the
+evidence functions compare them, so that it is done once per document, and not once for each
+hypothesis of each reference the document is a candidate of.
+
+The features are computed when the querier takes the document in, and are cached by bibcode,
+for as long as the documents of the document cache are. The querier attaches them to the record,
+under FEATURES_KEY, so that scoring reads them off the record, see get_record_features.
+"""
+
+from flask import current_app
+
+from referencesrv.resolver.authors import get_ads_last_name
+from referencesrv.resolver.journalfield import normalize_words, get_pub_normalizer
+from referencesrv.resolver.documentcache import DocumentCache
+from referencesrv.resolver.similarity import tokenize_title, tokenize_pub
+
+
+# the key of the features in the massaged record
+FEATURES_KEY = '_features'
+
+def get_plain_number(value):
+    """
+    returns value as an integer if it is a plain number, -1 otherwise
+
+    :param value:
+    :return:
+    """
+    return int(value) if isinstance(value, str) and value.isdigit() else -1
+
+
+class DocumentFeatures(object):
+    """
+    the normalized fields of a document:
+
+        author_last_names, the last names of author_norm, as count_matching_authors compares them,
+        title, the main title lower cased without punctuation, and its words, as add_title_evidence compares them,
+        pubs, the publication, the raw publication, and the title with the bibcode, as compute_pubstring_statistics
+            compares them, keyed by field,
+        year, volume, and page, as integers, -1 if not plain numbers,
+        title_tokens and pub_tokens, the token sets of title and pubs, computed on first use,
+            since only the token similarity compares them, see similarity.
+    """
+    __slots__ = ('author_last_names', 'title', 'pubs', 'year', 'volume', 'page', 'title_tokens', 'pub_tokens')
+
+    def __init__(self, document, pub_normalizer):
+        """
+
+        :param document: massaged solr record
+        :param pub_normalizer: the PubNormalizer cooking the publication strings
+        """
+        self.author_last_names = [get_ads_last_name(author) for author in document.get('author_norm') or []]
+        self.title = normalize_words(document.get('title', '').split('-')[0])
+        bibcode = document.get('bibcode', '')
+        self.pubs = {field: pub_normalizer.cook_reference_pub(document.get(field, '').lower() + ' ' + bibcode.lower())
+                     for field in ['pub', 'pub_raw', 'title']}
+        self.year = get_plain_number(document.get('year')) if len(document.get('year') or '') == 4 else -1
+        self.volume = get_plain_number(document.get('volume'))
+        self.page = get_plain_number(document.get('page'))
+        self.title_tokens = None
+        self.pub_tokens = None
+
+    def get_title_tokens(self):
+        """
+        returns the token set of the main title
+
+        :return:
+        """
+        if self.title_tokens is None:
+            self.title_tokens = tokenize_title(self.title[0])
+        return self.title_tokens
+
+    def get_pub_tokens(self, field):
+        """
+        returns the token set of the cooked publication string of field
+
+        :param field: one of pub, pub_raw, and title
+        :return:
+        """
+        if self.pub_tokens is None:
+            self.pub_tokens = {name: tokenize_pub(cooked_pub) for name, cooked_pub in self.pubs.items()}
+        return self.pub_tokens[field]
+
+
+def get_feature_cache():
+    """
+    returns the process wide cache of document features, creating it on first use
+
+    :return:
+    """
+    feature_cache = current_app.extensions.get('feature_cache', None)
+    if feature_cache is None:
+        feature_cache = DocumentCache(current_app.config['REFERENCE_SERVICE_DOCUMENT_CACHE_SIZE'],
+                                      current_app.config['REFERENCE_SERVICE_DOCUMENT_CACHE_TTL'],
+                                      name='feature_cache')
+        current_app.extensions['feature_cache'] = feature_cache
+    return feature_cache
+
+
+def get_document_features(document):
+    """
+    returns the features of the document, computing them if the document has not been seen before
+
+    :param document: massaged solr record
+    :return:
+    """
+    bibcode = document.get('bibcode', None)
+    if not bibcode:
+        return DocumentFeatures(document, get_pub_normalizer())
+    feature_cache = get_feature_cache()
+    features = feature_cache.get(bibcode)
+    if features is None:
+        features = DocumentFeatures(document, get_pub_normalizer())
+        feature_cache.put(bibcode, features)
+    return features
+
+
+def get_record_features(record, context):
+    """
+    returns the features the querier attached to the record, computing and attaching them
+    with the pub normalizer of the scoring context if the record did not come from the querier
+
+    :param record: massaged solr record
+    :param context: ScoringContext
+    :return:
+    """
+    features = record.get(FEATURES_KEY, None)
+    if features is None:
+        features = record[FEATURES_KEY] = DocumentFeatures(record, context.pub_normalizer)
+    return features
@@ -6,6 +6,7 @@ from referencesrv.resolver.scoring import get_score_for_reference_identifier, ge
     get_thesis_score_for_input_fields, get_book_score_for_input_fields
 from referencesrv.resolver.specialrules import iter_journal_specific_hypotheses
 from referencesrv.resolver.journalfield import get_best_bibstem_for, cook_title_string, has_thesis_indicators
+from referencesrv.resolver.volumeranges import prune_impossible_hypotheses, get_volume_ranges
 
 from flask import current_app
 
@@ -41,12 +42,14 @@ class Hypotheses(object):
                              'MIEB','MPL','NCim','NIMP','NuPh','PGen','PhL','PhRv','Phy','PMag',
                              'RSPS','RSPT','Tell','ZNat','ZPhy']
 
-    def __init__(self, ref):
+    def __init__(self, ref, citing_year=None):
         """
         
         :param ref: 
+        :param citing_year: publication year of the citing paper, if known
         """
         self.ref = ref
+        self.citing_year = citing_year
         self.make_digested_record()
 
     def __str__(self):
@@ -276,7 +279,59 @@ class Hypotheses(object):
                            year=year,journal=journal,volume=volume,page_qualifier=q,page=p))
         return bibcode
 
-    def iter_hypotheses(self):
+    def iter_hypotheses(self, context):
+        """
+        iterates over the hypotheses, including the journal specific ones, less the ones
+        with a bibstem, year, volume, and page the table of volume ranges rules out
+
+        :param context: ScoringContext
+        :return:
+        """
+        return prune_impossible_hypotheses(self.iter_unpruned_hypotheses(context), context)
+
+    def get_year_windows(self, year, context):
+        """
+        returns the half width, and first and last year, of each window of the approximate year hypothesis,
+        narrowest first
+
+        The narrow windows of REFERENCE_SERVICE_YEAR_WINDOWS are tried only when there is evidence of
+        the year of the record, the year of the citing paper, which it cannot be much later than, or the
+        years the table of volume ranges has the volume of the bibstem in. Each is cut down to these
+        years, or moved onto them if the year of the reference is off, and without evidence, only the
+        widest window is tried.
+
+        :param year: the year of the reference
+        :param context: ScoringContext
+        :return: list of (half width, first year, last year)
+        """
+        half_widths = sorted(current_app.config['REFERENCE_SERVICE_YEAR_WINDOWS']) or [5]
+        widest = half_widths[-1]
+        first, last = year - widest, year + widest
+        if self.citing_year:
+            last = min(last, self.citing_year + context.citing_year_slack)
+        if first > last:
+            return []
+        volume_years = None
+        volume_ranges = get_volume_ranges()
+        bibstem = self.digested_record.get("bibstem", "").rstrip('*')
+        if volume_ranges is not None and bibstem:
+            volume_years = volume_ranges.get_volume_years(bibstem, self.digested_record.get("volume"),
+                                                          context.volume_ranges_slack)
+        if not self.citing_year and volume_years is None:
+            return [(widest, first, last)]
+
+        lowest, highest = (max(first, volume_years[0]), min(last, volume_years[1])) if volume_years else (first, last)
+        year_windows = []
+        for half_width in half_widths[:-1]:
+            low, high = max(year - half_width, lowest), min(year + half_width, highest)
+            if low > high:
+                low, high = lowest, highest
+            if low <= high and (low, high) != (first, last) and \
+                    (not year_windows or year_windows[-1][1:] != (low, high)):
+                year_windows.append((half_width, low, high))
+        return year_windows + [(widest, first, last)]
+
+    def iter_unpruned_hypotheses(self, context):
         has_etal = self.ETAL_PAT.search(str(self.ref)) is not None
 
         # If there's a DOI, use it.
@@ -496,13 +551,27 @@ class Hypotheses(object):
                 page_qualifier=self.digested_record.get("qualifier", ""),
                 has_etal=has_etal,
                 normalized_authors=self.normalized_authors)
-            # and now approximate year
-            yield Hypothesis("fielded-author/year~", {
-                "author": self.normalized_authors,
-                "year~": self.digested_record["year"]},
-                get_score_for_input_fields,
-                input_fields=self.digested_record,
-                page_qualifier=self.digested_record.get("qualifier", ""),
-                has_etal=has_etal,
-                normalized_authors=self.normalized_authors)
+            # and now approximate year, widening the window only if the narrower one did not resolve
+            year_match = self.YEAR_PATTERN.match(self.digested_record["year"])
+            if year_match:
+                year_windows = self.get_year_windows(int(year_match.group(1)), context)
+                for year_window, first, last in year_windows:
+                    yield Hypothesis("fielded-author/year~%d"%year_window if len(year_windows) > 1 else "fielded-author/year~", {
+                        "author": self.normalized_authors,
+                        "year~": "%d TO %d"%(first, last)},
+                        get_score_for_input_fields,
+                        input_fields=self.digested_record,
+                        page_qualifier=self.digested_record.get("qualifier", ""),
+                        has_etal=has_etal,
+                        normalized_authors=self.normalized_authors,
+                        year_window=year_window)
+            else:
+                yield Hypothesis("fielded-author/year~", {
+                    "author": self.normalized_authors,
+                    "year~": self.digested_record["year"]},
+                    get_score_for_input_fields,
+                    input_fields=self.digested_record,
+                    page_qualifier=self.digested_record.get("qualifier", ""),
+                    has_etal=has_etal,
+                    normalized_authors=self.normalized_authors)
 
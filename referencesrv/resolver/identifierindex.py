@@ -0,0 +1,244 @@
+"""
+An optional local index of identifiers (DOI, arXiv id, ASCL id, bibcode and
+alternate bibcodes) pointing to the canonical bibcode and scix_id of a record.
+
+The index is built from a bulk export file into a read-only, memory mapped
+SQLite file, so that the pure identifier hypotheses can be answered locally.
+Solr remains the fallback whenever the index has no entry for an identifier.
+
+The export file has one json document per line, with the fields
+bibcode, scix_id, identifier and doi, as returned by solr for the query fields
+`bibcode,scix_id,identifier,doi`.
+"""
+
+import os
+import json
+import sqlite3
+import threading
+import time
+import traceback
+
+from flask import current_app
+
+
+# identifiers starting with these are case insensitive, and are lower cased in the index,
+# bibcodes are case sensitive and are kept as they are
+CASE_INSENSITIVE_PREFIXES = ('10.', 'doi:', 'arxiv:', 'ascl:')
+
+
+def normalize_identifier(identifier):
+    """
+    returns identifier stripped, and lower cased if it is a DOI, an arXiv id, or an ASCL id
+
+    :param identifier:
+    :return:
+    """
+    identifier = identifier.strip()
+    lowered = identifier.lower()
+    if lowered.startswith(CASE_INSENSITIVE_PREFIXES):
+        return lowered
+    return identifier
+
+
+class IdentifierIndex(object):
+    """
+    read-only access to an identifier index file.
+
+    SQLite connections should not be shared among threads, so each thread
+    gets its own connection to the (memory mapped) file.
+    """
+
+    # hint name -> prefix of the key in the index, hint names are the ones used in hypotheses
+    HINT_PREFIXES = {
+        'doi': '',
+        'arxiv': 'arxiv:',
+        'ascl': 'ascl:',
+        'bibcode': '',
+    }
+
+    def __init__(self, index_file, mmap_size=0):
+        """
+
+        :param index_file: path to the SQLite file created by build_identifier_index
+        :param mmap_size: number of bytes of the file to memory map
+        """
+        self.index_file = index_file
+        self.mmap_size = mmap_size
+        self.local = threading.local()
+
+    def get_connection(self):
+        """
+        returns the connection of the current thread, opening it if needed
+
+        :return:
+        """
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect('file:%s?mode=ro'%self.index_file, uri=True, check_same_thread=False)
+            connection.execute('PRAGMA mmap_size=%d'%int(self.mmap_size))
+            self.local.connection = connection
+        return connection
+
+    def lookup(self, key):
+        """
+        returns the tuple (bibcode, scix_id) the identifier key points to, None if not in the index
+
+        :param key: normalized identifier, see get_index_keys
+        :return:
+        """
+        row = self.get_connection().execute('SELECT bibcode, scix_id FROM identifiers WHERE key = ?',
+                                            (normalize_identifier(key),)).fetchone()
+        if row:
+            return row[0], row[1]
+        return None
+
+    def lookup_hint(self, name, value):
+        """
+        returns the tuple (bibcode, scix_id) for a hypothesis identifier hint, None if not in the index
+
+        :param name: one of doi, arxiv, ascl, or bibcode
+        :param value:
+        :return:
+        """
+        prefix = self.HINT_PREFIXES.get(name, None)
+        if prefix is None or not value:
+            return None
+        return self.lookup(prefix + value)
+
+    def get_stats(self):
+        """
+        returns when and from what the index was built, and how many identifiers it holds
+
+        :return:
+        """
+        meta = dict(self.get_connection().execute('SELECT name, value FROM meta').fetchall())
+        return {
+            'built': float(meta.get('built', 0)),
+            'source': meta.get('source', ''),
+            'count': int(meta.get('count', 0)),
+        }
+
+
+def get_index_keys(doc):
+    """
+    returns the normalized identifiers of a solr document, see normalize_identifier
+
+    The canonical bibcode is returned separately, since it takes precedence
+    over any other record listing it as an alternate identifier.
+
+    :param doc:
+    :return: canonical key, set of other keys
+    """
+    bibcode = normalize_identifier(doc.get('bibcode', ''))
+    keys = set()
+    for identifier in doc.get('identifier', []) + doc.get('doi', []):
+        identifier = normalize_identifier(identifier)
+        if identifier and identifier != bibcode:
+            keys.add(identifier)
+    return bibcode, keys
+
+
+def build_identifier_index(export_file, index_file):
+    """
+    builds the identifier index from the bulk export file
+
+    The index is first written to a temporary file and then moved in place,
+    so processes that have the old index open keep on working with it until reloaded.
+
+    Identifiers that are claimed by more than one record, and are not the canonical
+    bibcode of one of them, are ambiguous and left out, so that solr decides on those.
+
+    :param export_file:
+    :param index_file:
+    :return: number of identifiers in the index
+    """
+    tmp_file = index_file + '.tmp'
+    if os.path.exists(tmp_file):
+        os.remove(tmp_file)
+
+    connection = sqlite3.connect(tmp_file)
+    try:
+        connection.execute('CREATE TABLE entries (key TEXT, bibcode TEXT, scix_id TEXT, canonical INTEGER)')
+        connection.execute('CREATE TABLE identifiers (key TEXT PRIMARY KEY, bibcode TEXT, scix_id TEXT) WITHOUT ROWID')
+        connection.execute('CREATE TABLE meta (name TEXT PRIMARY KEY, value TEXT)')
+
+        with open(export_file, 'r') as f:
+            batch = []
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                doc = json.loads(line)
+                bibcode, scix_id = doc.get('bibcode', None), doc.get('scix_id', None)
+                if not bibcode:
+                    continue
+                canonical, keys = get_index_keys(doc)
+                batch.append((canonical, bibcode, scix_id, 1))
+                batch.extend((key, bibcode, scix_id, 0) for key in keys)
+                if len(batch) >= 100000:
+                    connection.executemany('INSERT INTO entries VALUES (?, ?, ?, ?)', batch)
+                    batch = []
+            connection.executemany('INSERT INTO entries VALUES (?, ?, ?, ?)', batch)
+
+        connection.execute('INSERT OR IGNORE INTO identifiers '
+                           'SELECT key, bibcode, scix_id FROM entries WHERE canonical = 1')
+        connection.execute('INSERT OR IGNORE INTO identifiers '
+                           'SELECT key, MIN(bibcode), MIN(scix_id) FROM entries WHERE canonical = 0 '
+                           'GROUP BY key HAVING COUNT(DISTINCT bibcode) = 1')
+        connection.execute('DROP TABLE entries')
+
+        count = connection.execute('SELECT COUNT(*) FROM identifiers').fetchone()[0]
+        connection.executemany('INSERT INTO meta VALUES (?, ?)',
+                               [('built', str(time.time())), ('source', export_file), ('count', str(count))])
+        connection.commit()
+        connection.execute('VACUUM')
+    finally:
+        connection.close()
+
+    os.replace(tmp_file, index_file)
+    return count
+
+
+def create_identifier_index():
+    """
+    rebuild the identifier index from the configured export file
+
+    :return: the stats of the new index
+    """
+    try:
+        start_time = time.time()
+        index_file = current_app.config['REFERENCE_SERVICE_IDENTIFIER_INDEX']
+        export_file = current_app.config['REFERENCE_SERVICE_IDENTIFIER_EXPORT']
+        if not index_file or not export_file:
+            raise ValueError('REFERENCE_SERVICE_IDENTIFIER_INDEX and REFERENCE_SERVICE_IDENTIFIER_EXPORT need to be configured')
+        count = build_identifier_index(export_file, index_file)
+        current_app.logger.info("saved identifier index with %d identifiers in %s." % (count, index_file))
+        current_app.logger.debug("identifier index built in %s ms" % ((time.time() - start_time) * 1000))
+        identifier_index = IdentifierIndex(index_file, current_app.config['REFERENCE_SERVICE_IDENTIFIER_INDEX_MMAP_SIZE'])
+        current_app.extensions['identifier_index'] = identifier_index
+        return identifier_index.get_stats()
+    except Exception as e:
+        current_app.logger.error('Exception: %s' % (str(e)))
+        current_app.logger.error(traceback.format_exc())
+        raise e
+
+
+def load_identifier_index():
+    """
+    open the identifier index if one has been configured
+
+    :return: IdentifierIndex object, or None if there is no index
+    """
+    index_file = current_app.config.get('REFERENCE_SERVICE_IDENTIFIER_INDEX', None)
+    if not index_file:
+        return None
+    try:
+        identifier_index = IdentifierIndex(index_file, current_app.config['REFERENCE_SERVICE_IDENTIFIER_INDEX_MMAP_SIZE'])
+        stats = identifier_index.get_stats()
+        current_app.logger.info("loaded identifier index from %s, built %s from %s with %d identifiers." % (
+            index_file, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(stats['built'])), stats['source'], stats['count']))
+        return identifier_index
+    except Exception as e:
+        current_app.logger.error('Exception: %s' % (str(e)))
+        current_app.logger.error(traceback.format_exc())
+        return None
@@ -9,12 +9,13 @@ ADS gives a field (i.e., not None or empty string) while the other does.
 
 import regex as re
 import editdistance
-import unidecode
 import math
 
 from flask import current_app
 
-from referencesrv.resolver.common import SOURCE_MATCHER, round_two_significant_digits
+from referencesrv.resolver.common import SOURCE_MATCHER, round_two_significant_digits, get_scoring_context
+from referencesrv.resolver.pubnormalizer import PubNormalizer
+from referencesrv.resolver.similarity import get_title_tokens, tokenize_title, tokenize_pub, get_title_similarity
 
 
 # A string containing all "modifiers" to page numbers from
@@ -97,25 +98,25 @@ def add_volume_evidence(evidences, ref_volume, ads_volume, ads_issue, ads_pub_ra
         if not ads_volume and ads_pub_raw:
             # see if reference volume appears in ads pub_raw
             if re.search(r'\b(%s)\b'%ref_volume, ads_pub_raw):
-                evidences.add_evidence(current_app.config['EVIDENCE_SCORE_RANGE'][1] * current_app.config['MISSING_VOLUME_FACTORY'], 'volume')
+                evidences.add_evidence(evidences.max_score * evidences.context.missing_volume_factor, 'volume')
                 return
-        evidences.add_evidence(current_app.config['EVIDENCE_SCORE_RANGE'][0] if ads_volume else 0, 'volume')
+        evidences.add_evidence(evidences.min_score if ads_volume else 0, 'volume')
         return
 
     try:
         if int(ref_volume) == int(ads_volume):
-            score = current_app.config['EVIDENCE_SCORE_RANGE'][1]
+            score = evidences.max_score
         # sometimes ads_volume holds conference year, and references include the issue
         # see if ads_volume is a year, if so then check the reference against issue
         elif ads_issue and YEAR_PATTERN.findall(ads_volume) and int(ref_volume)==int(ads_issue):
-            score = current_app.config['EVIDENCE_SCORE_RANGE'][1]
+            score = evidences.max_score
         else:
             delta_volume = compute_closeness_two_numbers(ref_volume, ads_volume)
             delta_issue = compute_closeness_two_numbers(ref_volume, ads_issue) if ads_issue and YEAR_PATTERN.findall(ads_volume) else 0
-            score = current_app.config['EVIDENCE_SCORE_RANGE'][1] * max(delta_volume, delta_issue)
+            score = evidences.max_score * max(delta_volume, delta_issue)
     except ValueError:
         # Some weird format, so use edit distance
-        score = string_similarity(ref_volume, ads_volume)
+        score = string_similarity(ref_volume, ads_volume, evidences.min_score)
 
     evidences.add_evidence(score, 'volume')
     return
@@ -177,13 +178,14 @@ def compute_closeness_two_numbers(num1, num2):
         return round_two_significant_digits(closeness * 10) if closeness > 0 else 0
 
 
-def compute_page_delta_plain_number(ref_page, ads_match, ref_qualifier):
+def compute_page_delta_plain_number(ref_page, ads_match, ref_qualifier, context):
     """
     helps compute_page_delta for actual numeric page numbers.
 
     :param ref_page:
     :param ads_match:
     :param ref_qualifier:
+    :param context: ScoringContext
     :return:
     """
     delta = 0
@@ -200,23 +202,24 @@ def compute_page_delta_plain_number(ref_page, ads_match, ref_qualifier):
     ref_page = ref_page.replace(".", "")
 
     if int(ads_page)==int(ref_page):
-        delta += current_app.config['EVIDENCE_SCORE_RANGE'][1]
+        delta += context.max_score
         if ads_letter or ref_qualifier:
             if ads_letter!=ref_qualifier:
-                delta += current_app.config['NO_LETTER_DEMERIT']
+                delta += context.no_letter_demerit
     else:
         return compute_closeness_two_numbers(ref_page, ads_page)
 
     return delta
 
 
-def compute_page_delta(ref_page, ads_page, ref_qualifier=None):
+def compute_page_delta(ref_page, ads_page, context, ref_qualifier=None):
     """
     returns a confidence delta between page specifications from
     the reference and from ADS.
 
     :param ref_page:
     :param ads_page:
+    :param context: ScoringContext
     :param ref_qualifier:
     :return:
     """
@@ -230,11 +233,11 @@ def compute_page_delta(ref_page, ads_page, ref_qualifier=None):
         mat = ADS_NUMERIC_PAGE_PATTERN.match(ads_page)
         if not mat:
             raise ValueError('ADS page in bad format')
-        delta = compute_page_delta_plain_number(ref_page, mat, ref_qualifier)
+        delta = compute_page_delta_plain_number(ref_page, mat, ref_qualifier, context)
     except ValueError:
         # it's some weird identifier.  String identity should do for the moment.
         if ads_page==ref_page:
-            delta = current_app.config['EVIDENCE_SCORE_RANGE'][1]
+            delta = context.max_score
         else:
             return 0
 
@@ -259,12 +262,12 @@ def add_page_evidence(evidences, ref_page, ads_page, ads_page_range="", ads_eid=
         return
     # if reference is a page range compare to ads_page range
     if isinstance(ref_page, str) and '-' in ref_page:
-        delta = compute_page_delta(ref_page, ads_page_range, ref_qualifier)
+        delta = compute_page_delta(ref_page, ads_page_range, evidences.context, ref_qualifier)
     else:
-        delta = compute_page_delta(ref_page, ads_page, ref_qualifier)
+        delta = compute_page_delta(ref_page, ads_page, evidences.context, ref_qualifier)
         # if there is eid, compare that to ref_page and pick the largest delta
         if ads_eid:
-            delta = max(delta, compute_page_delta(ref_page, ads_eid, ref_qualifier))
+            delta = max(delta, compute_page_delta(ref_page, ads_eid, evidences.context, ref_qualifier))
     if delta is not None:
         evidences.add_evidence(delta, 'page')
 
@@ -313,23 +316,35 @@ def add_year_evidence(evidences, ref_year, ads_year):
     evidences.add_evidence(number_similarity(ref_year, ads_year), "year")
 
 
-def compute_pubstring_statistics(ref_pub, ads_pub, suggested_bibcode):
+def compute_pubstring_statistics(ref_pub, ads_pub, suggested_bibcode, pub_normalizer, cooked_ads_pub=None, ads_pub_tokens=None):
     """
     returns a tuple (total_ref_words, missing_ref_words).
 
     A word from ref_pub is accounted for it's position found in ads_pub
     or anywhere in the bibcode.
 
+    If the token set of ads_pub is given, a word from ref_pub is accounted for if
+    a word of ads_pub, or an alphabetic or numeric part of the bibcode, starts with it.
+
     :param ref_pub:
     :param ads_pub:
     :param suggested_bibcode:
+    :param pub_normalizer: the PubNormalizer cooking the publication strings
+    :param cooked_ads_pub: ads_pub and suggested_bibcode cooked, if already done, see features
+    :param ads_pub_tokens: token set of the cooked ads_pub, to compare the words with, see similarity
     :return:
     """
-    ref_pub = cook_reference_pub(ref_pub).lower()
-    ads_pub = cook_reference_pub(ads_pub.lower()+' '+suggested_bibcode.lower())
+    ref_pub = pub_normalizer.cook_reference_pub(ref_pub).lower()
+    ref_words = re.findall(r"\w\w+", ref_pub or "")
+    if ads_pub_tokens is not None:
+        return len(ref_words), sum(1 for ref_word in ref_words if not ads_pub_tokens.has_prefix(ref_word))
+
+    if cooked_ads_pub is not None:
+        ads_pub = cooked_ads_pub
+    else:
+        ads_pub = pub_normalizer.cook_reference_pub(ads_pub.lower()+' '+suggested_bibcode.lower())
 
     missing_words = 0
-    ref_words = re.findall(r"\w\w+", ref_pub or "")
 
     for ref_word in ref_words:
         if ref_word not in ads_pub:
@@ -338,26 +353,37 @@ def compute_pubstring_statistics(ref_pub, ads_pub, suggested_bibcode):
     return len(ref_words), missing_words
 
 
-def string_similarity(str_a, str_b):
+def normalize_words(text):
+    """
+    returns text lower cased with punctuation removed, and its words, as string_similarity compares them
+
+    :param text:
+    :return:
+    """
+    text = " ".join(re.split('\W+', text.lower()))
+    return text, re.findall(r"\w+", text or "")
+
+
+def string_similarity(str_a, str_b, min_score, normalized_b=None):
     """
     find how many words from str_a exists in str_b
 
     :param str_a:
     :param str_b:
+    :param min_score: the score if either is empty
+    :param normalized_b: normalize_words of str_b, if already computed
     :return:
     """
     if str_a is None or str_b is None:
-        return current_app.config['EVIDENCE_SCORE_RANGE'][0]
+        return min_score
     if max(len(str_a), len(str_b)) == 0:
-        return current_app.config['EVIDENCE_SCORE_RANGE'][0]
+        return min_score
 
     # remove punctuation and turn lower case
     str_a = " ".join(re.split('\W+', str_a.lower()))
-    str_b = " ".join(re.split('\W+', str_b.lower()))
-
-    words = re.findall(r"\w+", str_b or "")
+    str_b, words = normalized_b or normalize_words(str_b)
     if len(words) == 0:
-        return current_app.config['EVIDENCE_SCORE_RANGE'][0]
+        return min_score
 
     # if the beginning matches, bring that score
     # sometimes subtitle is missing in one string and is included in another
@@ -379,7 +405,8 @@ def string_similarity(str_a, str_b):
     return (len(words)-2*len_missing_words)/float(len(words))
 
 
-def add_publication_evidence(evidences, ref_pub, ref_bibstem, ref_str, ads_pub, ads_bibcode, ads_bibstem):
+def add_publication_evidence(evidences, ref_pub, ref_bibstem, ref_str, ads_pub, ads_bibcode, ads_bibstem, cooked_ads_pub=None,
+                             ads_pub_tokens=None):
     """
     adds evidence from comparing the publication string within the
     reference with ADS' one and the suspected bibcode.
@@ -395,11 +422,14 @@ def add_publication_evidence(evidences, ref_pub, ref_bibstem, ref_str, ads_pub,
     :param ref_str:
     :param ads_pub:
     :param ads_bibcode:
+    :param cooked_ads_pub: ads_pub and ads_bibcode cooked, if already done, see features
+    :param ads_pub_tokens: token set of the cooked ads_pub, if already computed, see features,
+        only used if the scoring context compares token sets
     :return:
     """
     if (len(ref_bibstem) > 1 and (ref_bibstem in ads_bibcode)) or \
        (len(ref_pub) > 1 and (ads_bibstem in ref_pub)):
-        evidences.add_evidence(current_app.config['EVIDENCE_SCORE_RANGE'][1], 'pub')
+        evidences.add_evidence(evidences.max_score, 'pub')
         return
 
     nonzeros = [a for a in [ref_pub, ads_pub] if a]
@@ -407,13 +437,13 @@ def add_publication_evidence(evidences, ref_pub, ref_bibstem, ref_str, ads_pub,
     if len(nonzeros) == 0 or not ref_pub:
         return
     if len(nonzeros) == 1:
-        evidences.add_evidence(current_app.config['EVIDENCE_SCORE_RANGE'][0], 'pub')
+        evidences.add_evidence(evidences.min_score, 'pub')
         return
 
     # if ref_pub is one word, see how similar it is with ads_bibstem
     # if the similarity is larger than half, do not penalize, maybe it is typo, but don't help either
     if len(ref_pub.split()) == 1:
-        if string_similarity(ref_pub, ads_bibstem) >= 0.5:
+        if string_similarity(ref_pub, ads_bibstem, evidences.min_score) >= 0.5:
             evidences.add_evidence(0, 'pubstring')
             return
 
@@ -422,7 +452,14 @@ def add_publication_evidence(evidences, ref_pub, ref_bibstem, ref_str, ads_pub,
     if re.search(r"\b%s\b"%ads_bibstem, ref_str):
         return
 
-    total_ref_words, missing_ref_words = compute_pubstring_statistics(ref_pub, ads_pub, ads_bibcode)
+    if not evidences.context.token_similarity:
+        ads_pub_tokens = None
+    elif ads_pub_tokens is None:
+        if cooked_ads_pub is None:
+            cooked_ads_pub = evidences.context.pub_normalizer.cook_reference_pub(ads_pub.lower()+' '+ads_bibcode.lower())
+        ads_pub_tokens = tokenize_pub(cooked_ads_pub)
+    total_ref_words, missing_ref_words = compute_pubstring_statistics(ref_pub, ads_pub, ads_bibcode, evidences.context.pub_normalizer,
+                                                                      cooked_ads_pub, ads_pub_tokens)
     if total_ref_words:
         evidences.add_evidence((total_ref_words-2*missing_ref_words)/float(total_ref_words), 'pubstring')
 
@@ -438,6 +475,15 @@ def has_word(haystack, needle):
     return re.search(r"\b%s\b"%re.escape(needle), haystack) is not None
 
 
+def get_pub_normalizer():
+    """
+    returns the normalizer of publication strings and titles of the config of the app, the one of its scoring context
+
+    :return:
+    """
+    return get_scoring_context().pub_normalizer
+
+
 def has_thesis_indicators(pub_string):
     """
     returns true if pub_string could point to some thesis.
@@ -447,15 +493,7 @@ def has_thesis_indicators(pub_string):
     :param pub_string:
     :return:
     """
-    stuff_to_match = unidecode.unidecode(pub_string).lower()
-    for thesis_word in current_app.config['THESIS_INDICATOR_WORDS']:
-        if thesis_word.endswith("*"):
-            if thesis_word[:-1] in stuff_to_match:
-                return True
-        else:
-            if has_word(stuff_to_match, thesis_word):
-                return True
-    return False
+    return get_pub_normalizer().has_thesis_indicators(pub_string)
 
 
 def cook_reference_pub(pub_string):
@@ -466,11 +504,7 @@ def cook_reference_pub(pub_string):
     :param pub_string:
     :return:
     """
-    expansion_mapping = current_app.config["JOURNAL_ABBREVIATION"]
-    stop_words = re.compile("\b({})\b".format("|".join(current_app.config["REFERENCE_SERVICE_STOP_WORDS"])))
-    elements = stop_words.sub(" ", pub_string).split()
-    # we need embedded ampersands as "and" so we accept A&A as  word
-    return " ".join(expansion_mapping.get(e, e) for e in elements).replace("&", "and")
+    return get_pub_normalizer().cook_reference_pub(pub_string)
 
 
 def cook_title_string(title):
@@ -481,20 +515,19 @@ def cook_title_string(title):
     :param title:
     :return:
     """
-    return " ".join(p
-                    for p in re.sub(r"[^\w]+", " ",
-                                    title).split()
-                    if p not in current_app.config["REFERENCE_SERVICE_STOP_WORDS"]
-                    and len(p) > 5)
+    return get_pub_normalizer().cook_title_string(title)
 
 
-def add_title_evidence(evidences, ref_title, ads_title):
+def add_title_evidence(evidences, ref_title, ads_title, normalized_ads_title=None, ads_title_tokens=None):
     """
     adds evidence from comparing publication title.
 
     :param evidences:
     :param ref_title:
     :param ads_title:
+    :param normalized_ads_title: normalize_words of the main ads_title, if already computed, see features
+    :param ads_title_tokens: token set of the main ads_title, if already computed, see features,
+        only used if the scoring context compares token sets
     :return:
     """
     if not ref_title:
@@ -504,4 +537,10 @@ def add_title_evidence(evidences, ref_title, ads_title):
     ref_title = ref_title.split('-')[0]
     ads_title = ads_title.split('-')[0]
 
-    evidences.add_evidence(string_similarity(ref_title, ads_title), "title")
+    if evidences.context.token_similarity:
+        if ads_title_tokens is None:
+            ads_title_tokens = tokenize_title(ads_title)
+        evidences.add_evidence(get_title_similarity(get_title_tokens(ref_title), ads_title_tokens, evidences.min_score), "title")
+        return
+
+    evidences.add_evidence(string_similarity(ref_title, ads_title, evidences.min_score, normalized_ads_title), "title")
@@ -0,0 +1,64 @@
+"""
+Bounded, process wide memoization of pure functions, ie, the normalization of author strings,
+that the hypotheses of a reference, the references of a request, and the candidates of the queries
+call again and again with the same arguments.
+
+The hits and misses of each memoized function are counted in the metrics.
+"""
+
+import threading
+
+from collections import OrderedDict
+from functools import wraps
+
+from referencesrv.metrics import METRICS
+
+
+def memoized(name, max_size):
+    """
+    decorator keeping the results of the max_size most recently used arguments of a pure function,
+    counting name.hits and name.misses in the metrics
+
+    the arguments need to be hashable, and exceptions are not kept, they are raised again on the next call
+
+    :param name: prefix of the metrics of the function
+    :param max_size:
+    :return:
+    """
+    def decorator(function):
+        entries = OrderedDict()
+        lock = threading.Lock()
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            key = (args, tuple(sorted(kwargs.items()))) if kwargs else args
+            with lock:
+                if key in entries:
+                    entries.move_to_end(key)
+                    result = entries[key]
+                    hit = True
+                else:
+                    hit = False
+            if hit:
+                METRICS.incr('%s.hits' % name)
+                return result
+
+            METRICS.incr('%s.misses' % name)
+            result = function(*args, **kwargs)
+            with lock:
+                entries[key] = result
+                while len(entries) > max_size:
+                    entries.popitem(last=False)
+            return result
+
+        def cache_clear():
+            with lock:
+                entries.clear()
+
+        def cache_size():
+            return len(entries)
+
+        wrapper.cache_clear = cache_clear
+        wrapper.cache_size = cache_size
+        return wrapper
+    return decorator
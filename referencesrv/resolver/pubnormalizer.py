@@ -0,0 +1,73 @@
+"""
+The normalization of publication strings and titles, built from the lists of the config, kept apart
+from journalfield so that the scoring context can carry it, see common.ScoringContext.
+"""
+
+import regex as re
+import unidecode
+
+from referencesrv.resolver.memoize import memoized
+
+
+NON_WORD_PATTERN = re.compile(r"[^\w]+")
+
+# the number of publication strings and titles kept normalized
+PUB_STRINGS_CACHE_SIZE = 4096
+
+
+class PubNormalizer(object):
+    """
+    the normalization of publication strings and titles, with the patterns built once from the config lists,
+    and the results for the most recently seen strings kept, since the hypotheses of a reference, and the
+    candidates of its queries, come back with the same ones
+    """
+
+    def __init__(self, config):
+        """
+
+        :param config: the config of the app
+        """
+        self.expansion_mapping = config["JOURNAL_ABBREVIATION"]
+        # note that the word boundaries here are backspaces, kept as they have always been
+        self.stop_words_pattern = re.compile("\b({})\b".format("|".join(config["REFERENCE_SERVICE_STOP_WORDS"])))
+        self.stop_words = frozenset(config["REFERENCE_SERVICE_STOP_WORDS"])
+        thesis_words = [thesis_word for thesis_word in config['THESIS_INDICATOR_WORDS'] if not thesis_word.endswith("*")]
+        self.thesis_prefixes = [thesis_word[:-1] for thesis_word in config['THESIS_INDICATOR_WORDS'] if thesis_word.endswith("*")]
+        self.thesis_words_pattern = re.compile(r"\b(?:%s)\b" % "|".join(re.escape(thesis_word) for thesis_word in thesis_words)) \
+            if thesis_words else None
+
+        self.cook_reference_pub = memoized('journalfield.cooked_pub', PUB_STRINGS_CACHE_SIZE)(self.compute_cooked_reference_pub)
+        self.cook_title_string = memoized('journalfield.cooked_title', PUB_STRINGS_CACHE_SIZE)(self.compute_cooked_title_string)
+        self.has_thesis_indicators = memoized('journalfield.thesis_indicators', PUB_STRINGS_CACHE_SIZE)(self.compute_has_thesis_indicators)
+
+    def compute_cooked_reference_pub(self, pub_string):
+        """
+        see cook_reference_pub
+
+        :param pub_string:
+        :return:
+        """
+        elements = self.stop_words_pattern.sub(" ", pub_string).split()
+        # we need embedded ampersands as "and" so we accept A&A as  word
+        return " ".join(self.expansion_mapping.get(e, e) for e in elements).replace("&", "and")
+
+    def compute_cooked_title_string(self, title):
+        """
+        see cook_title_string
+
+        :param title:
+        :return:
+        """
+        return " ".join(p for p in NON_WORD_PATTERN.sub(" ", title).split() if p not in self.stop_words and len(p) > 5)
+
+    def compute_has_thesis_indicators(self, pub_string):
+        """
+        see has_thesis_indicators
+
+        :param pub_string:
+        :return:
+        """
+        stuff_to_match = unidecode.unidecode(pub_string).lower()
+        if any(thesis_prefix in stuff_to_match for thesis_prefix in self.thesis_prefixes):
+            return True
+        return self.thesis_words_pattern is not None and self.thesis_words_pattern.search(stuff_to_match) is not None
@@ -8,13 +8,68 @@ generator.  The docstrings should say what kind of details they need.
 """
 
 import regex as re
-
-from flask import current_app
+import numpy as np
 
 from referencesrv.resolver.authors import add_author_evidence, normalize_author_list
 from referencesrv.resolver.common import Evidences, Hypothesis
+from referencesrv.resolver.features import get_record_features
 from referencesrv.resolver.journalfield import add_year_evidence, add_page_evidence, \
-    add_publication_evidence, add_volume_evidence, has_thesis_indicators, add_title_evidence
+    add_publication_evidence, add_volume_evidence, has_thesis_indicators, add_title_evidence, YEAR_PATTERN
+
+
+def add_memoized_evidence(evidences, hypothesis, key, result_record, add_function, *args):
+    """
+    adds the evidence add_function adds, taking it from the evidence memo of the resolution,
+    if the hypothesis carries one, and the component has already been computed for the record
+
+    :param evidences:
+    :param hypothesis:
+    :param key: name of the component and the input values it is computed from
+    :param result_record:
+    :param add_function: one of the add_*_evidence functions
+    :param args: the arguments to add_function after evidences
+    :return:
+    """
+    evidence_memo = hypothesis.get_detail('evidence_memo')
+    bibcode = result_record.get('bibcode', None)
+    if evidence_memo is None or bibcode is None:
+        add_function(evidences, *args)
+        return
+    key = key + (bibcode,)
+    component = evidence_memo.get(key)
+    if component is None:
+        component = Evidences(evidences.context)
+        add_function(component, *args)
+        evidence_memo.put(key, component)
+    evidences + component
+
+
+def get_ads_title_tokens(evidences, result_record):
+    """
+    returns the token set of the title of result_record, if the scoring context compares token sets, None otherwise
+
+    :param evidences:
+    :param result_record:
+    :return:
+    """
+    if evidences.context.token_similarity:
+        return get_record_features(result_record, evidences.context).get_title_tokens()
+    return None
+
+
+def get_ads_pub_tokens(evidences, result_record, field):
+    """
+    returns the token set of the publication string of field of result_record, if the scoring context
+    compares token sets, None otherwise
+
+    :param evidences:
+    :param result_record:
+    :param field: one of pub, pub_raw, and title
+    :return:
+    """
+    if evidences.context.token_similarity:
+        return get_record_features(result_record, evidences.context).get_pub_tokens(field)
+    return None
 
 def get_author_year_score_for_input_fields(result_record, hypothesis):
     """
@@ -30,13 +85,16 @@ def get_author_year_score_for_input_fields(result_record, hypothesis):
     if normalized_authors is None:
         normalized_authors = normalize_author_list(input_fields.get('author', ''))
 
-    evidences = Evidences()
+    evidences = Evidences(hypothesis.get_scoring_context())
 
-    add_author_evidence(evidences,
+    add_memoized_evidence(evidences, hypothesis,
+        ('authors', normalized_authors, hypothesis.get_detail('has_etal')), result_record,
+        add_author_evidence,
         normalized_authors,
         result_record.get('author_norm'),
         result_record.get('first_author_norm'),
-        has_etal=hypothesis.get_detail('has_etal'))
+        hypothesis.get_detail('has_etal'),
+        get_record_features(result_record, evidences.context).author_last_names)
 
     add_year_evidence(evidences,
         input_fields.get('year'),
@@ -57,13 +115,17 @@ def get_author_year_pub_score_for_input_fields(result_record, hypothesis):
 
     input_fields = hypothesis.get_detail("input_fields")
 
-    add_publication_evidence(evidences,
+    add_memoized_evidence(evidences, hypothesis,
+        ('pub', input_fields.get("pub", ""), input_fields.get("bibstem",""), input_fields.get("refstr", "")), result_record,
+        add_publication_evidence,
         input_fields.get("pub", ""),
         input_fields.get("bibstem",""),
         input_fields.get("refstr", ""),
         result_record.get("pub", ""),
         result_record.get("bibcode", ""),
-        result_record.get("bibstem", ""))
+        result_record.get("bibstem", ""),
+        get_record_features(result_record, evidences.context).pubs['pub'],
+        get_ads_pub_tokens(evidences, result_record, 'pub'))
 
     return evidences
 
@@ -116,7 +178,7 @@ def get_volume_page_score_for_input_fields(result_record, hypothesis):
     """
     input_fields = hypothesis.get_detail('input_fields')
 
-    evidences = Evidences()
+    evidences = Evidences(hypothesis.get_scoring_context())
 
     exist = bool('volume' in input_fields) + bool('page' in input_fields)
 
@@ -203,9 +265,13 @@ def get_basic_score_for_input_fields(result_record, hypothesis):
         result_record.get('eid', None),
         hypothesis.get_detail('page_qualifier'))
 
-    add_title_evidence(evidences,
+    add_memoized_evidence(evidences, hypothesis,
+        ('title', input_fields.get('title')), result_record,
+        add_title_evidence,
         input_fields.get('title'),
-        result_record.get('title', ''))
+        result_record.get('title', ''),
+        get_record_features(result_record, evidences.context).title,
+        get_ads_title_tokens(evidences, result_record))
 
     return evidences
 
@@ -224,9 +290,13 @@ def get_serial_score_for_input_fields(result_record, hypothesis):
 
     input_fields = hypothesis.get_detail("input_fields")
 
-    add_title_evidence(evidences,
+    add_memoized_evidence(evidences, hypothesis,
+        ('title', input_fields.get('title')), result_record,
+        add_title_evidence,
         input_fields.get('title'),
-        result_record.get('title', ''))
+        result_record.get('title', ''),
+        get_record_features(result_record, evidences.context).title,
+        get_ads_title_tokens(evidences, result_record))
 
     return evidences
 
@@ -247,12 +317,15 @@ def get_book_score_for_input_fields(result_record, hypothesis):
 
     # if ads record is a book and reference record has no volume and page resolve it as if it is a book
     if result_record["doctype"] in ["book", "inbook", "techreport", "proceedings"]:
-        evidences.add_evidence(current_app.config["EVIDENCE_SCORE_RANGE"][1], "doctype")
+        evidences.add_evidence(evidences.max_score, "doctype")
         if all([input_fields.get(key, None) == None for key in ['volume', 'page']]):
-            add_title_evidence(evidences, input_fields.get("title", ""), result_record.get("title", ""))
+            add_memoized_evidence(evidences, hypothesis, ('title', input_fields.get("title", "")), result_record,
+                                  add_title_evidence, input_fields.get("title", ""), result_record.get("title", ""),
+                                  get_record_features(result_record, evidences.context).title,
+                                  get_ads_title_tokens(evidences, result_record))
             return evidences
     else:
-        evidences.add_evidence(current_app.config["EVIDENCE_SCORE_RANGE"][0], "doctype")
+        evidences.add_evidence(evidences.min_score, "doctype")
 
     # book does not have volume and page number
     # but if reference has score it so that we would not have false positive
@@ -269,13 +342,18 @@ def get_book_score_for_input_fields(result_record, hypothesis):
                       hypothesis.get_detail('page_qualifier'),
                       input_fields.get('refstr', ''))
 
-    add_publication_evidence(evidences,
-        hypothesis.get_hint("title") or input_fields.get("pub", ""),
+    ref_pub = hypothesis.get_hint("title") or input_fields.get("pub", "")
+    add_memoized_evidence(evidences, hypothesis,
+        ('pub-title', ref_pub, input_fields.get("bibstem", ""), input_fields.get("refstr", "")), result_record,
+        add_publication_evidence,
+        ref_pub,
         input_fields.get("bibstem", ""),
         input_fields.get("refstr", ""),
         result_record.get("title", ""),
         result_record.get("bibcode", ""),
-        result_record.get("bibstem", ""))
+        result_record.get("bibstem", ""),
+        get_record_features(result_record, evidences.context).pubs['title'],
+        get_ads_pub_tokens(evidences, result_record, 'title'))
 
     return evidences
 
@@ -314,13 +392,13 @@ def get_thesis_score_for_input_fields(result_record, hypothesis):
     :param hypothesis:
     :return:
     """
-    evidences = Evidences()
+    evidences = Evidences(hypothesis.get_scoring_context())
 
     # consider only thesis records
     if result_record["doctype"] in ["phdthesis", "mastersthesis"]:
-        evidences.add_evidence(current_app.config["EVIDENCE_SCORE_RANGE"][1], "doctype")
+        evidences.add_evidence(evidences.max_score, "doctype")
     else:
-        evidences.add_evidence(current_app.config["EVIDENCE_SCORE_RANGE"][0], "doctype")
+        evidences.add_evidence(evidences.min_score, "doctype")
 
     input_fields = hypothesis.get_detail("input_fields")
 
@@ -330,10 +408,10 @@ def get_thesis_score_for_input_fields(result_record, hypothesis):
         ref_lastname, ref_first_init = re.sub(r"[\s.]", "", hypothesis.get_detail("normalized_authors")).lower().split(",")
         ads_lastname, ads_first_init = re.sub(r"[\s.]", "", result_record["author_norm"][0].lower()).split(",")
         # lastname match is worth 0.7, first inital 0.3
-        author_score = int(ref_lastname==ads_lastname) * current_app.config["EVIDENCE_SCORE_RANGE"][1] * 0.7 + \
-                       int(ref_first_init==ads_first_init) * current_app.config["EVIDENCE_SCORE_RANGE"][1] * 0.3
+        author_score = int(ref_lastname==ads_lastname) * evidences.max_score * 0.7 + \
+                       int(ref_first_init==ads_first_init) * evidences.max_score * 0.3
     else:
-        author_score = current_app.config["EVIDENCE_SCORE_RANGE"][0]
+        author_score = evidences.min_score
     evidences.add_evidence(author_score, "author")
 
     add_year_evidence(evidences,
@@ -371,16 +449,21 @@ def get_chapter_score_for_input_fields(result_record, hypothesis):
                 input_fields.get("title", ""), input_fields.get("title", "")]
     ads_pubs = [result_record.get("title", ""), result_record.get("pub_raw", ""),
                 result_record.get("title", ""), result_record.get("pub_raw", "")]
-    track_evidence = Evidences()
-    for ref_pub, ads_pub in zip(ref_pubs, ads_pubs):
-        tmp_evidence = Evidences()
-        add_publication_evidence(tmp_evidence,
+    ads_pub_fields = ["title", "pub_raw", "title", "pub_raw"]
+    track_evidence = Evidences(evidences.context)
+    for ref_pub, ads_pub, ads_pub_field in zip(ref_pubs, ads_pubs, ads_pub_fields):
+        tmp_evidence = Evidences(evidences.context)
+        add_memoized_evidence(tmp_evidence, hypothesis,
+                                 ('pub-%s' % ads_pub_field, ref_pub, input_fields.get("bibstem", ""), input_fields.get("refstr", "")), result_record,
+                                 add_publication_evidence,
                                  ref_pub,
                                  input_fields.get("bibstem", ""),
                                  input_fields.get("refstr", ""),
                                  ads_pub,
                                  result_record.get("bibcode", ""),
-                                 result_record.get("bibstem", ""))
+                                 result_record.get("bibstem", ""),
+                                 get_record_features(result_record, evidences.context).pubs[ads_pub_field],
+                                 get_ads_pub_tokens(evidences, result_record, ads_pub_field))
         if tmp_evidence > track_evidence:
             track_evidence = tmp_evidence
     # add in a neutral pubstring evidence, it is needed not to have false positive
@@ -417,20 +500,20 @@ def get_score_for_reference_identifier(result_record, hypothesis):
     :param result_record:
     :return:
     """
-    evidences = Evidences()
+    evidences = Evidences(hypothesis.get_scoring_context())
 
     input_fields = hypothesis.get_detail("input_fields")
 
     if compare_doi(input_fields.get("doi", None), result_record.get("doi", [])):
-        evidences.add_evidence(current_app.config["EVIDENCE_SCORE_RANGE"][1], "bibcode")
+        evidences.add_evidence(evidences.max_score, "bibcode")
     elif input_fields.get("arxiv", "not in ref") == get_arxiv_id_or_ascl_id(result_record):
-        evidences.add_evidence(current_app.config["EVIDENCE_SCORE_RANGE"][1], "bibcode")
+        evidences.add_evidence(evidences.max_score, "bibcode")
     elif input_fields.get("ascl", "not in ref") == get_arxiv_id_or_ascl_id(result_record):
-        evidences.add_evidence(current_app.config["EVIDENCE_SCORE_RANGE"][1], "bibcode")
+        evidences.add_evidence(evidences.max_score, "bibcode")
     elif compare_bibcode(input_fields.get("bibcode", None), result_record.get("bibcode", None), result_record.get("identifier", None)):
-        evidences.add_evidence(current_app.config["EVIDENCE_SCORE_RANGE"][1], "bibcode")
+        evidences.add_evidence(evidences.max_score, "bibcode")
     else:
-        evidences.add_evidence(current_app.config["EVIDENCE_SCORE_RANGE"][0], "bibcode")
+        evidences.add_evidence(evidences.min_score, "bibcode")
 
     return evidences
 
@@ -497,11 +580,19 @@ def adjust_volume_when_identical_year(result_record, hypothesis):
     this is to cover when volume and year are identical, but volume was not specified in the reference string
     hence reverse engineer, using information from ads (result_record)
 
+    the table of volume ranges, if loaded and in the details of the hypothesis, tells the journals
+    numbering their volumes by year even when the record has no volume
+
     :param result_record:
     :param hypothesis:
     :return:
     """
-    if result_record["year"] == result_record["volume"]:
+    identical = result_record["year"] == result_record.get("volume")
+    volume_ranges = hypothesis.get_detail('volume_ranges')
+    if not identical and volume_ranges is not None and result_record["year"].isdigit():
+        year = int(result_record["year"])
+        identical = volume_ranges.get_volume_range(result_record["bibcode"][4:9].rstrip('.'), result_record["year"]) == (year, year)
+    if identical:
         input_fields = hypothesis.get_detail("input_fields")
         if 'volume' in input_fields and 'page' not in input_fields:
             new_input_fields = input_fields.copy()
@@ -512,6 +603,194 @@ def adjust_volume_when_identical_year(result_record, hypothesis):
             new_hypothesis = Hypothesis('volume-year-identical',
                                         new_input_fields,
                                         get_serial_score_for_input_fields,
-                                        input_fields=input_fields)
+                                        input_fields=input_fields,
+                                        evidence_memo=hypothesis.get_detail('evidence_memo'),
+                                        scoring_context=hypothesis.get_detail('scoring_context'))
             return new_hypothesis
     return hypothesis
+
+
+# the maximum number of evidences each score function adds, each evidence being at most EVIDENCE_SCORE_RANGE[1]
+MAX_NUM_EVIDENCES = {
+    get_author_year_score_for_input_fields: 2,
+    get_author_year_pub_score_for_input_fields: 3,
+    get_serial_score_for_input_fields: 6,
+    get_book_score_for_input_fields: 6,
+    get_catalog_score_for_input_fields: 5,
+    get_thesis_score_for_input_fields: 4,
+    get_chapter_score_for_input_fields: 5,
+    get_score_for_reference_identifier: 1,
+}
+
+# score functions that include the year evidence, and that include volume and page evidences
+# compared as tagged when both are in the reference
+YEAR_SCORED = set(MAX_NUM_EVIDENCES) - {get_score_for_reference_identifier}
+VOLUME_PAGE_SCORED = {get_serial_score_for_input_fields, get_chapter_score_for_input_fields}
+
+
+def get_score_function_for_doctype(result_record, score_function):
+    """
+    returns the score function get_score_for_input_fields dispatches to, for the doctype of result_record
+
+    :param result_record:
+    :param score_function:
+    :return:
+    """
+    if score_function != get_score_for_input_fields:
+        return score_function
+    doctype = result_record.get("doctype", "")
+    if doctype in ["inbook", "inproceedings"]:
+        return get_chapter_score_for_input_fields
+    if doctype in ["book", "proceedings"]:
+        return get_book_score_for_input_fields
+    if doctype == "catalog":
+        return get_catalog_score_for_input_fields
+    return get_serial_score_for_input_fields
+
+
+def get_score_upper_bound(result_record, hypothesis):
+    """
+    returns an upper bound of the score hypothesis would give result_record, None if there is none
+
+    Only the cheap evidences are computed, year, and volume and page if both are in the reference,
+    and all the others (authors, title, publication) are counted at the maximum score,
+    so that candidates that cannot beat the best one so far need not be scored.
+
+    :param result_record:
+    :param hypothesis:
+    :return:
+    """
+    score_function = get_score_function_for_doctype(result_record, hypothesis.get_score_function)
+    max_num_evidences = MAX_NUM_EVIDENCES.get(score_function, None)
+    input_fields = hypothesis.get_detail("input_fields")
+    if max_num_evidences is None or input_fields is None:
+        return None
+
+    evidences = Evidences(hypothesis.get_scoring_context())
+    if score_function in YEAR_SCORED:
+        add_year_evidence(evidences,
+            input_fields.get('year'),
+            result_record.get('year'))
+    if score_function in VOLUME_PAGE_SCORED and input_fields.get('volume') and input_fields.get('page'):
+        add_volume_evidence(evidences,
+                            input_fields['volume'],
+                            result_record.get('volume', ''),
+                            result_record.get('issue'),
+                            result_record.get('pub_raw'))
+        add_page_evidence(evidences,
+                          input_fields['page'],
+                          result_record.get('page', ''),
+                          result_record.get('page_range', ''),
+                          result_record.get('eid', None),
+                          hypothesis.get_detail('page_qualifier'),
+                          input_fields.get('refstr', ''))
+    return evidences.sum() + (max_num_evidences - len(evidences)) * evidences.max_score
+
+
+class CandidateBatch(object):
+    """
+    the numeric fields of the candidates of a query as columns, to compare them with the reference all at once
+    """
+
+    def __init__(self, solutions, context):
+        """
+
+        :param solutions: the massaged records
+        :param context: ScoringContext
+        """
+        self.size = len(solutions)
+        features = [get_record_features(solution, context) for solution in solutions]
+        self.year = np.array([feature.year for feature in features], dtype=np.int64)
+        self.volume = np.array([feature.volume for feature in features], dtype=np.int64)
+        self.page = np.array([feature.page for feature in features], dtype=np.int64)
+        # the records compared the plain way, without an eid, or a year for volume with an issue
+        self.plain = np.array([not solution.get('eid') and
+                               not (solution.get('issue') and YEAR_PATTERN.findall(solution.get('volume') or ''))
+                               for solution in solutions], dtype=bool)
+
+
+def get_year_similarities(ref_year, years):
+    """
+    returns number_similarity of the reference year, of four digits, and each of the years
+
+    :param ref_year:
+    :param years: array of years, -1 where not known
+    :return:
+    """
+    count = sum(((years // 10**(3 - i)) % 10 == int(digit)).astype(np.int64) for i, digit in enumerate(ref_year))
+    return count / float(len(ref_year))
+
+
+def get_closenesses(ref_number, numbers):
+    """
+    returns compute_closeness_two_numbers of the reference number and each of the numbers,
+    for the ones that it is 0 for, and nan for the ones that need their digits compared,
+    ie, differing only in one digit, or within 3% of each other
+
+    :param ref_number:
+    :param numbers: array of numbers, -1 where not known
+    :return:
+    """
+    diff = np.abs(ref_number - numbers)
+    closeness = 0.03 - diff / np.where(numbers != 0, numbers, 1).astype(float)
+    return np.where(numbers == 0, 0.0, np.where((diff % 10 != 0) & (closeness <= 0), 0.0, np.nan))
+
+
+def get_score_upper_bounds(solutions, hypothesis):
+    """
+    returns get_score_upper_bound of each of the solutions
+
+    The year, volume, and page evidences of all the candidates are computed in one pass over their columns,
+    and the candidates these comparisons do not cover, ie, with a page with a letter, or a volume close to
+    the one of the reference, are bounded one at a time.
+
+    :param solutions:
+    :param hypothesis:
+    :return:
+    """
+    input_fields = hypothesis.get_detail("input_fields")
+    if input_fields is None or not solutions:
+        return [None] * len(solutions)
+
+    context = hypothesis.get_scoring_context()
+    max_score = context.max_score
+    score_functions = [get_score_function_for_doctype(solution, hypothesis.get_score_function) for solution in solutions]
+    batch = CandidateBatch(solutions, context)
+    sums = np.zeros(batch.size)
+    counts = np.zeros(batch.size, dtype=np.int64)
+    vectorized = np.ones(batch.size, dtype=bool)
+
+    year_scored = np.array([score_function in YEAR_SCORED for score_function in score_functions], dtype=bool)
+    ref_year = input_fields.get('year')
+    if isinstance(ref_year, str) and ref_year.isdigit() and len(ref_year) == 4:
+        vectorized &= ~year_scored | (batch.year >= 0)
+        sums += np.where(year_scored, get_year_similarities(ref_year, batch.year), 0)
+        counts += year_scored
+    else:
+        vectorized &= ~year_scored
+
+    ref_volume, ref_page = input_fields.get('volume'), input_fields.get('page')
+    if ref_volume and ref_page:
+        volume_page_scored = np.array([score_function in VOLUME_PAGE_SCORED for score_function in score_functions], dtype=bool)
+        if ref_volume.isdigit() and ref_page.isdigit() and not hypothesis.get_detail('page_qualifier'):
+            volume_evidences = np.where(batch.volume == int(ref_volume), max_score, get_closenesses(int(ref_volume), batch.volume) * max_score)
+            page_evidences = np.where(batch.page == int(ref_page), max_score, get_closenesses(int(ref_page), batch.page))
+            covered = batch.plain & (batch.volume >= 0) & (batch.page >= 0) & \
+                      ~np.isnan(volume_evidences) & ~np.isnan(page_evidences)
+            vectorized &= ~volume_page_scored | covered
+            sums += np.where(volume_page_scored & covered, volume_evidences, 0)
+            sums += np.where(volume_page_scored & covered, page_evidences, 0)
+            counts += 2 * volume_page_scored
+        else:
+            vectorized &= ~volume_page_scored
+
+    bounds = []
+    for index, score_function in enumerate(score_functions):
+        max_num_evidences = MAX_NUM_EVIDENCES.get(score_function, None)
+        if max_num_evidences is None:
+            bounds.append(None)
+        elif vectorized[index]:
+            bounds.append(float(sums[index] + (max_num_evidences - counts[index]) * max_score))
+        else:
+            bounds.append(get_score_upper_bound(solutions[index], hypothesis))
+    return bounds
@@ -0,0 +1,135 @@
+"""
+Similarity of titles and publication strings on their sets of words, rather than on the strings themselves,
+so that comparing a reference with a candidate is a few set lookups, and does not scan the candidate string
+once for each word of the reference.
+
+The token sets of the documents are computed once, with their features, the ones of the titles of the references
+are memoized.
+"""
+
+import bisect
+
+import regex as re
+
+from referencesrv.resolver.memoize import memoized
+
+
+TOKEN_PATTERN = re.compile(r"\w+")
+# the alphabetic and numeric runs of the tokens, so that a bibstem or a volume can be found in a bibcode
+TOKEN_PARTS_PATTERN = re.compile(r"[^\W\d_]+|\d+")
+
+# the number of titles of the references kept tokenized
+TOKEN_SETS_CACHE_SIZE = 4096
+
+
+class TokenSet(object):
+    """
+    the words of a string, in order, as a set, and sorted, to look up the words starting with a prefix
+    """
+    __slots__ = ('tokens', 'set', 'sorted')
+
+    def __init__(self, tokens):
+        """
+
+        :param tokens: the words, in order
+        """
+        self.tokens = tuple(tokens)
+        self.set = frozenset(self.tokens)
+        self.sorted = sorted(self.set)
+
+    def __len__(self):
+        """
+
+        :return:
+        """
+        return len(self.tokens)
+
+    def has_prefix(self, prefix):
+        """
+        returns True if any of the words starts with prefix, ie, it is the word, or an abbreviation of it
+
+        :param prefix:
+        :return:
+        """
+        index = bisect.bisect_left(self.sorted, prefix)
+        return index < len(self.sorted) and self.sorted[index].startswith(prefix)
+
+
+def tokenize_title(title):
+    """
+    returns the TokenSet of the words of title, lower cased
+
+    :param title:
+    :return:
+    """
+    return TokenSet(TOKEN_PATTERN.findall(title.lower()))
+
+
+def tokenize_pub(cooked_pub):
+    """
+    returns the TokenSet of the words of a cooked publication string, along with their alphabetic and numeric
+    runs, that take apart the bibcode cooked with the publication string
+
+    :param cooked_pub:
+    :return:
+    """
+    cooked_pub = cooked_pub.lower()
+    words = TOKEN_PATTERN.findall(cooked_pub)
+    word_set = set(words)
+    parts = [part for part in TOKEN_PARTS_PATTERN.findall(cooked_pub) if part not in word_set]
+    return TokenSet(words + parts)
+
+
+# the titles of the references come back with each hypothesis and each candidate
+get_title_tokens = memoized('similarity.title_tokens', TOKEN_SETS_CACHE_SIZE)(tokenize_title)
+
+
+def count_missing_prefixes(tokens_a, tokens_b):
+    """
+    returns the number of the words of tokens_a, counted as often as they appear, that no word of tokens_b starts with
+
+    :param tokens_a: TokenSet
+    :param tokens_b: TokenSet
+    :return:
+    """
+    return sum(1 for token in tokens_a.tokens if token not in tokens_b.set and not tokens_b.has_prefix(token))
+
+
+def get_common_prefix_length(tokens_a, tokens_b):
+    """
+    returns the number of leading words tokens_a and tokens_b have in common
+
+    :param tokens_a: TokenSet
+    :param tokens_b: TokenSet
+    :return:
+    """
+    length = 0
+    for token_a, token_b in zip(tokens_a.tokens, tokens_b.tokens):
+        if token_a != token_b:
+            break
+        length += 1
+    return length
+
+
+def get_title_similarity(ref_tokens, ads_tokens, min_score):
+    """
+    the word set counterpart of journalfield.string_similarity, on the same scale:
+
+    if the titles start with the same words, ie, one of them has a subtitle the other does not have,
+    the fraction of the ADS words that are leading, otherwise 1 less twice the fraction of the ADS words
+    the reference does not have, where a word is accounted for if a word of the reference starts with it
+
+    :param ref_tokens: TokenSet of the title of the reference
+    :param ads_tokens: TokenSet of the title of the ADS record
+    :param min_score: the score of an empty title
+    :return:
+    """
+    if not ads_tokens.tokens or not ref_tokens.tokens:
+        return min_score
+
+    leading = get_common_prefix_length(ref_tokens, ads_tokens)
+    if leading:
+        return leading / float(len(ads_tokens))
+
+    missing = count_missing_prefixes(ads_tokens, ref_tokens)
+    return (len(ads_tokens) - 2 * missing) / float(len(ads_tokens))
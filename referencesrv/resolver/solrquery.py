@@ -2,12 +2,162 @@ import unidecode
 import json
 import requests
 import time
+import random
+import threading
+import urllib.parse
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 from flask import current_app, request
 from referencesrv.client import client
+from referencesrv.metrics import METRICS
 
 from referencesrv.resolver.common import Solr
-from referencesrv.resolver.solrtestdata import get_test_data
+from referencesrv.resolver.backends import RemoteSolr, StaticBackend
+from referencesrv.resolver.documentcache import get_document_cache
+from referencesrv.resolver.features import get_document_features, FEATURES_KEY
+
+# status codes that mean solr (or what is in front of it) is overloaded or down, and are worth retrying
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class LatencyWindow(object):
+    """
+    the most recent latencies of successful solr requests, to decide when to send a hedged request
+    """
+    def __init__(self, size):
+        """
+
+        :param size: number of latencies to keep
+        """
+        self.latencies = deque(maxlen=size)
+        self.lock = threading.Lock()
+
+    def add(self, latency):
+        """
+
+        :param latency: in seconds
+        :return:
+        """
+        with self.lock:
+            self.latencies.append(latency)
+
+    def get_percentile(self, percentile, min_samples):
+        """
+        returns the latency at the percentile, None if there are not enough samples yet
+
+        :param percentile:
+        :param min_samples:
+        :return:
+        """
+        with self.lock:
+            if len(self.latencies) < max(min_samples, 1):
+                return None
+            latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * percentile / 100.0))]
+
+
+class CircuitBreaker(object):
+    """
+    fails fast once solr has failed repeatedly, so that workers are not tied up waiting on a dead backend
+
+    closed: requests go through, consecutive failures are counted
+    open: requests are rejected until the cooldown has passed
+    half_open: one trial request goes through, success closes the breaker, failure opens it again,
+        a trial request not heard of within the cooldown counts as failed, and another one goes through
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, threshold, cooldown):
+        """
+
+        :param threshold: number of consecutive failures that open the breaker
+        :param cooldown: number of seconds the breaker stays open
+        """
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.trial_at = 0
+        METRICS.set('solr.breaker.state', self.state)
+
+    def transition(self, state):
+        """
+        must be called with the lock held
+
+        :param state:
+        :return:
+        """
+        self.state = state
+        METRICS.incr('solr.breaker.%s' % state)
+        METRICS.set('solr.breaker.state', state)
+
+    def allow(self):
+        """
+        returns True if a request can be sent now
+
+        :return:
+        """
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            now = time.time()
+            if self.state == self.OPEN and now - self.opened_at >= self.cooldown:
+                self.transition(self.HALF_OPEN)
+                self.trial_at = now
+                return True
+            if self.state == self.HALF_OPEN and now - self.trial_at >= self.cooldown:
+                METRICS.incr('solr.breaker.trial_lost')
+                self.trial_at = now
+                return True
+            # either open, or half open with the trial request still out
+            return False
+
+    def record_success(self):
+        """
+
+        :return:
+        """
+        with self.lock:
+            self.failures = 0
+            if self.state != self.CLOSED:
+                self.transition(self.CLOSED)
+
+    def record_failure(self):
+        """
+
+        :return:
+        """
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.threshold):
+                self.opened_at = time.time()
+                self.transition(self.OPEN)
+
+
+def get_resilience():
+    """
+    returns the process wide latency window, circuit breaker, and the executor used for hedged requests,
+    creating them on first use
+
+    :return:
+    """
+    resilience = current_app.extensions.get('solr_resilience', None)
+    if resilience is None:
+        resilience = {
+            'latency_window': LatencyWindow(current_app.config['REFERENCE_SERVICE_SOLR_LATENCY_WINDOW']),
+            'circuit_breaker': CircuitBreaker(current_app.config['REFERENCE_SERVICE_SOLR_BREAKER_THRESHOLD'],
+                                              current_app.config['REFERENCE_SERVICE_SOLR_BREAKER_COOLDOWN']),
+            'executor': ThreadPoolExecutor(max_workers=current_app.config['REFERENCE_SERVICE_SOLR_HEDGE_WORKERS']),
+        }
+        current_app.extensions['solr_resilience'] = resilience
+    return resilience
+
 
 class Querier(object):
     def __init__(self):
@@ -23,61 +173,278 @@ class Querier(object):
         Authorization = current_app.config.get('SERVICE_TOKEN', None) or \
                         request.headers.get('X-Forwarded-Authorization', request.headers.get('Authorization', ''))
         self.Authorization = Authorization if 'Bearer' in Authorization else 'Bearer %s'%Authorization
+        self.timeout = current_app.config['REFERENCE_SERVICE_SOLR_TIMEOUT']
+        self.post_length = current_app.config['REFERENCE_SERVICE_SOLR_POST_LENGTH']
+        self.hedge_percentile = current_app.config['REFERENCE_SERVICE_SOLR_HEDGE_PERCENTILE']
+        self.hedge_min_samples = current_app.config['REFERENCE_SERVICE_SOLR_HEDGE_MIN_SAMPLES']
+        self.retries = current_app.config['REFERENCE_SERVICE_SOLR_RETRIES']
+        self.retry_backoff = current_app.config['REFERENCE_SERVICE_SOLR_RETRY_BACKOFF']
+        self.retry_backoff_max = current_app.config['REFERENCE_SERVICE_SOLR_RETRY_BACKOFF_MAX']
+        self.two_phase = current_app.config['REFERENCE_SERVICE_SOLR_TWO_PHASE']
+        # numFound of the last query, for the trace of the explain endpoint
+        self.num_found = None
+        # the lookup of the records of the last query in two-phase mode, for the trace of the explain endpoint
+        self.hydration = None
+        # the number of requests the last query took, the lookup of two-phase mode being one more
+        self.num_requests = 0
+        # the backends are built on first use
+        self.remote_solr = None
+        self.static_backend = None
+
+    @property
+    def backend(self):
+        """
+        returns the search backend to send the queries to, the local index if it has been configured
+        and loaded, otherwise solr if live, otherwise the canned test records
+
+        :return:
+        """
+        if current_app.config['REFERENCE_SERVICE_SEARCH_BACKEND'] == 'local':
+            local_index = current_app.extensions.get('local_index', None)
+            if local_index is not None:
+                return local_index
+            current_app.logger.error('local index is not loaded, querying %s instead.' % ('solr' if self.connect_solr else 'test data'))
+        if self.connect_solr:
+            if self.remote_solr is None:
+                self.remote_solr = RemoteSolr(self)
+            return self.remote_solr
+        if self.static_backend is None:
+            self.static_backend = StaticBackend()
+        return self.static_backend
 
-    def make_params(self, query):
+    def make_params(self, query, filters=None):
         """
         returns a dictionary of params suitable for the ADS API.
 
         :param query:
+        :param filters: list of filter queries, cached by solr independent of the query
         :return:
         """
-        return {
+        params = {
             'fl': self.query_fields,
             'rows': str(self.max_rows),
             'q': query,
         }
+        if filters:
+            params['fq'] = filters
+        return params
 
 
-    def query(self, query):
+    def get(self, session, params):
         """
-        executes query, and returns the result.
+        sends one request to solr, and returns the response and how long it took
 
-        If query yields exactly max_rows fields, we have an overflow.
+        long parameters are sent in the body of a POST request, to stay clear of url length limits
 
-        :param query:
+        this can run in a worker thread, so it must not touch current_app
+
+        :param session:
+        :param params:
         :return:
         """
-        current_app.logger.debug('Query is %s' % (query))
-        solutions = []
-
-        if self.connect_solr:
-            start_time = time.time()
-            response = client().get(
+        start_time = time.time()
+        if self.post_length and len(urllib.parse.urlencode(params, doseq=True)) > self.post_length:
+            METRICS.incr('solr.post')
+            response = session.post(
                 url=self.endpoint,
                 headers={'Authorization': self.Authorization},
-                params=self.make_params(query),
-                timeout=10
+                data=params,
+                timeout=self.timeout
             )
-            current_app.logger.debug("Query executed in %s ms" % ((time.time() - start_time)*1000))
+            return response, time.time() - start_time
+        response = session.get(
+            url=self.endpoint,
+            headers={'Authorization': self.Authorization},
+            params=params,
+            timeout=self.timeout
+        )
+        return response, time.time() - start_time
+
+    def get_hedged(self, session, params, latency_window, circuit_breaker):
+        """
+        sends a request to solr, and if it has not returned after the configured percentile of
+        recent latencies, sends a second one and returns whichever comes back first
+
+        the slower request is not cancelled, its response is discarded
+
+        :param session:
+        :param params:
+        :param latency_window:
+        :param circuit_breaker:
+        :return:
+        """
+        delay = None
+        if self.hedge_percentile and circuit_breaker.state == CircuitBreaker.CLOSED:
+            delay = latency_window.get_percentile(self.hedge_percentile, self.hedge_min_samples)
+        if delay is None:
+            return self.get(session, params)
+
+        executor = get_resilience()['executor']
+        futures = [executor.submit(self.get, session, params)]
+        done, _ = wait(futures, timeout=delay)
+        if not done:
+            METRICS.incr('solr.hedge.sent')
+            futures.append(executor.submit(self.get, session, params))
+
+        pending = futures
+        while True:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is not futures[0]:
+                        METRICS.incr('solr.hedge.won')
+                    return future.result()
+            if not pending:
+                # both failed, report the first one
+                return futures[0].result()
+
+    def send(self, params):
+        """
+        sends the request to solr, retrying with jitter on connection errors, timeouts, and overload,
+        and going through the circuit breaker
+
+        :param params:
+        :return: the response
+        """
+        resilience = get_resilience()
+        latency_window, circuit_breaker = resilience['latency_window'], resilience['circuit_breaker']
+        # get the session here, the hedged requests are sent from worker threads without the app context
+        session = client()
+
+        for attempt in range(self.retries + 1):
+            if not circuit_breaker.allow():
+                METRICS.incr('solr.breaker.rejected')
+                raise Solr("circuit breaker is open")
+            METRICS.incr('solr.requests')
+            try:
+                response, duration = self.get_hedged(session, params, latency_window, circuit_breaker)
+                current_app.logger.debug("Query executed in %s ms" % (duration * 1000))
+                if response.status_code not in RETRY_STATUS_CODES:
+                    # solr is up, even if it did not like the query
+                    circuit_breaker.record_success()
+                    if response.status_code == 200:
+                        latency_window.add(duration)
+                    return response
+                error = "status_code %s" % response.status_code
+            except requests.exceptions.RequestException as e:
+                response = None
+                error = str(e)
+            except Exception:
+                # not retried, but the breaker has to hear of it, or it is left half open
+                METRICS.incr('solr.errors')
+                circuit_breaker.record_failure()
+                raise
+            METRICS.incr('solr.errors')
+            circuit_breaker.record_failure()
+            current_app.logger.error('Solr request failed on attempt {attempt}: {error}.'.format(attempt=attempt + 1, error=error))
+            if attempt < self.retries:
+                METRICS.incr('solr.retries')
+                # full jitter exponential backoff
+                time.sleep(random.uniform(0, min(self.retry_backoff_max, self.retry_backoff * 2 ** attempt)))
+
+        if response is not None:
+            return response
+        raise Solr(error)
 
-            # all non-200 responses
-            if response.status_code != 200:
-                current_app.logger.error('Solr returned {response}.'.format(response=response))
-                raise Solr("status_code %s"%response.status_code)
+    def get_from_solr(self, params):
+        """
+        sends the request and returns the decoded solr response, raises Solr on any non-200 response
+
+        :param params:
+        :return:
+        """
+        response = self.send(params)
+
+        # all non-200 responses
+        if response.status_code != 200:
+            current_app.logger.error('Solr returned {response}.'.format(response=response))
+            raise Solr("status_code %s"%response.status_code)
+        return json.loads(response.text)
+
+    def hydrate(self, probed):
+        """
+        returns the massaged records of the probed docs, taking the ones already seen from the document cache,
+        and fetching the rest in one query, and the bibcodes that the query did not return
+
+        :param probed: docs with bibcode only, in the order solr returned them
+        :return: records, unhydrated bibcodes
+        """
+        document_cache = get_document_cache()
+        documents = {}
+        missing = []
+        for doc in probed:
+            document = document_cache.get(doc['bibcode'])
+            if document is None:
+                missing.append(doc['bibcode'])
             else:
-                from_solr = json.loads(response.text)
-        else:
-            from_solr = get_test_data()
+                documents[doc['bibcode']] = document
+
+        if missing:
+            METRICS.incr('solr.two_phase.hydrated', len(missing))
+            start_time = time.time()
+            self.num_requests += 1
+            for doc in self.backend.lookup(missing, self.query_fields):
+                bibcode = doc['bibcode']
+                document = self.massage_solution(doc)
+                document_cache.put(bibcode, document)
+                documents[bibcode] = document
+            self.hydration = {'bibcodes': len(missing), 'ms': round((time.time() - start_time) * 1000, 3)}
+
+        unhydrated = [doc['bibcode'] for doc in probed if doc['bibcode'] not in documents]
+        # hand out copies, the cached records are shared
+        return [dict(documents[doc['bibcode']]) for doc in probed if doc['bibcode'] in documents], unhydrated
 
-        num_docs = from_solr['response'].get('numFound', 0)
+    def query(self, query, filters=None):
+        """
+        executes query, and returns the result.
+
+        If query yields exactly max_rows fields, we have an overflow.
+
+        In two-phase mode, the query asks for bibcodes only, to learn the candidates and their count,
+        and then the records are hydrated, see hydrate. If some of the bibcodes do not come back from
+        the lookup, the query is sent again for the full records, so that no candidate is lost.
+
+        :param query:
+        :param filters: list of filter queries
+        :return:
+        """
+        current_app.logger.debug('Query is %s' % (query))
+        if filters:
+            current_app.logger.debug('Filter queries are %s' % (filters))
+        solutions = []
+        self.hydration = None
+        self.num_requests = 1
+
+        # the records of the other backends are at hand, there is nothing to save by probing first
+        two_phase = isinstance(self.backend, RemoteSolr) and self.two_phase
+        num_docs, docs = self.backend.search(query, filters, fields='bibcode,scix_id' if two_phase else None, rows=self.max_rows)
         current_app.logger.debug('YIELD num_docs=%s' %(num_docs))
+        self.num_found = num_docs
 
         if num_docs >= self.max_rows:
             current_app.logger.error('solr overflow exception: query {query} returned more than {num_rows} rows'.format(query=query, num_rows=self.max_rows))
             return None
 
-        for docs in from_solr["response"]["docs"]:
-            solutions.append(self.massage_solution(docs))
+        if two_phase:
+            solutions, unhydrated = self.hydrate(docs)
+            if unhydrated:
+                METRICS.incr('solr.two_phase.unhydrated', len(unhydrated))
+                current_app.logger.warning('bibcodes {bibcodes} of query {query} were not returned by the lookup, '
+                                           'querying for the full records.'.format(bibcodes=unhydrated, query=query))
+                self.hydration['unhydrated'] = unhydrated
+                self.num_requests += 1
+                num_docs, docs = self.backend.search(query, filters, rows=self.max_rows)
+                self.num_found = num_docs
+                if num_docs >= self.max_rows:
+                    return None
+                solutions = [self.massage_solution(doc) for doc in docs]
+        else:
+            for doc in docs:
+                solutions.append(self.massage_solution(doc))
+        # normalize the fields the evidence functions compare once here, and not for every hypothesis scoring them,
+        # the scoring reads them off the record
+        for solution in solutions:
+            solution[FEATURES_KEY] = get_document_features(solution)
         current_app.logger.debug('len(solutions)=%s' %(len(solutions)))
 
         return solutions
@@ -5,13 +5,19 @@ Evaluating hypotheses and working out which is acceptable.
 import regex as re
 import urllib
 import traceback
+import heapq
+import time
 
 from flask import current_app
 
-from referencesrv.resolver.common import Undecidable, NoSolution, Solution, OverflowOrNone, Solr, Incomplete, sorted2
+from referencesrv.resolver.common import Undecidable, NoSolution, Solution, OverflowOrNone, Solr, Incomplete, \
+    Evidences, EvidenceMemo, QueryBudget, get_scoring_context
 from referencesrv.resolver.solrquery import Querier
 from referencesrv.resolver.hypotheses import Hypotheses
-from referencesrv.resolver.authors import normalize_author_list
+from referencesrv.resolver.authors import normalize_author_list, get_distinctive_authors
+from referencesrv.resolver.scoring import get_score_upper_bounds
+from referencesrv.resolver.volumeranges import get_volume_ranges
+from referencesrv.metrics import METRICS, incr_request_metric
 
 # metacharacters and reserved words of the ADS solr parser
 SOLR_ESCAPABLE = re.compile(r"""(?i)([-]|\bto\b|\band\b|\bor\b|\bnot\b|\bnear\b)""")
@@ -26,6 +32,16 @@ AUTHOR_LAST_NAME_CASE_INSENSITIVE = re.compile(r"([A-Za-z]+)")
 HINT_TO_SOLR_KEYS = {
 }
 
+# input fields a query that overflows is refined with, most selective first,
+# along with the hints that already constrain each of them
+REFINEMENT_FIELDS = [
+    ('volume', ('volume',)),
+    ('page', ('page',)),
+    ('bibstem', ('bibstem', 'pub')),
+    ('year', ('year',)),
+    ('title~', ('title', 'title~')),
+]
+
 def make_solr_condition_author(value):
     """
 
@@ -46,8 +62,10 @@ def make_solr_condition_author(value):
         if len(lastname) == 0:
             lastname = '; '.join(AUTHOR_LAST_NAME_CASE_INSENSITIVE.findall(value))
         value = lastname
+    authors = get_distinctive_authors([s.strip() for s in value.split(";")],
+                                      current_app.config['REFERENCE_SERVICE_QUERY_AUTHORS_MAX'])
     # authors fields have special serialization rules
-    return " AND ".join('"%s"' % s.strip() for s in value.split(";"))
+    return " AND ".join('"%s"' % s for s in authors)
 
 def make_solr_condition_first_author(value):
     """
@@ -101,6 +119,10 @@ def make_solr_condition(key, value):
     if key == 'bibcode':
         return 'identifier:"%s"' %value
 
+    # the bibcodes matching a wildcard bibcode in the bibcode index
+    if key == 'bibcodes':
+        return 'identifier:(%s)'%' OR '.join('"%s"'%bibcode for bibcode in value.split())
+
     if key == 'arxiv':
         return 'identifier:("arxiv:%s")'%value
 
@@ -132,16 +154,65 @@ def make_solr_condition(key, value):
         return '%s:(%s)'%(key, value)
 
     # approximate search
-    # for year discrepancy => give it a 10 year window
+    # for year discrepancy => either the window of the hypothesis, or give it a 10 year window
     if key=='year~':
+        if ' TO ' in value:
+            return 'year:[%s]'%value
         return 'year:%s'%("[%s TO %s]"%(int(value)-5, int(value)+5))
 
+    # cited records cannot be published after the citing paper
+    if key=='year_max':
+        return 'year:[* TO %s]'%value
+
     if key=='doctype':
         return '%s:(%s)'%(key, value)
 
     return '%s:"%s"'%(key, SOLR_ESCAPABLE.sub(r"\\\1", value))
 
 
+def get_refined_hints(hints, input_fields):
+    """
+    returns the hints with one more of the input fields that they do not constrain yet,
+    or None if there is none left
+
+    :param hints:
+    :param input_fields:
+    :return:
+    """
+    for key, constrained_by in REFINEMENT_FIELDS:
+        value = input_fields.get(key.rstrip('~'), None)
+        if not value or any(hint in hints for hint in constrained_by):
+            continue
+        refined = dict(hints)
+        # the exact year is narrower than the year window
+        if key == 'year':
+            refined.pop('year~', None)
+        refined[key] = value
+        return refined
+    return None
+
+
+def make_solr_query(hints):
+    """
+    returns the query and the filter queries for the hints of a hypothesis
+
+    If filter queries are enabled, the exact, non-scoring constraints, ie, year, doctype, and bibstem,
+    are sent as filter queries, for solr to cache them, and only the rest goes to the query.
+
+    :param hints:
+    :return: query, list of filter queries
+    """
+    conditions = [(key, make_solr_condition(key, value)) for key, value in hints.items()]
+    conditions = [(key, condition) for key, condition in conditions if condition is not None]
+    if not current_app.config['REFERENCE_SERVICE_SOLR_FILTER_QUERIES']:
+        return " AND ".join(condition for _, condition in conditions), []
+
+    filter_keys = current_app.config['REFERENCE_SERVICE_SOLR_FILTER_KEYS']
+    filters = [condition for key, condition in conditions if key in filter_keys]
+    query = " AND ".join(condition for key, condition in conditions if key not in filter_keys)
+    return query or "*:*", filters
+
+
 def inspect_doubtful_solutions(scored_solutions, query_string, hypothesis):
     """
     raises an Undecidable exception carrying halfway credible candidates.
@@ -213,7 +284,7 @@ def inspect_ambiguous_solutions(scored_solutions, query_string, hypothesis):
         return non_vetoed[-1]
 
     to_stash = [(score.get_score(), sol.get("bibcode", None), sol.get("scix_id", None))
-                for score, sol in non_vetoed if score>current_app.config['EVIDENCE_SCORE_RANGE'][0]]
+                for score, sol in non_vetoed if score>hypothesis.get_scoring_context().min_score]
     current_app.logger.debug("Unsolved ambiguity, stashing %s"%(to_stash))
     raise Undecidable("Ambiguous %s."%(query_string), considered_solutions=to_stash)
 
@@ -232,7 +303,7 @@ def choose_solution(candidates, query_string, hypothesis):
     :param hypothesis:
     :return:
     """
-    min_score = current_app.config['MIN_SCORE_FIRST_ROUND']
+    min_score = hypothesis.get_scoring_context().min_score_first_round
     filtered = [(score, solution) for score, solution in candidates if score >= min_score*len(score)]
     if len(filtered)==0:
         if candidates:
@@ -250,6 +321,11 @@ def choose_solution(candidates, query_string, hypothesis):
         # get all equal-scored matches with the highest scores
         best_score = max(item[0].get_score() for item in filtered)
         best_solution = [(ev, solution) for ev, solution in filtered if ev.get_score()==best_score]
+        # the ones published by the time of the citing paper are preferred over the ones in press
+        citing_year = hypothesis.get_detail('citing_year')
+        if citing_year and len(best_solution) > 1:
+            best_solution = [(ev, solution) for ev, solution in best_solution
+                             if solution.get('year', '9999')[:4] <= str(citing_year)] or best_solution
         if len(best_solution)==1:
             evidence, solution = best_solution[0]
             return evidence, solution
@@ -258,7 +334,133 @@ def choose_solution(candidates, query_string, hypothesis):
             raise Undecidable("%s solutions with equal (good) score."%len(best_solution))
 
 
-def solve_for_fields(hypothesis):
+def select_candidates(solutions, hypothesis):
+    """
+    returns the pairs of (evidences, solution) choose_solution needs to decide, lowest score first
+
+    Instead of scoring and sorting all the solutions, the candidates are scored in the order of
+    their score upper bound, the best ones are kept in a bounded heap, and once there is an acceptable
+    candidate, the ones whose upper bound is below its score are not scored at all, since they could
+    neither be chosen nor tie with it. That also stops scoring once a candidate has the maximum score possible.
+
+    If no candidate is acceptable, all were scored, and the ones inspect_doubtful_solutions looks at are kept,
+    which are the non-vetoed (two are enough to know it is not unique), and the best with a single veto from page,
+    the first solr returned among equally scored, which is the one inspect_doubtful_solutions stashes.
+
+    :param solutions:
+    :param hypothesis:
+    :return:
+    """
+    context = hypothesis.get_scoring_context()
+    min_score = context.min_score_first_round
+    top_candidates = context.top_candidates
+
+    bounds = get_score_upper_bounds(solutions, hypothesis)
+    order = sorted(range(len(solutions)), key=lambda i: -bounds[i] if bounds[i] is not None else float('-inf'))
+
+    accepted = []
+    best_score = None
+    best_other = None
+    non_vetoed = []
+    page_vetoed = None
+    for num_scored, index in enumerate(order):
+        if best_score is not None and bounds[index] is not None and bounds[index] < best_score - 1e-9:
+            # the rest are sorted by bound, so none can compete
+            METRICS.incr('resolver.candidates.pruned', len(order) - num_scored)
+            break
+        solution = solutions[index]
+        evidences = hypothesis.get_score(solution, hypothesis)
+        METRICS.incr('resolver.candidates.scored')
+        # key of the heap is score, and then the order solr returned the solutions in
+        item = (evidences.get_score(), -index, evidences, solution)
+        if evidences >= min_score * len(evidences):
+            if best_score is None or item[0] > best_score:
+                best_score = item[0]
+            if len(accepted) < top_candidates:
+                heapq.heappush(accepted, item)
+            else:
+                heapq.heappushpop(accepted, item)
+        elif not accepted:
+            if best_other is None or item[:2] > best_other[:2]:
+                best_other = item
+            if not evidences.has_veto():
+                if len(non_vetoed) < 2:
+                    non_vetoed.append(item)
+            elif evidences.single_veto_from("page") and (page_vetoed is None or item[:2] > page_vetoed[:2]):
+                page_vetoed = item
+
+    if accepted:
+        candidates = accepted
+    else:
+        candidates = {id(item[3]): item for item in non_vetoed + [page_vetoed, best_other] if item is not None}.values()
+    return [(item[2], item[3]) for item in sorted(candidates, key=lambda item: item[:2])]
+
+
+def solve_from_identifier_index(hypothesis):
+    """
+    returns a Solution if hypothesis is a pure identifier lookup that the local
+    identifier index can answer, otherwise None, in which case solr needs to be queried.
+
+    raises NoSolution if the record found is published after the citing paper, as solr
+    would not return it either
+
+    :param hypothesis:
+    :return:
+    """
+    identifier_index = current_app.extensions.get('identifier_index', None)
+    if identifier_index is None or len(hypothesis.hints) != 1:
+        return None
+
+    name, value = list(hypothesis.hints.items())[0]
+    # wildcard bibcodes need to go to solr
+    if '?' in value:
+        return None
+
+    found = identifier_index.lookup_hint(name, value)
+    if not found:
+        return None
+
+    bibcode, scix_id = found
+    current_app.logger.debug("identifier %s:%s found in identifier index as %s"%(name, value, bibcode))
+    citing_year = hypothesis.get_detail('citing_year')
+    if citing_year and bibcode[:4].isdigit() and int(bibcode[:4]) > citing_year + hypothesis.get_scoring_context().citing_year_slack:
+        raise NoSolution("%s in identifier index is published after the citing paper"%bibcode)
+    evidences = Evidences(hypothesis.get_scoring_context())
+    evidences.add_evidence(evidences.max_score, 'bibcode')
+    return Solution(bibcode, evidences, hypothesis.name, scix_id=scix_id)
+
+
+def get_bibcode_hints(hints, max_records):
+    """
+    returns the hints with the wildcard bibcode replaced by the bibcodes matching it in the bibcode index,
+    or the hints as they are if there is no index, or the index cannot narrow the wildcard bibcode down
+
+    raises NoSolution if no bibcode matches
+
+    :param hints:
+    :param max_records: the number of records a query returns at most
+    :return:
+    """
+    bibcode_index = current_app.extensions.get('bibcode_index', None)
+    pattern = hints.get('bibcode', '')
+    if bibcode_index is None or '?' not in pattern:
+        return hints
+
+    bibcodes = bibcode_index.match(pattern)
+    if bibcodes is None or len(bibcodes) >= max_records:
+        METRICS.incr('resolver.bibcode_index.fallback')
+        return hints
+    if not bibcodes:
+        METRICS.incr('resolver.bibcode_index.unmatched')
+        raise NoSolution("No bibcode matching %s in bibcode index"%pattern)
+    METRICS.incr('resolver.bibcode_index.matched')
+    hints = dict(hints)
+    del hints['bibcode']
+    hints['bibcodes'] = ' '.join(bibcodes)
+    return hints
+
+
+def solve_for_fields(hypothesis, trace=None, budget=None):
     """
     returns a record matching hypothesis or raises NoSolution.
 
@@ -266,6 +468,8 @@ def solve_for_fields(hypothesis):
     hypothesis evaluate whatever comes back.
 
     :param hypothesis:
+    :param trace: ResolutionTrace, to record the query and the candidates scored, if the resolution is explained
+    :param budget: QueryBudget of the reference, charged with the query
     :return:
     """
     if not hasattr(solve_for_fields, "query"):
@@ -274,19 +478,70 @@ def solve_for_fields(hypothesis):
 
     current_app.logger.debug("HINTS IN %s: %s"%(hypothesis.name, hypothesis.hints))
 
-    query_string = " AND ".join(cond for cond in (make_solr_condition(*item)
-                                                  for item in hypothesis.hints.items()) if cond is not None)
-
-    solutions = query(query_string)
+    start_time = time.time()
+    try:
+        solution = solve_from_identifier_index(hypothesis)
+    except NoSolution:
+        if trace is not None:
+            trace.add_query('identifier index', None, 0, time.time() - start_time)
+        raise
+    if solution:
+        if trace is not None:
+            trace.add_query('identifier index', None, 1, time.time() - start_time)
+        return solution
+
+    try:
+        hints = get_bibcode_hints(hypothesis.hints, hypothesis.get_scoring_context().max_records)
+    except NoSolution:
+        if trace is not None:
+            trace.add_query('bibcode index', None, 0, time.time() - start_time)
+        raise
+    citing_year = hypothesis.get_detail('citing_year')
+    if citing_year:
+        hints = dict(hints, year_max=str(citing_year + hypothesis.get_scoring_context().citing_year_slack))
+    input_fields = hypothesis.get_detail('input_fields') or {}
+    refinements = 0
+    while True:
+        query_string, filters = make_solr_query(hints)
+
+        start_time = time.time()
+        try:
+            solutions = query(query_string, filters)
+        finally:
+            if budget is not None:
+                budget.spend(time.time() - start_time, max(QUERIER.num_requests, 1))
+        if trace is not None:
+            trace.add_query(query_string, filters, QUERIER.num_found, time.time() - start_time)
+            if QUERIER.hydration:
+                trace.add_hydration(QUERIER.hydration)
+
+        # instead of giving up on a query that returns too many records,
+        # narrow it down with what the reference has that is not in the query yet
+        if solutions is not None or refinements >= current_app.config['REFERENCE_SERVICE_OVERFLOW_REFINEMENTS'] or \
+                (budget is not None and budget.is_exceeded()):
+            break
+        hints = get_refined_hints(hints, input_fields)
+        if hints is None:
+            break
+        refinements += 1
+        METRICS.incr('resolver.overflow.refined')
+        current_app.logger.debug("Overflow in %s, refining the query with %s"%(hypothesis.name, hints))
+
+    if refinements and solutions:
+        METRICS.incr('resolver.overflow.recovered')
+    if filters:
+        query_string = " AND ".join([query_string] + filters)
 
     if solutions:
         if len(solutions) > 0:
             current_app.logger.debug("solutions: %s"%(solutions))
 
-            scored = list(sorted2((hypothesis.get_score(s, hypothesis), s) for s in solutions))
+            scored = select_candidates(solutions, hypothesis)
+            if trace is not None:
+                trace.add_candidates(scored)
 
             current_app.logger.debug("evidences from %s"%(hypothesis.name))
-            for score, sol in sorted2(scored):
+            for score, sol in scored:
                 current_app.logger.debug("score %s %s %s"%(sol.get('bibcode',None), score.get_score(), score))
 
             score, sol = choose_solution(scored, query_string, hypothesis)
@@ -319,13 +574,22 @@ def enough_to_proceed(ref):
     return False
 
 
-def solve_reference(ref):
+def solve_reference(ref, trace=None):
     """
     returns a solution for what record is presumably meant by ref.
 
     ref is an instance of Reference (or rather, its subclasses).
     If no matching record is found, NoSolution is raised.
+
+    If trace is given, each hypothesis tried is recorded in it, along with
+    the reason it was accepted or rejected.
+
+    Once the reference has used up its query budget, no more hypotheses are
+    tried, and the solution is chosen from the ties stashed so far.
+
+    If the year of the citing paper is known, records published after it are not considered.
     :param ref:
+    :param trace: ResolutionTrace
     :return:
     """
     if not enough_to_proceed(ref):
@@ -334,22 +598,76 @@ def solve_reference(ref):
 
     possible_solutions = []
     reason = None
-    for hypothesis in Hypotheses.iter_hypotheses(ref):
-        try:
-            return solve_for_fields(hypothesis)
-        except Undecidable as ex:
-            # The list of possible solutions is the list of triples sent back
-            # when the Undecidable exception is thrown in the solve_for_fields call.
-            # These are generated in inspect_doubtful_solutions. 
-            possible_solutions.extend(ex.considered_solutions)
-            reason = ex.reason
-        except (NoSolution, OverflowOrNone) as ex:
-            current_app.logger.debug("(%s)"%ex.__class__.__name__)
-        except (Solr, KeyboardInterrupt):
-            raise
-        except Exception as ex:
-            current_app.logger.error("Unhandled exception of type {0} occurred with arguments:{1!r}, thus killing a single hypothesis.".format(type(ex).__name__, ex.args))
-            current_app.logger.error(traceback.format_exc())
+    # once a year window has records that scored, wider windows are not tried
+    year_window_scored = False
+    # evidence components computed for one hypothesis are reused by the others
+    evidence_memo = EvidenceMemo()
+    # the thresholds and weights are looked up once for all the candidates of all the hypotheses
+    scoring_context = get_scoring_context()
+    # and so is the table of volume ranges, so that scoring does not need the app
+    volume_ranges = get_volume_ranges()
+    budget = QueryBudget(current_app.config['REFERENCE_SERVICE_QUERY_BUDGET_QUERIES'],
+                         current_app.config['REFERENCE_SERVICE_QUERY_BUDGET_SECONDS'])
+    budget_exceeded = False
+    try:
+        for hypothesis in Hypotheses.iter_hypotheses(ref, scoring_context):
+            if budget.is_exceeded():
+                current_app.logger.debug("Query budget exceeded with %s, not trying %s"%(budget, hypothesis.name))
+                budget_exceeded = True
+                break
+            year_window = hypothesis.get_detail('year_window')
+            if year_window:
+                if year_window_scored:
+                    continue
+                METRICS.incr('resolver.year_window.%d.tried'%year_window)
+            hypothesis.details['evidence_memo'] = evidence_memo
+            hypothesis.details['citing_year'] = ref.citing_year
+            hypothesis.details['scoring_context'] = scoring_context
+            hypothesis.details['volume_ranges'] = volume_ranges
+            if trace is not None:
+                trace.start_hypothesis(hypothesis)
+            try:
+                solution = solve_for_fields(hypothesis, trace, budget)
+                if trace is not None:
+                    trace.set_outcome('accepted', str(solution))
+                if year_window:
+                    METRICS.incr('resolver.year_window.%d.resolved'%year_window)
+                if hypothesis.get_detail('rule'):
+                    METRICS.incr('specialrules.%s.resolved'%hypothesis.get_detail('rule'))
+                return solution
+            except Undecidable as ex:
+                # The list of possible solutions is the list of triples sent back
+                # when the Undecidable exception is thrown in the solve_for_fields call.
+                # These are generated in inspect_doubtful_solutions.
+                possible_solutions.extend(ex.considered_solutions)
+                reason = ex.reason
+                year_window_scored = bool(year_window)
+                if trace is not None:
+                    trace.set_outcome('undecidable', str(ex))
+            except (NoSolution, OverflowOrNone) as ex:
+                current_app.logger.debug("(%s)"%ex.__class__.__name__)
+                if trace is not None:
+                    trace.set_outcome('rejected', "%s: %s"%(ex.__class__.__name__, ex))
+            except Solr as ex:
+                if trace is not None:
+                    trace.set_outcome('failed', "Solr: %s"%ex)
+                raise
+            except KeyboardInterrupt:
+                raise
+            except Exception as ex:
+                current_app.logger.error("Unhandled exception of type {0} occurred with arguments:{1!r}, thus killing a single hypothesis.".format(type(ex).__name__, ex.args))
+                current_app.logger.error(traceback.format_exc())
+                if trace is not None:
+                    trace.set_outcome('failed', "%s: %s"%(type(ex).__name__, ex))
+    finally:
+        METRICS.incr('resolver.evidence_memo.hits', evidence_memo.hits)
+        METRICS.incr('resolver.evidence_memo.misses', evidence_memo.misses)
+        incr_request_metric('evidence_memo.hits', evidence_memo.hits)
+        incr_request_metric('evidence_memo.misses', evidence_memo.misses)
+        METRICS.incr('resolver.budget.queries', budget.queries)
+        if budget_exceeded:
+            METRICS.incr('resolver.budget.exceeded')
+            incr_request_metric('budget.exceeded')
 
     # if we have collected possible solutions for which we didn't want
     # to decide the first time around, now see if any one is better than
@@ -377,6 +695,8 @@ def solve_reference(ref):
             return Solution(bibcode, scored[0][0], "best tied solution", scix_id=scored[0][1])
         else:
             current_app.logger.debug("Remaining ties, giving up")
+    if budget_exceeded:
+        raise NoSolution("Query budget exceeded (%s)"%budget, "%s -- %s"%(reason, str(ref)) if reason else str(ref))
     if reason:
         raise NoSolution("Hypotheses exhausted", "%s -- %s"%(reason, str(ref)))
     raise NoSolution("Hypotheses exhausted", str(ref))
@@ -4,12 +4,12 @@ Extra hypothesis generators (and verifiers) by individual publication types, giv
 
 import regex as re
 
-from flask import current_app
-
 from referencesrv.resolver.common import Evidences, Hypothesis
 from referencesrv.resolver.scoring import get_basic_score_for_input_fields, get_serial_score_for_input_fields, \
     get_author_year_pub_score_for_input_fields
 from referencesrv.resolver.authors import add_author_evidence, normalize_author_list
+from referencesrv.resolver.features import get_record_features
+from referencesrv.metrics import METRICS
 
 
 def change_dict(base, del_keys=(), **kwargs):
@@ -43,9 +43,9 @@ def add_boolean_evidence(evidences, boolean, hint):
     :return:
     """
     if boolean:
-        evidences.add_evidence(current_app.config['EVIDENCE_SCORE_RANGE'][1], hint)
+        evidences.add_evidence(evidences.max_score, hint)
     else:
-        evidences.add_evidence(current_app.config['EVIDENCE_SCORE_RANGE'][0], hint)
+        evidences.add_evidence(evidences.min_score, hint)
 
 
 def get_score_for_baas_match(result_record, hypothesis):
@@ -61,9 +61,9 @@ def get_score_for_baas_match(result_record, hypothesis):
     :param hypothesis:
     :return:
     """
-    evidences = Evidences()
+    evidences = Evidences(hypothesis.get_scoring_context())
     if not re.match(r'....%s'%hypothesis.get_detail('expected_bibstem'), result_record['bibcode']):
-        evidences.add_evidence(current_app.config['EVIDENCE_SCORE_RANGE'][0], 'no DDA bibcode')
+        evidences.add_evidence(evidences.min_score, 'no DDA bibcode')
         return evidences
 
     input_fields = hypothesis.get_detail('input_fields')
@@ -75,7 +75,8 @@ def get_score_for_baas_match(result_record, hypothesis):
     add_author_evidence(evidences,
         normalized_authors,
         result_record['author_norm'],
-        result_record['first_author_norm'])
+        result_record['first_author_norm'],
+        ads_last_names=get_record_features(result_record, evidences.context).author_last_names)
 
     add_boolean_evidence(evidences,
         'Vol. %s'%input_fields['volume'] in result_record['pub_raw'],
@@ -87,27 +88,227 @@ def get_score_for_baas_match(result_record, hypothesis):
     return evidences
 
 
-def get_conf_series_indicators():
+class JournalRule(object):
+    """
+    a rule generating extra hypotheses for a publication type, triggered by the bibstem of the reference,
+    by a condition on its fields, or by a pattern found in its journal
+    """
+
+    def __init__(self, name, generate, bibstems=(), condition=None, pattern=None):
+        """
+
+        :param name: name of the rule in the metrics
+        :param generate: function of the input fields and the reference fields, yielding the hypotheses
+        :param bibstems: the bibstems triggering the rule
+        :param condition: function of the reference fields triggering the rule
+        :param pattern: regular expression triggering the rule when found in the journal
+        """
+        self.name = name
+        self.generate = generate
+        self.bibstems = bibstems
+        self.condition = condition
+        self.pattern = re.compile(pattern) if pattern else None
+
+
+class RuleRegistry(object):
+    """
+    the rules indexed by their trigger, so that for a reference only the ones that can fire are evaluated,
+    in the order of bibstem rules, condition rules, and pattern rules, each in the order registered
+    """
+
+    def __init__(self):
+        """
+
+        """
+        self.by_bibstem = {}
+        self.conditional = []
+        self.by_pattern = []
+        self.any_pattern = None
+
+    def register(self, name, bibstems=(), condition=None, pattern=None):
+        """
+        decorator registering the function generating the hypotheses of a rule
+
+        :param name:
+        :param bibstems:
+        :param condition:
+        :param pattern:
+        :return:
+        """
+        def decorator(generate):
+            self.add(JournalRule(name, generate, bibstems, condition, pattern))
+            return generate
+        return decorator
+
+    def add(self, rule):
+        """
+
+        :param rule:
+        :return:
+        """
+        for bibstem in rule.bibstems:
+            self.by_bibstem.setdefault(bibstem, []).append(rule)
+        if rule.condition:
+            self.conditional.append(rule)
+        if rule.pattern:
+            self.by_pattern.append(rule)
+            # one pass over the journal tells if any of the patterns is in there at all
+            self.any_pattern = re.compile("|".join("(?:%s)" % rule.pattern.pattern for rule in self.by_pattern))
+
+    def iter_fired_rules(self, fields):
+        """
+        iterates over the rules that fire for the fields of the reference
+
+        :param fields:
+        :return:
+        """
+        for rule in self.by_bibstem.get(fields['bibstem'], []):
+            yield rule
+        for rule in self.conditional:
+            if rule.condition(fields):
+                yield rule
+        journal = fields['journal']
+        if journal and self.any_pattern is not None and self.any_pattern.search(journal):
+            for rule in self.by_pattern:
+                if rule.pattern.search(journal):
+                    yield rule
+
+
+JOURNAL_RULES = RuleRegistry()
+
+
+@JOURNAL_RULES.register('BAAS', bibstems=['BAAS'])
+def iter_baas_hypotheses(input_fields, fields):
+    """
+    abstracts in BAAS are also published in the bibstems of the meetings and divisions
+
+    :param input_fields:
+    :param fields:
+    :return:
     """
+    for meeting in ['DDA', 'AAS', 'DPS']:
+        yield Hypothesis('extra-BAAS->%s'%meeting,
+            change_dict(input_fields, ['volume', 'page', 'pub'], bibstem=meeting),
+            get_score_for_baas_match,
+            input_fields=input_fields,
+            expected_bibstem=meeting)
+
 
-    :return: REs to recognise within pub the bibstem
+@JOURNAL_RULES.register('LPSC', bibstems=['LPSC'])
+def iter_lpsc_hypotheses(input_fields, fields):
     """
-    conf_series_indicators = {
-        "IAUS": r"[\201'Il]( |\.)?\ ?A( |\.)?\ ?U( |\. )?\ ?Sym",
-        "IAUCo": r"[\201'I] ?A ?U ?Co[li1]{2}",
-        "AIPC": r"A(m)?\s*[lIi](nst)?\s*P(hys)?\s+(Co[on]f|Proc)",
-        "ASPC": r"A(stro?n?)?\s*S(oc)?\s*P(ac)?\s*C(o[on]f)?",
-        "SPIE": r"SPIE",
-        "BSRSL": r"BSRSL",
-        "LPSC": r"Lun(ar)?\.?\s+(Planet(ary)?\.?)?\s+(Sci(ence)?\.?)?\s+Conf|LPSC?\s+[IVXLCDM0-9]+",
-        "LPI": r"Lunar\s+(Planet(ary)?\.?)?\s+(Sci(ence)?\.?)?\s+[iIvVxXlLcCdDmM]+",
-        "LPICo": r"LPI\s+Contrib",
-        "ESASP": r"ESA\sS(pec(ial)?)?\.?\s*P(ubl(ication)?s?)?\.?",
-        "LNP": r"Lect(ure)?\.?\s+Not(es)?\.?\s+(in)?\s*Phys(ics)?\.?",
-        "SAAS": r"Saas[\s-]?Fee",
-        "ASSL": r"Astrophys(ics|\.)?\s+(and\s+)?Space\s+Sci(ence|\.)?\s+Lib(rary|\.)?"
-    }
-    return [(re.compile(pat), stem) for stem, pat in conf_series_indicators.items()]
+
+    :param input_fields:
+    :param fields:
+    :return:
+    """
+    # These were published in 'volumes' per conference. So,
+    # for these volume can mean essentially anything
+    yield Hypothesis('LPSC-ignore-volume',
+        change_dict(input_fields, ['volume', 'pub']),
+        get_basic_score_for_input_fields,
+        input_fields=change_dict(input_fields, ['volume']),
+        expected_bibstem='LPSC')
+
+
+@JOURNAL_RULES.register('JOSS', bibstems=['JOSS'])
+def iter_joss_hypotheses(input_fields, fields):
+    """
+
+    :param input_fields:
+    :param fields:
+    :return:
+    """
+    # These are software records and hence sometimes author skip including volume and page
+    # that is why we are here, incomplete record, and
+    # so try to match author, year, and publication only
+    # if more than one record with these specification is found, no matched is returned
+    yield Hypothesis('JOSS-ignore-volume-page',
+        change_dict(input_fields, ['volume', 'page'], bibstem='JOSS'),
+        get_author_year_pub_score_for_input_fields,
+        input_fields=change_dict(input_fields, ['volume', 'page']))
+
+
+@JOURNAL_RULES.register('ApJL', bibstems=['ApJ'])
+def iter_apjl_hypotheses(input_fields, fields):
+    """
+
+    :param input_fields:
+    :param fields:
+    :return:
+    """
+    yield Hypothesis('extra-ApJ->ApJL',
+        change_dict(input_fields, ['pub'], bibstem='ApJL'),
+        get_serial_score_for_input_fields,
+        input_fields=input_fields)
+
+
+def has_repeated_year(fields):
+    """
+    returns True if the year appears more than once in the reference
+
+    :param fields:
+    :return:
+    """
+    return bool(fields['full_reference'] and fields['year'] and fields['full_reference'].count(fields['year']) > 1)
+
+
+@JOURNAL_RULES.register('volume-year', condition=has_repeated_year)
+def iter_volume_year_hypotheses(input_fields, fields):
+    """
+
+    :param input_fields:
+    :param fields:
+    :return:
+    """
+    # some pubications do not have a volume number, actually the volume number equals the year
+    # when parsed if multiple year encountered, it is ignored, and hence the first numeric value is
+    # considered volume, and the next one, if any is considered the page
+    # so shift that, assign the year to volume, whatever is assigned to volume assign to page
+    yield Hypothesis('volume-year-identical',
+        change_dict(input_fields, ['volume', 'page'], volume=fields['year'], page=fields['volume']),
+        get_serial_score_for_input_fields,
+        input_fields=input_fields)
+
+
+# REs to recognise within pub the bibstem
+CONF_SERIES_INDICATORS = [
+    ("IAUS", r"[\201'Il]( |\.)?\ ?A( |\.)?\ ?U( |\. )?\ ?Sym"),
+    ("IAUCo", r"[\201'I] ?A ?U ?Co[li1]{2}"),
+    ("AIPC", r"A(m)?\s*[lIi](nst)?\s*P(hys)?\s+(Co[on]f|Proc)"),
+    ("ASPC", r"A(stro?n?)?\s*S(oc)?\s*P(ac)?\s*C(o[on]f)?"),
+    ("SPIE", r"SPIE"),
+    ("BSRSL", r"BSRSL"),
+    ("LPSC", r"Lun(ar)?\.?\s+(Planet(ary)?\.?)?\s+(Sci(ence)?\.?)?\s+Conf|LPSC?\s+[IVXLCDM0-9]+"),
+    ("LPI", r"Lunar\s+(Planet(ary)?\.?)?\s+(Sci(ence)?\.?)?\s+[iIvVxXlLcCdDmM]+"),
+    ("LPICo", r"LPI\s+Contrib"),
+    ("ESASP", r"ESA\sS(pec(ial)?)?\.?\s*P(ubl(ication)?s?)?\.?"),
+    ("LNP", r"Lect(ure)?\.?\s+Not(es)?\.?\s+(in)?\s*Phys(ics)?\.?"),
+    ("SAAS", r"Saas[\s-]?Fee"),
+    ("ASSL", r"Astrophys(ics|\.)?\s+(and\s+)?Space\s+Sci(ence|\.)?\s+Lib(rary|\.)?"),
+]
+
+
+def get_conf_series_generator(conf_bibstem):
+    """
+    returns the function generating the hypothesis of the conference series conf_bibstem
+
+    :param conf_bibstem:
+    :return:
+    """
+    def iter_conf_series_hypotheses(input_fields, fields):
+        # volume often isn't properly parsed out for those; if
+        # this gives too may false positives, we'll have to do
+        # it ourselves from journal, and then use the serial_score.
+        yield Hypothesis('fielded-confser-%s'%conf_bibstem,
+            change_dict(input_fields, ['pub'], bibstem=conf_bibstem),
+            get_basic_score_for_input_fields,
+            input_fields=input_fields)
+    return iter_conf_series_hypotheses
+
+
+for conf_bibstem, conf_pattern in CONF_SERIES_INDICATORS:
+    JOURNAL_RULES.add(JournalRule('confser-%s'%conf_bibstem, get_conf_series_generator(conf_bibstem), pattern=conf_pattern))
 
 
 def iter_journal_specific_hypotheses(bibstem, year, author, journal, volume, page, full_reference):
@@ -121,6 +322,9 @@ def iter_journal_specific_hypotheses(bibstem, year, author, journal, volume, pag
     narrowly defined publications), as, in particular for text references,
     they could otherwise generate many, many queries.
 
+    Only the rules of JOURNAL_RULES the reference triggers are evaluated. The hypotheses
+    carry the name of their rule, to count in the metrics how often each fires, and resolves.
+
     Note that bibstem might be None.
 
     :param bibstem:
@@ -141,67 +345,11 @@ def iter_journal_specific_hypotheses(bibstem, year, author, journal, volume, pag
             ('year', year),
             ('page', page),
             ('pub', journal)] if val)
-
-    if bibstem == 'BAAS':
-        yield Hypothesis('extra-BAAS->DDA',
-            change_dict(input_fields, ['volume', 'page', 'pub'], bibstem='DDA'),
-            get_score_for_baas_match,
-            input_fields=input_fields,
-            expected_bibstem='DDA')
-        yield Hypothesis('extra-BAAS->AAS',
-            change_dict(input_fields, ['volume', 'page', 'pub'], bibstem='AAS'),
-            get_score_for_baas_match,
-            input_fields=input_fields,
-            expected_bibstem='AAS')
-        yield Hypothesis('extra-BAAS->DPS',
-            change_dict(input_fields, ['volume', 'page', 'pub'], bibstem='DPS'),
-            get_score_for_baas_match,
-            input_fields=input_fields,
-            expected_bibstem='DPS')
-
-    if bibstem=='LPSC':
-        # These were published in 'volumes' per conference. So,
-        # for these volume can mean essentially anything
-        yield Hypothesis('LPSC-ignore-volume',
-            change_dict(input_fields, ['volume', 'pub']),
-            get_basic_score_for_input_fields,
-            input_fields=change_dict(input_fields, ['volume']),
-            expected_bibstem='LPSC')
-
-    if bibstem=='JOSS':
-        # These are software records and hence sometimes author skip including volume and page
-        # that is why we are here, incomplete record, and
-        # so try to match author, year, and publication only
-        # if more than one record with these specification is found, no matched is returned
-        yield Hypothesis('JOSS-ignore-volume-page',
-            change_dict(input_fields, ['volume', 'page'], bibstem='JOSS'),
-            get_author_year_pub_score_for_input_fields,
-            input_fields=change_dict(input_fields, ['volume', 'page']))
-
-    if bibstem=='ApJ':
-        yield Hypothesis('extra-ApJ->ApJL',
-            change_dict(input_fields, ['pub'], bibstem='ApJL'),
-            get_serial_score_for_input_fields,
-            input_fields=input_fields)
-
-    if full_reference and year:
-        if full_reference.count(year) > 1:
-            # some pubications do not have a volume number, actually the volume number equals the year
-            # when parsed if multiple year encountered, it is ignored, and hence the first numeric value is
-            # considered volume, and the next one, if any is considered the page
-            # so shift that, assign the year to volume, whatever is assigned to volume assign to page
-            yield Hypothesis('volume-year-identical',
-                change_dict(input_fields, ['volume', 'page'], volume=year, page=volume),
-                get_serial_score_for_input_fields,
-                input_fields=input_fields)
-
-    if journal:
-        for pattern, conf_bibstem in get_conf_series_indicators():
-            if pattern.search(journal):
-                # volume often isn't properly parsed out for those; if
-                # this gives too may false positives, we'll have to do
-                # it ourselves from journal, and then use the serial_score.
-                yield Hypothesis('fielded-confser-%s'%conf_bibstem,
-                    change_dict(input_fields, ['pub'], bibstem=conf_bibstem),
-                    get_basic_score_for_input_fields,
-                    input_fields=input_fields)
+    fields = {'bibstem': bibstem, 'year': year, 'author': author, 'journal': journal,
+              'volume': volume, 'page': page, 'full_reference': full_reference}
+
+    for rule in JOURNAL_RULES.iter_fired_rules(fields):
+        METRICS.incr('specialrules.%s.fired'%rule.name)
+        for hypothesis in rule.generate(input_fields, fields):
+            hypothesis.details['rule'] = rule.name
+            yield hypothesis
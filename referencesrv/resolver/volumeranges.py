@@ -0,0 +1,234 @@
+"""
+An optional table of the volumes and pages each journal published in each year,
+built from the bibcode list, to tell apart the combinations of bibstem, year,
+volume, and page that exist from the ones that cannot, ie, when the bibstem was
+guessed wrong, and not send solr the queries of the impossible ones.
+
+The table is a json file of {bibstem: {year: [first volume, last volume, first page, last page]}},
+with the bibstems and years of the bibcodes of numbered volumes and pages only.
+"""
+
+import json
+import time
+import traceback
+
+from flask import current_app
+
+from referencesrv.metrics import METRICS
+
+
+def get_bibcode_numbers(bibcode):
+    """
+    returns the bibstem, year, volume, and page of a bibcode, with volume and page None if not numeric
+
+    :param bibcode:
+    :return:
+    """
+    volume = bibcode[9:13].lstrip('.')
+    # pages of five digits take the place of the qualifier
+    page = bibcode[13:18].lstrip('.') if bibcode[13].isdigit() else bibcode[14:18].lstrip('.')
+    return bibcode[4:9].rstrip('.'), bibcode[:4], \
+           int(volume) if volume.isdigit() else None, int(page) if page.isdigit() else None
+
+
+class VolumeRanges(object):
+    """
+    the first and last volume and page of each bibstem in each year
+    """
+
+    def __init__(self, ranges):
+        """
+
+        :param ranges: {bibstem: {year: [first volume, last volume, first page, last page]}}
+        """
+        self.ranges = ranges
+        # the records of the last year of a journal might not be all in yet
+        self.last_year = {bibstem: max(years) for bibstem, years in ranges.items()}
+
+    def __len__(self):
+        """
+
+        :return:
+        """
+        return sum(len(years) for years in self.ranges.values())
+
+    @classmethod
+    def from_bibcodes(cls, bibcodes):
+        """
+        builds the table from the bibcodes
+
+        :param bibcodes: iterable of bibcodes
+        :return:
+        """
+        ranges = {}
+        for bibcode in bibcodes:
+            bibcode = bibcode.strip()
+            if len(bibcode) != 19 or not bibcode[:4].isdigit():
+                continue
+            bibstem, year, volume, page = get_bibcode_numbers(bibcode)
+            if volume is None or page is None:
+                continue
+            limits = ranges.setdefault(bibstem, {}).get(year)
+            if limits is None:
+                ranges[bibstem][year] = [volume, volume, page, page]
+            else:
+                ranges[bibstem][year] = [min(limits[0], volume), max(limits[1], volume),
+                                         min(limits[2], page), max(limits[3], page)]
+        return cls(ranges)
+
+    def save(self, filename):
+        """
+
+        :param filename:
+        :return:
+        """
+        with open(filename, 'w') as f:
+            json.dump(self.ranges, f, separators=(',', ':'))
+
+    def get_volume_range(self, bibstem, year):
+        """
+        returns the first and last volume of bibstem in year, None if not known
+
+        :param bibstem:
+        :param year:
+        :return:
+        """
+        limits = self.ranges.get(bibstem, {}).get(year)
+        if limits is None:
+            return None
+        return limits[0], limits[1]
+
+    def get_volume_years(self, bibstem, volume, slack=0):
+        """
+        returns the first and last year bibstem published volume in, None if not known
+
+        :param bibstem:
+        :param volume:
+        :param slack: see is_possible
+        :return:
+        """
+        if not volume or not volume.isdigit():
+            return None
+        years = [int(year) for year, limits in self.ranges.get(bibstem, {}).items()
+                 if limits[0] - slack <= int(volume) <= limits[1] + slack]
+        if not years:
+            return None
+        return min(years), max(years)
+
+    def is_possible(self, bibstem, year, volume=None, page=None, slack=0):
+        """
+        returns False if the table rules out that bibstem published volume and page in year,
+        True if it does not, or does not know about it, ie, for the bibstems of journals with
+        volumes that are not numbered
+
+        :param bibstem:
+        :param year:
+        :param volume:
+        :param page:
+        :param slack: the number of volumes either side of the range of the year that are possible too
+        :return:
+        """
+        years = self.ranges.get(bibstem)
+        if not years or not year or not year.isdigit() or year > self.last_year[bibstem]:
+            return True
+        limits = years.get(year)
+        if limits is None:
+            return False
+        if volume and volume.isdigit() and not limits[0] - slack <= int(volume) <= limits[1] + slack:
+            return False
+        if page and page.isdigit() and int(page) > limits[3]:
+            return False
+        return True
+
+    def is_possible_hypothesis(self, hints, slack=0):
+        """
+        returns False if the bibstem, year, volume, and page the hypothesis is to query for cannot
+        go together, these being either in the hints, or in the bibcode hint, if not wildcards
+
+        :param hints:
+        :param slack: see is_possible
+        :return:
+        """
+        bibcode = hints.get('bibcode', '')
+        if len(bibcode) == 19:
+            if '?' in bibcode[4:9]:
+                return True
+            bibstem, year, volume, page = get_bibcode_numbers(bibcode)
+            return self.is_possible(bibstem, year, str(volume) if volume else None, str(page) if page else None, slack)
+        bibstem = hints.get('bibstem', '')
+        if not bibstem or '*' in bibstem:
+            return True
+        return self.is_possible(bibstem, hints.get('year'), hints.get('volume'), hints.get('page'), slack)
+
+
+def get_volume_ranges():
+    """
+    returns the table of volume ranges if one is loaded, None otherwise
+
+    :return:
+    """
+    return current_app.extensions.get('volume_ranges', None)
+
+
+def prune_impossible_hypotheses(hypotheses, context):
+    """
+    filters out the hypotheses the table of volume ranges rules out
+
+    :param hypotheses: iterable of Hypothesis objects
+    :param context: ScoringContext, with the slack of the volume ranges
+    :return:
+    """
+    volume_ranges = get_volume_ranges()
+    for hypothesis in hypotheses:
+        if volume_ranges is not None and not volume_ranges.is_possible_hypothesis(hypothesis.hints, context.volume_ranges_slack):
+            current_app.logger.debug("Hypothesis %s pruned, no such volume in %s" % (hypothesis.name, hypothesis.hints))
+            METRICS.incr('resolver.volume_ranges.pruned')
+            continue
+        yield hypothesis
+
+
+def create_volume_ranges():
+    """
+    rebuild the table of volume ranges from the bibcode list, save it, and start using it
+
+    :return: the stats of the new table
+    """
+    try:
+        start_time = time.time()
+        ranges_file = current_app.config['REFERENCE_SERVICE_VOLUME_RANGES']
+        bibcode_list = current_app.config['REFERENCE_SERVICE_BIBCODE_LIST']
+        if not ranges_file or not bibcode_list:
+            raise ValueError('REFERENCE_SERVICE_VOLUME_RANGES and REFERENCE_SERVICE_BIBCODE_LIST need to be configured')
+        with open(bibcode_list, 'r') as f:
+            volume_ranges = VolumeRanges.from_bibcodes(f)
+        volume_ranges.save(ranges_file)
+        current_app.logger.info("saved volume ranges of %d bibstems and years in %s." % (len(volume_ranges), ranges_file))
+        current_app.logger.debug("volume ranges built in %s ms" % ((time.time() - start_time) * 1000))
+        current_app.extensions['volume_ranges'] = volume_ranges
+        return {'source': bibcode_list, 'count': len(volume_ranges)}
+    except Exception as e:
+        current_app.logger.error('Exception: %s' % (str(e)))
+        current_app.logger.error(traceback.format_exc())
+        raise e
+
+
+def load_volume_ranges():
+    """
+    load the table of volume ranges if one has been configured
+
+    :return: VolumeRanges object, or None if there is no table
+    """
+    ranges_file = current_app.config.get('REFERENCE_SERVICE_VOLUME_RANGES', None)
+    if not ranges_file:
+        return None
+    try:
+        start_time = time.time()
+        with open(ranges_file, 'r') as f:
+            volume_ranges = VolumeRanges(json.load(f))
+        current_app.logger.info("loaded volume ranges from %s of %d bibstems and years in %s ms." % (
+            ranges_file, len(volume_ranges), (time.time() - start_time) * 1000))
+        return volume_ranges
+    except Exception as e:
+        current_app.logger.error('Exception: %s' % (str(e)))
+        current_app.logger.error(traceback.format_exc())
+        return None
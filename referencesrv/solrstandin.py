@@ -0,0 +1,558 @@
+"""
+A local stand-in for the solr search endpoint, for offline benchmarking and load tests.
+
+It serves responses recorded from the real endpoint, keyed by the query, and answers
+queries it has no recording for with synthetic results. Latency and errors are
+injected following configurable distributions, so that throughput and tail latency
+of the service can be measured without network access.
+
+To record responses, run it with an upstream url, then all queries not yet recorded
+are forwarded to upstream and the responses saved to the recordings file.
+
+To use it, point the service to it in local_config.py, ie
+
+    REFERENCE_SERVICE_SOLRQUERY_URL = "http://localhost:9983/v1/search/query"
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import zlib
+
+from collections import OrderedDict
+
+import regex as re
+import requests
+
+from flask import Flask, request, Response, current_app
+from werkzeug.serving import run_simple
+
+
+DEFAULT_CONFIG = {
+    # json lines file of {"key": <query key>, "response": <solr response>}
+    'SOLR_STANDIN_RECORDINGS': None,
+    # if set, queries not recorded are forwarded here, and the responses recorded
+    'SOLR_STANDIN_UPSTREAM_URL': None,
+    # number of synthetic docs returned for queries not recorded, fixed or [min, max]
+    'SOLR_STANDIN_SYNTHETIC_NUM_FOUND': [0, 5],
+    # latency distribution in ms, one of fixed, uniform, normal, lognormal, exponential, or recorded
+    # recorded uses QTime of the response, and falls back to fixed for synthetic responses
+    'SOLR_STANDIN_LATENCY': {'distribution': 'fixed', 'ms': 0},
+    # fraction of queries answered with an error, and what status code to return
+    'SOLR_STANDIN_ERROR_RATE': 0.0,
+    'SOLR_STANDIN_ERROR_STATUS': 503,
+    # seed for the latency and error generator, None for random
+    'SOLR_STANDIN_SEED': None,
+    # optional cost model added to the latency, a cost for each clause of the query, and for each filter query,
+    # depending on whether it is in the filter cache, ie,
+    # {"q_ms": 2.0, "fq_miss_ms": 2.0, "fq_hit_ms": 0.1, "filter_cache_size": 512}
+    'SOLR_STANDIN_CLAUSE_COST': None,
+}
+
+YEAR_EXACT = re.compile(r'year:"?(\d{4})"?')
+YEAR_RANGE = re.compile(r'year:\[(\d{4}) TO (\d{4})\]')
+BIBSTEM = re.compile(r'bibstem:\(?"?([A-Za-z&.]+)')
+VOLUME = re.compile(r'volume:"([^"]+)"')
+PAGE = re.compile(r'page:\(?"([^"?]+)"')
+AUTHORS = re.compile(r'"\^?([^",^]+), ([A-Z])"')
+# the query of a lookup by bibcode, as the second phase of two-phase querying sends it
+BIBCODE_LOOKUP = re.compile(r'^bibcode:\((.*)\)$')
+QUOTED = re.compile(r'"([^"]+)"')
+# the [fields name=count] limits of the fl parameter
+FIELD_LIMITS = re.compile(r'\[fields ([^\]]+)\]')
+
+# number of synthetic docs kept by bibcode, so that a lookup returns the doc a query returned
+SYNTHETIC_DOCS_SIZE = 100000
+
+
+def get_search_key(params):
+    """
+    returns the query and filter queries, which the records found depend on
+
+    :param params: request parameters
+    :return:
+    """
+    key = params.get('q', '')
+    filters = sorted(params.getlist('fq')) if hasattr(params, 'getlist') else sorted(params.get('fq', []))
+    for fq in filters:
+        key += ' fq:%s' % fq
+    return key
+
+
+def get_query_key(params):
+    """
+    returns the key responses are recorded under, the search key with the fields and the rows asked for,
+    so that the probe of two-phase querying and the full query of the same search are recorded apart
+
+    :param params: request parameters
+    :return:
+    """
+    key = get_search_key(params)
+    for name in ('fl', 'rows', 'start'):
+        if params.get(name, None) is not None:
+            key += ' %s:%s' % (name, params.get(name))
+    return key
+
+
+class Recordings(object):
+    """
+    responses keyed by query, appended to the recordings file when in recorder mode
+    """
+    def __init__(self, filename=None):
+        """
+
+        :param filename:
+        """
+        self.filename = filename
+        self.responses = {}
+        self.lock = threading.Lock()
+        if filename and os.path.exists(filename):
+            with open(filename, 'r') as f:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        recording = json.loads(line)
+                        self.responses[recording['key']] = recording['response']
+
+    def get(self, key):
+        """
+
+        :param key:
+        :return:
+        """
+        return self.responses.get(key, None)
+
+    def add(self, key, response):
+        """
+
+        :param key:
+        :param response:
+        :return:
+        """
+        with self.lock:
+            self.responses[key] = response
+            if self.filename:
+                with open(self.filename, 'a') as f:
+                    f.write(json.dumps({'key': key, 'response': response}) + '\n')
+
+
+class FilterCache(object):
+    """
+    the filter queries seen, least recently used are evicted, to model the solr filter cache
+    """
+    def __init__(self, size):
+        """
+
+        :param size:
+        """
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def lookup(self, fq):
+        """
+        returns True if the filter query is cached, and caches it if not
+
+        :param fq:
+        :return:
+        """
+        with self.lock:
+            if fq in self.entries:
+                self.entries.move_to_end(fq)
+                return True
+            self.entries[fq] = True
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+            return False
+
+    def clear(self):
+        """
+
+        :return:
+        """
+        with self.lock:
+            self.entries.clear()
+
+
+class Stats(object):
+    """
+    counts of what was served, and the latencies injected, to compare backend latency between runs
+    """
+    def __init__(self):
+        """
+
+        """
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+
+        :return:
+        """
+        with self.lock:
+            self.counts = {'recorded': 0, 'upstream': 0, 'synthetic': 0, 'error': 0}
+            self.filter_cache = {'hits': 0, 'misses': 0}
+            self.latencies = []
+
+    def add(self, source, latency):
+        """
+
+        :param source: one of recorded, upstream, synthetic, or error
+        :param latency: in ms
+        :return:
+        """
+        with self.lock:
+            self.counts[source] += 1
+            self.latencies.append(latency)
+
+    def add_filter_cache(self, hits, misses):
+        """
+
+        :param hits:
+        :param misses:
+        :return:
+        """
+        with self.lock:
+            self.filter_cache['hits'] += hits
+            self.filter_cache['misses'] += misses
+
+    def get(self):
+        """
+
+        :return:
+        """
+        with self.lock:
+            latencies = sorted(self.latencies)
+            counts = dict(self.counts)
+            filter_cache = dict(self.filter_cache)
+        result = {'counts': counts, 'filter_cache': filter_cache, 'queries': len(latencies), 'latency_ms': {}}
+        if latencies:
+            result['latency_ms'] = {
+                'total': round(sum(latencies), 1),
+                'mean': round(sum(latencies) / len(latencies), 1),
+                'p50': get_percentile(latencies, 50),
+                'p95': get_percentile(latencies, 95),
+                'p99': get_percentile(latencies, 99),
+                'max': latencies[-1],
+            }
+        return result
+
+
+def get_percentile(sorted_values, percentile):
+    """
+    nearest rank percentile of an already sorted list
+
+    :param sorted_values:
+    :param percentile:
+    :return:
+    """
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, int(round(percentile / 100.0 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def get_latency(rng, latency_config, recorded_ms=None):
+    """
+    returns number of ms to delay the response
+
+    :param rng: random.Random object
+    :param latency_config: dict with distribution and its parameters
+    :param recorded_ms: QTime of a recorded response, if any
+    :return:
+    """
+    distribution = latency_config.get('distribution', 'fixed')
+    if distribution == 'recorded' and recorded_ms is not None:
+        return float(recorded_ms)
+    if distribution == 'uniform':
+        return rng.uniform(latency_config.get('min_ms', 0), latency_config.get('max_ms', 100))
+    if distribution == 'normal':
+        return max(0.0, rng.gauss(latency_config.get('mean_ms', 50), latency_config.get('sigma_ms', 10)))
+    if distribution == 'lognormal':
+        # parameters of the underlying normal distribution of log(ms)
+        return rng.lognormvariate(latency_config.get('mu', 3.5), latency_config.get('sigma', 0.5))
+    if distribution == 'exponential':
+        return rng.expovariate(1.0 / latency_config.get('mean_ms', 50))
+    return float(latency_config.get('ms', 0))
+
+
+def get_clause_cost(params, clause_cost, filter_cache):
+    """
+    returns the ms the clauses of the query and the filter queries add to the latency, and the filter cache hits and misses
+
+    The clauses of the query are evaluated for every query, while a filter query is evaluated only if not in the filter cache.
+
+    :param params: request parameters
+    :param clause_cost: see SOLR_STANDIN_CLAUSE_COST
+    :param filter_cache: FilterCache object
+    :return:
+    """
+    query = params.get('q', '')
+    num_clauses = 0 if query in ('', '*:*') else query.count(' AND ') + 1
+    filters = params.getlist('fq') if hasattr(params, 'getlist') else params.get('fq', [])
+    hits = sum(1 for fq in filters if filter_cache.lookup(fq))
+    misses = len(filters) - hits
+    cost = num_clauses * clause_cost.get('q_ms', 0) + \
+           hits * clause_cost.get('fq_hit_ms', 0) + misses * clause_cost.get('fq_miss_ms', 0)
+    return cost, hits, misses
+
+
+def make_synthetic_doc(rng, i, year, bibstem, volume, page, authors):
+    """
+    returns a made up doc with the given fields, and the other fields random
+
+    :param rng:
+    :param i: position of the doc in the response
+    :param year:
+    :param bibstem:
+    :param volume:
+    :param page:
+    :param authors: the authors to start the author list with, possibly none
+    :return:
+    """
+    doc_authors = authors + ['Synthetic%d, %s.' % (rng.randint(0, 9999), chr(rng.randint(65, 90)))
+                             for _ in range(rng.randint(0, 5))]
+    if not doc_authors:
+        doc_authors = ['Synthetic%d, A.' % rng.randint(0, 9999)]
+    bibcode = '%s%s%s%s%s' % (year, bibstem[:5].ljust(5, '.'), volume[:4].rjust(4, '.'),
+                              '.', page[:4].rjust(4, '.')) + doc_authors[0][0]
+    return {
+        'bibcode': bibcode,
+        'scix_id': 'scix:%04X-%04X-%04X' % (rng.randint(0, 0xffff), rng.randint(0, 0xffff), rng.randint(0, 0xffff)),
+        'author': doc_authors,
+        'author_norm': ['%s, %s' % (a.split(',')[0], a.split(',')[1].strip()[0]) for a in doc_authors],
+        'first_author_norm': '%s, %s' % (doc_authors[0].split(',')[0], doc_authors[0].split(',')[1].strip()[0]),
+        'year': year,
+        'title': ['Synthetic record %d for benchmarking' % i],
+        'pub': bibstem,
+        'pub_raw': '%s, Volume %s, p. %s' % (bibstem, volume, page),
+        'volume': volume,
+        'page': [page],
+        'bibstem': [bibstem],
+        'identifier': [bibcode],
+        'doctype': 'article',
+        'aff_raw': ['-'],
+    }
+
+
+def make_doc_for_bibcode(bibcode):
+    """
+    returns a made up doc for a bibcode that no query returned, with the fields the bibcode tells
+
+    :param bibcode:
+    :return:
+    """
+    rng = random.Random(zlib.crc32(bibcode.encode('utf-8')))
+    initial = bibcode[18:19].upper() if bibcode[18:19].isalpha() else 'A'
+    doc = make_synthetic_doc(rng, 0, bibcode[:4], bibcode[4:9].strip('.') or 'ApJ', bibcode[9:13].strip('.') or '1',
+                             bibcode[14:18].strip('.') or '1', ['%sSynthetic%d, A.' % (initial, rng.randint(0, 9999))])
+    doc['bibcode'] = bibcode
+    doc['identifier'] = [bibcode]
+    return doc
+
+
+def select_fields(doc, fields):
+    """
+    returns doc with only the fields of a solr fl parameter, and at most as many values as the [fields] limits give
+
+    :param doc:
+    :param fields: ie, bibcode,author,[fields author=10], all fields if empty or *
+    :return:
+    """
+    names = [name.strip() for name in FIELD_LIMITS.sub(',', fields or '').split(',') if name.strip()]
+    if not names or '*' in names:
+        return doc
+    limits = {}
+    for field_limits in FIELD_LIMITS.findall(fields):
+        for field_limit in field_limits.split(','):
+            name, count = field_limit.split('=')
+            limits[name.strip()] = int(count)
+    selected = {}
+    for name in names:
+        if name in doc:
+            value = doc[name]
+            selected[name] = value[:limits[name]] if name in limits and isinstance(value, list) else value
+    return selected
+
+
+def get_synthetic_response(query_key, params, num_found_config, synthetic_docs=None):
+    """
+    returns a solr response with made up docs, consistent with the fields constrained in the query,
+    and with only the fields asked for in fl
+
+    The docs are deterministic for a query, so that repeated runs see the same candidates. The docs returned
+    are kept in synthetic_docs, if given, so that a lookup of their bibcodes, as the second phase of two-phase
+    querying sends it, returns them, a bibcode not returned before gets a doc made up from the bibcode.
+
+    :param query_key: see get_search_key
+    :param params:
+    :param num_found_config: fixed number of docs or [min, max]
+    :param synthetic_docs: OrderedDict of the docs returned so far by bibcode
+    :return:
+    """
+    match = BIBCODE_LOOKUP.match(params.get('q', ''))
+    if match:
+        docs = []
+        for bibcode in QUOTED.findall(match.group(1)):
+            doc = synthetic_docs.get(bibcode) if synthetic_docs is not None else None
+            docs.append(doc or make_doc_for_bibcode(bibcode))
+        docs = [select_fields(doc, params.get('fl')) for doc in docs]
+        return {'responseHeader': {'status': 0, 'QTime': 0, 'params': dict(params)},
+                'response': {'numFound': len(docs), 'start': 0, 'docs': docs}}
+
+    rng = random.Random(zlib.crc32(query_key.encode('utf-8')))
+    if isinstance(num_found_config, (list, tuple)):
+        num_found = rng.randint(num_found_config[0], num_found_config[1])
+    else:
+        num_found = int(num_found_config)
+    rows = int(params.get('rows', 100))
+
+    match = YEAR_EXACT.search(query_key)
+    if match:
+        years = [int(match.group(1))] * 2
+    else:
+        match = YEAR_RANGE.search(query_key)
+        years = [int(match.group(1)), int(match.group(2))] if match else [1990, 2020]
+    match = BIBSTEM.search(query_key)
+    bibstem = match.group(1).strip('*') if match else 'ApJ'
+    match = VOLUME.search(query_key)
+    volume = match.group(1) if match else None
+    match = PAGE.search(query_key)
+    page = match.group(1) if match else None
+    authors = ['%s, %s.' % (last, first) for last, first in AUTHORS.findall(query_key)]
+
+    docs = []
+    for i in range(min(num_found, rows)):
+        year = str(rng.randint(years[0], years[1]))
+        doc_volume = volume or str(rng.randint(1, 999))
+        doc_page = page or str(rng.randint(1, 2000))
+        doc = make_synthetic_doc(rng, i, year, bibstem, doc_volume, doc_page, list(authors))
+        if synthetic_docs is not None:
+            synthetic_docs[doc['bibcode']] = doc
+            while len(synthetic_docs) > SYNTHETIC_DOCS_SIZE:
+                synthetic_docs.popitem(last=False)
+        docs.append(select_fields(doc, params.get('fl')))
+    return {'responseHeader': {'status': 0, 'QTime': 0, 'params': dict(params)},
+            'response': {'numFound': num_found, 'start': 0, 'docs': docs}}
+
+
+def create_app(**config):
+    """
+    create the stand-in application
+
+    :param config: overrides of DEFAULT_CONFIG
+    :return: flask.Flask application
+    """
+    app = Flask(__name__, static_folder=None)
+    app.config.update(DEFAULT_CONFIG)
+    app.config.update(config)
+
+    app.extensions['recordings'] = Recordings(app.config['SOLR_STANDIN_RECORDINGS'])
+    app.extensions['stats'] = Stats()
+    app.extensions['rng'] = random.Random(app.config['SOLR_STANDIN_SEED'])
+    app.extensions['rng_lock'] = threading.Lock()
+    app.extensions['synthetic_docs'] = OrderedDict()
+    app.extensions['filter_cache'] = FilterCache((app.config['SOLR_STANDIN_CLAUSE_COST'] or {}).get('filter_cache_size', 512))
+
+    app.add_url_rule('/v1/search/query', 'query', query, methods=['GET', 'POST'])
+    app.add_url_rule('/stats', 'stats', stats, methods=['GET', 'DELETE'])
+    return app
+
+
+def query():
+    """
+    serves a query the way the solr endpoint would
+
+    :return:
+    """
+    params = request.values
+    key = get_query_key(params)
+
+    response = current_app.extensions['recordings'].get(key)
+    recorded_ms = response.get('responseHeader', {}).get('QTime', None) if response else None
+
+    with current_app.extensions['rng_lock']:
+        rng = current_app.extensions['rng']
+        is_error = rng.random() < current_app.config['SOLR_STANDIN_ERROR_RATE']
+        latency = get_latency(rng, current_app.config['SOLR_STANDIN_LATENCY'], recorded_ms)
+
+    source = 'recorded'
+    if is_error:
+        source = 'error'
+    elif response is None:
+        if current_app.config['SOLR_STANDIN_UPSTREAM_URL']:
+            source = 'upstream'
+            start_time = time.time()
+            r = requests.request(request.method, current_app.config['SOLR_STANDIN_UPSTREAM_URL'],
+                                 params=request.args, data=request.form, timeout=60,
+                                 headers={'Authorization': request.headers.get('Authorization', '')})
+            if r.status_code != 200:
+                return Response(r.text, status=r.status_code, content_type='application/json')
+            response = json.loads(r.text)
+            current_app.extensions['recordings'].add(key, response)
+            # upstream already took its time
+            latency = (time.time() - start_time) * 1000
+        else:
+            source = 'synthetic'
+            with current_app.extensions['rng_lock']:
+                response = get_synthetic_response(get_search_key(params), params, current_app.config['SOLR_STANDIN_SYNTHETIC_NUM_FOUND'],
+                                                  current_app.extensions['synthetic_docs'])
+
+    clause_cost = current_app.config['SOLR_STANDIN_CLAUSE_COST']
+    if clause_cost and source != 'upstream':
+        cost, hits, misses = get_clause_cost(params, clause_cost, current_app.extensions['filter_cache'])
+        latency += cost
+        current_app.extensions['stats'].add_filter_cache(hits, misses)
+
+    if source != 'upstream':
+        time.sleep(latency / 1000.0)
+    current_app.extensions['stats'].add(source, latency)
+
+    if is_error:
+        return Response(json.dumps({'error': 'injected error'}),
+                        status=current_app.config['SOLR_STANDIN_ERROR_STATUS'], content_type='application/json')
+    return Response(json.dumps(response), status=200, content_type='application/json')
+
+
+def stats():
+    """
+    GET returns the counts and latencies served so far, DELETE resets them, and empties the filter cache
+
+    :return:
+    """
+    if request.method == 'DELETE':
+        current_app.extensions['stats'].reset()
+        current_app.extensions['filter_cache'].clear()
+    return Response(json.dumps(current_app.extensions['stats'].get()), status=200, content_type='application/json')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local stand-in for the solr search endpoint')
+    parser.add_argument('-p', '--port', type=int, default=9983, help='port to listen on')
+    parser.add_argument('-r', '--recordings', help='json lines file of recorded responses')
+    parser.add_argument('-u', '--upstream', help='url of the real endpoint, to record responses of queries not yet recorded')
+    parser.add_argument('-c', '--config', help='json file with any of the SOLR_STANDIN_* settings')
+    parser.add_argument('-l', '--latency', help='latency distribution as json, ie {"distribution": "lognormal", "mu": 3.5, "sigma": 0.5}')
+    parser.add_argument('-e', '--error-rate', type=float, help='fraction of queries to answer with an error')
+    args = parser.parse_args()
+
+    config = {}
+    if args.config:
+        with open(args.config, 'r') as f:
+            config.update(json.load(f))
+    if args.recordings:
+        config['SOLR_STANDIN_RECORDINGS'] = args.recordings
+    if args.upstream:
+        config['SOLR_STANDIN_UPSTREAM_URL'] = args.upstream
+    if args.latency:
+        config['SOLR_STANDIN_LATENCY'] = json.loads(args.latency)
+    if args.error_rate is not None:
+        config['SOLR_STANDIN_ERROR_RATE'] = args.error_rate
+
+    run_simple('0.0.0.0', args.port, create_app(**config), threaded=True, use_reloader=False, use_debugger=False)
+    sys.exit(0)
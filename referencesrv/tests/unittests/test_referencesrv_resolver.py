@@ -4,30 +4,52 @@ project_home = os.path.abspath(os.path.join(os.path.dirname(__file__), '../../..
 if project_home not in sys.path:
     sys.path.insert(0, project_home)
 
+from flask import has_app_context
 from flask_testing import TestCase
 import unittest
+import tempfile
+import itertools
+import threading
+import json
+import time
+import mock
+import urllib.parse
 
 import regex as re
 
 import referencesrv.app as app
 from referencesrv.resolver.authors import get_author_pattern, get_authors, normalize_single_author, \
     normalize_author_list, get_first_author, get_first_author_last_name, count_matching_authors, \
-    add_author_evidence
+    add_author_evidence, get_distinctive_authors, get_reference_authors, get_misspelling_threshold
 from referencesrv.resolver.common import Evidences, NotResolved, Undecidable, NoSolution, DeferredSourceMatcher, \
-    SOURCE_MATCHER, Solution, Hypothesis
+    SOURCE_MATCHER, Solution, Hypothesis, Solr, EvidenceMemo, OverflowOrNone, ScoringContext, get_scoring_context
 from referencesrv.resolver.pytrigdict import get_trigrams, TrigIndex, Trigdict
 from referencesrv.resolver.sourcematchers import TrigdictSourceMatcher, SourceMatcher
-from referencesrv.resolver.scoring import get_score_for_reference_identifier, get_score_for_input_fields, \
+from referencesrv.resolver.scoring import get_score_for_reference_identifier, get_score_for_input_fields, get_score_upper_bound, \
+    get_score_upper_bounds, CandidateBatch, \
     get_score_for_reference_identifier, get_book_score_for_input_fields, get_thesis_score_for_input_fields
 from referencesrv.resolver.journalfield import get_best_bibstem_for, add_volume_evidence, clean_ads_page, \
     compute_page_delta, add_page_evidence, compute_pubstring_statistics, string_similarity, add_publication_evidence, \
-    has_word, has_thesis_indicators, cook_title_string
-from referencesrv.resolver.solve import make_solr_condition, inspect_doubtful_solutions, inspect_ambiguous_solutions, \
-    choose_solution, solve_reference
+    has_word, has_thesis_indicators, cook_title_string, normalize_words, cook_reference_pub, PubNormalizer, get_pub_normalizer, \
+    add_title_evidence
+from referencesrv.resolver.solve import make_solr_condition, make_solr_query, select_candidates, inspect_doubtful_solutions, inspect_ambiguous_solutions, \
+    choose_solution, solve_reference, solve_for_fields, get_refined_hints, solve_from_identifier_index
 from referencesrv.resolver.hypotheses import Hypotheses
-from referencesrv.resolver.solrquery import Querier
-from referencesrv.resolver.specialrules import iter_journal_specific_hypotheses, get_score_for_baas_match
+from referencesrv.resolver.solrquery import Querier, CircuitBreaker, get_resilience
+from referencesrv.resolver.specialrules import iter_journal_specific_hypotheses, get_score_for_baas_match, JOURNAL_RULES
 from referencesrv.resolver.sourcematchers import load_source_matcher
+from referencesrv.resolver.documentcache import DocumentCache
+from referencesrv.resolver.identifierindex import IdentifierIndex, build_identifier_index, get_index_keys
+from referencesrv.resolver.bibcodeindex import BibcodeIndex
+from referencesrv.resolver.volumeranges import VolumeRanges, load_volume_ranges
+from referencesrv.resolver.scoring import adjust_volume_when_identical_year
+from referencesrv.resolver.backends import LocalIndex, parse_query, get_field_limits
+from referencesrv.resolver.features import DocumentFeatures, get_document_features
+from referencesrv.resolver.similarity import tokenize_title, tokenize_pub, count_missing_prefixes, \
+    get_common_prefix_length, get_title_similarity
+from referencesrv.resolver.solrtestdata import get_test_data
+from referencesrv import solrstandin
+from referencesrv.metrics import METRICS
 
 
 class TestResolver(TestCase):
@@ -119,39 +141,95 @@ class TestResolver(TestCase):
         """
         Verifies that statistics returned on the authors matching between ref_authors and ads_authors is correct.
         """
-        self.assertEqual(count_matching_authors("Abraham, Z ; Iben, I", ['Abraham, Zulema', 'Iben, Icko, Jr.']),
+        self.assertEqual(count_matching_authors("Abraham, Z ; Iben, I", ['Abraham, Zulema', 'Iben, Icko, Jr.'], 100),
                          (0, 0, 2, False))
-        self.assertEqual(count_matching_authors("Iben, I; Abraham, Z", ['Abraham, Zulema', 'Iben, Icko, Jr.']),
+        self.assertEqual(count_matching_authors("Iben, I; Abraham, Z", ['Abraham, Zulema', 'Iben, Icko, Jr.'], 100),
                          (0, 0, 2, False))
-        self.assertEqual(count_matching_authors("Abraham, Z", ['Abraham, Zulema', 'Iben, Icko, Jr.']),
+        self.assertEqual(count_matching_authors("Abraham, Z", ['Abraham, Zulema', 'Iben, Icko, Jr.'], 100),
                          (1, 0, 1, False))
-        self.assertEqual(count_matching_authors("Abraham, Z, Noname", ['Abraham, Zulema', 'Iben, Icko, Jr.']),
+        self.assertEqual(count_matching_authors("Abraham, Z, Noname", ['Abraham, Zulema', 'Iben, Icko, Jr.'], 100),
                          (1, 1, 1, False))
-        self.assertEqual(count_matching_authors("Foobar, K.C.D., Noname", ['Abraham, Zulema', 'Iben, Icko, Jr.']),
+        self.assertEqual(count_matching_authors("Foobar, K.C.D., Noname", ['Abraham, Zulema', 'Iben, Icko, Jr.'], 100),
                          (2, 2, 0, True))
-        self.assertEqual(count_matching_authors("Z. Abraham, I. Iben", ['Abraham, Zulema', 'Iben, Icko, Jr.']),
+        self.assertEqual(count_matching_authors("Z. Abraham, I. Iben", ['Abraham, Zulema', 'Iben, Icko, Jr.'], 100),
                          (0, 0, 2, False))
         with self.assertRaises(Exception) as context:
-            count_matching_authors("Abraham, Z ; Iben, I", None)
+            count_matching_authors("Abraham, Z ; Iben, I", None, 100)
         self.assertTrue('ADS paper without authors -- what should we do?' in str(context.exception))
 
 
+    def test_count_matching_authors_of_collaboration(self):
+        """
+        test that matching author lists of collaboration size, with the last names grouped by length and bigrams,
+        counts the same as comparing every ADS author with every reference author did
+        """
+        syllables = ['ber', 'ca', 'dos', 'fer', 'li', 'mar', 'ros', 'tin', 'vas', 'wen']
+        last_names = [''.join(parts) for parts in itertools.product(syllables, repeat=3)][::3][:300]
+        ads_authors = ['%s, a' % last_name for last_name in last_names]
+        # the first thirty of the collaboration, every fifth misspelled
+        ref_authors = ', '.join('%s, A.' % (last_name.replace('a', 'o', 1) if i % 5 == 0 else last_name).capitalize()
+                                for i, last_name in enumerate(last_names[:30])) + ' et al.'
+        self.assertEqual(count_matching_authors(ref_authors, ads_authors, 100), (236, 0, 27, False))
+        # the same authors, but the first author not the same
+        other_authors = ads_authors[150:] + ads_authors[:150]
+        self.assertEqual(count_matching_authors(ref_authors, other_authors, 100, other_authors[0]), (236, 0, 27, True))
+
+        self.assertEqual(count_matching_authors("Smith, J., Smyth, K., Garcia Perez, L. and Jones, A.",
+                                                ['smith, j', 'smyth, k', 'garcia perez, l', 'jones, a', 'brown, b'], 100), (1, 1, 4, False))
+        self.assertEqual(count_matching_authors("Anderson, J. Jr., and Andersen, K.",
+                                                ['anderson, j', 'andersen, k', 'andersson, l'], 100), (0, 2, 2, False))
+
+        reference_authors = get_reference_authors(ref_authors, 100)
+        self.assertEqual(reference_authors.get_misspelled('bercamar'), 'bercomar')
+        self.assertEqual(reference_authors.get_misspelled('wenwenwen'), None)
+        self.assertEqual([get_misspelling_threshold(n) for n in [3, 4, 7, 10, 14]], [0, 1, 2, 2, 4])
+        # the reference author string is tokenized once
+        self.assertIs(get_reference_authors(ref_authors, 100), reference_authors)
+
+
+    def test_memoized_author_normalization(self):
+        """
+        test that normalizing the same author string again is taken from the cache, and counted
+        """
+        author_string = 'Memoized, A., Cached, B., and Counted, C.'
+        METRICS.reset()
+        normalize_author_list.cache_clear()
+        normalized = normalize_author_list(author_string)
+        self.assertEqual(normalized, 'Memoized, A; Cached, B; Counted, C')
+        self.assertEqual(normalize_author_list(author_string), normalized)
+        self.assertEqual(normalize_author_list(author_string, initials=False), 'Memoized; Cached; Counted')
+        metrics = METRICS.get()
+        self.assertEqual((metrics['authors.normalized.hits'], metrics['authors.normalized.misses']), (1, 2))
+
+        self.assertIs(get_author_pattern(author_string), get_author_pattern(author_string))
+        self.assertEqual(get_first_author(author_string), 'Memoized')
+        self.assertEqual(get_first_author(author_string), 'Memoized')
+        self.assertEqual(METRICS.get()['authors.first_author.hits'], 1)
+
+        # exceptions are not kept
+        with mock.patch('referencesrv.resolver.authors.get_author_pattern', return_value=None):
+            for _ in range(2):
+                with self.assertRaises(Undecidable):
+                    get_first_author('Undecided, U.')
+        self.assertEqual(METRICS.get()['authors.first_author.misses'], 3)
+
+
     def test_add_author_evidence(self):
         """
         Test adding an evidence for ref_authors matching ads_authors.
         """
         # one author match
-        evidences = Evidences()
+        evidences = Evidences(get_scoring_context())
         add_author_evidence(evidences, 'Lefkimmiatis, S.', ['lefkimmiatis, s', 'unser, m'], 'lefkimmiatis, s', False)
         self.assertEqual(evidences['authors'], 0.5)
 
         # first author missing
-        evidences = Evidences()
+        evidences = Evidences(get_scoring_context())
         add_author_evidence(evidences, 'Lefkimmiatis, S.', ['lefkimmiatis, s', 'unser, m'], 'Foo', False)
         self.assertEqual(evidences['authors'], 0.15)
 
         # has etal
-        evidences = Evidences()
+        evidences = Evidences(get_scoring_context())
         add_author_evidence(evidences, 'L.Zhong', ['zheng, m', 'chen, w', 'zhang, x', 'liu, x', 'wu, q', 'yu, j'], 'zheng, m', True)
         self.assertEqual(evidences['authors'], 0)
 
@@ -309,9 +387,9 @@ class TestResolver(TestCase):
         """
         test the Evidences class
         """
-        e1 = Evidences()
+        e1 = Evidences(get_scoring_context())
         e1.add_evidence(1, 'bibcode')
-        e2 = Evidences()
+        e2 = Evidences(get_scoring_context())
         e2.add_evidence(0, 'bibcode')
         self.assertEqual(e1 < e2, False)
         self.assertEqual(e1 < None, False)
@@ -328,7 +406,7 @@ class TestResolver(TestCase):
         e2.add_evidence(1, 'year')
         e2.add_evidence(0.5, 'author')
         self.assertEqual(e2.sum(), 1.5)
-        e3 = Evidences()
+        e3 = Evidences(get_scoring_context())
         self.assertEqual(e3.get_score(), 0)
         self.assertEqual(e3.has_veto(), False)
         e3.add_evidence(0, 'bibcode')
@@ -337,7 +415,7 @@ class TestResolver(TestCase):
         e3.add_evidence(0, 'year')
         self.assertEqual(e3.single_veto_from('bibcode'), False)
         self.assertEqual(e3.count_votes(), False)
-        e4 = Evidences()
+        e4 = Evidences(get_scoring_context())
         e4.add_evidence(1, 'authors')
         e4.add_evidence(1, 'year')
         e4.add_evidence(1, 'page')
@@ -348,13 +426,17 @@ class TestResolver(TestCase):
         self.assertEqual(e4['year'], 1)
         self.assertEqual(e1['year'], None)
         self.assertEqual(e1['authors'], None)
+        # the last evidence of a label, also when added from other evidences
+        e1 += e4
+        e1.add_evidence(0.5, 'year')
+        self.assertEqual((e1['authors'], e1['year'], e1['bibcode']), (1, 0.5, 1))
 
 
     def test_Solution(self):
         """
         test Solution class
         """
-        e = Evidences()
+        e = Evidences(get_scoring_context())
         e.add_evidence(1, 'bibcode')
         s = Solution(cited_bibcode='2013SPIE.8004.2013Z', scix_id='foo', score=e)
         self.assertEqual(str(s), '1.0 bibcode:2013SPIE.8004.2013Z scixid:foo')
@@ -405,6 +487,53 @@ class TestResolver(TestCase):
         self.assertEqual(make_solr_condition("bibstem", "JOSAA"), 'bibstem:(JOSAA)')
         self.assertEqual(make_solr_condition("year", "1992"), 'year:"1992"')
         self.assertEqual(make_solr_condition("year~", "1992"), 'year:[1987 TO 1997]')
+        self.assertEqual(make_solr_condition("year~", "1991 TO 1993"), 'year:[1991 TO 1993]')
+
+
+    def test_get_distinctive_authors(self):
+        """
+        test that the authors queried are the first author and the ones with the longest last names
+        """
+        authors = ['Aad, G', 'Abbott, B', 'Abdallah, J', 'Abdinov, O', 'Ye, S', 'Aben, R', 'Abolins, M']
+        self.assertEqual(get_distinctive_authors(authors, 3), ['Aad, G', 'Abdallah, J', 'Abdinov, O'])
+        self.assertEqual(get_distinctive_authors(authors, 10), authors)
+        self.current_app.config['REFERENCE_SERVICE_QUERY_AUTHORS_MAX'] = 2
+        self.assertEqual(make_solr_condition("author", "Aad, G; Abbott, B; Abdallah, J"), 'author:("Aad, G" AND "Abdallah, J")')
+
+
+    def test_year_windows(self):
+        """
+        test that the approximate year hypotheses go from the narrowest to the widest year window
+        """
+        ref = {'authors': 'Accomazzi, A.', 'year': '2019'}
+        get_windows = lambda hypotheses: [(hypothesis.name, hypothesis.hints['year~']) for hypothesis in hypotheses.iter_hypotheses(get_scoring_context())
+                                          if hypothesis.get_detail('year_window')]
+        # with no evidence of the year, the widest window, which is counted in the metrics too
+        self.assertEqual(get_windows(Hypotheses(ref)), [('fielded-author/year~', '2014 TO 2024')])
+        self.assertEqual(make_solr_condition('year~', '2014 TO 2024'), 'year:[2014 TO 2024]')
+        METRICS.reset()
+        with mock.patch('referencesrv.resolver.solve.solve_for_fields', side_effect=NoSolution('no solution', ref)):
+            with self.assertRaises(NoSolution):
+                solve_reference(Hypotheses(dict(ref, volume='233', page='207.04')))
+        self.assertEqual((METRICS.get()['resolver.year_window.5.tried'], METRICS.get().get('resolver.year_window.5.resolved', 0)), (1, 0))
+
+        # the year of the citing paper caps the windows, and the narrower is tried first
+        self.assertEqual(get_windows(Hypotheses(ref, citing_year=2019)),
+                         [('fielded-author/year~1', '2018 TO 2020'), ('fielded-author/year~5', '2014 TO 2020')])
+        self.assertEqual(get_windows(Hypotheses(ref, citing_year=2012)), [])
+
+        # the table of volume ranges narrows the window to the years of the volume, or moves it onto them
+        self.current_app.extensions['volume_ranges'] = VolumeRanges({'ApJ': {'2018': [852, 869, 1, 300], '2019': [870, 887, 1, 300]}})
+        with mock.patch('referencesrv.resolver.hypotheses.get_best_bibstem_for', return_value='ApJ'):
+            for year, volume, windows in [('2019', '852', [('fielded-author/year~1', '2018 TO 2018'), ('fielded-author/year~5', '2014 TO 2024')]),
+                                          ('2016', '880', [('fielded-author/year~1', '2019 TO 2019'), ('fielded-author/year~5', '2011 TO 2021')]),
+                                          ('2019', '999', [('fielded-author/year~', '2014 TO 2024')])]:
+                reference = dict(ref, journal='ApJ', volume=volume, year=year)
+                self.assertEqual(get_windows(Hypotheses(reference)), windows)
+
+        # with no windows configured, the 10 year window
+        self.current_app.config['REFERENCE_SERVICE_YEAR_WINDOWS'] = []
+        self.assertEqual(get_windows(Hypotheses(ref, citing_year=2019)), [('fielded-author/year~', '2014 TO 2020')])
 
 
     def test_solve_reference(self):
@@ -457,38 +586,452 @@ class TestResolver(TestCase):
         self.assertEqual(str(solve_reference(Hypotheses(ref))), '0.8 bibcode:2019AAS...23320704A scixid:scix:6ANE-YQXJ-KRH0')
 
 
+    def test_explain(self):
+        """
+        test the trace of a resolution returned by the explain endpoint
+        """
+        ref = {'authors': 'Accomazzi, A.',
+               'journal': 'AAS233 Meeting',
+               'volume': '233',
+               'year': '2019',
+               'page': '381.08'}
+        r = self.client.post(path='/explain', data=json.dumps({'parsed_reference': ref}))
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.json['parsed'], ref)
+        self.assertEqual(r.json['result']['resolved'], '0.8 bibcode:2019AAS...23338108A scixid:scix:AGA3-9D3P-Y7EF')
+        hypotheses = r.json['hypotheses']
+        # only the last hypothesis is accepted, the ones before are rejected with a reason
+        self.assertEqual(hypotheses[-1]['outcome'], 'accepted')
+        self.assertEqual(hypotheses[-1]['name'], r.json['result']['hypothesis'])
+        self.assertTrue(all(hypothesis['outcome'] != 'accepted' and hypothesis['reason'] for hypothesis in hypotheses[:-1]))
+        self.assertTrue(all(hypothesis['num_found'] == 2 for hypothesis in hypotheses))
+        self.assertEqual(hypotheses[-1]['query'], 'identifier:"2019?????.23338108?"')
+        self.assertEqual([candidate['bibcode'] for candidate in hypotheses[-1]['candidates']][-1], '2019AAS...23338108A')
+
+        r = self.client.post(path='/explain', data=json.dumps({'parsed_reference': [ref, ref]}))
+        self.assertEqual(r.status_code, 400)
+
+
+    def test_query_budget(self):
+        """
+        test that the resolution stops once the reference has used up its query budget
+        """
+        # the first hypothesis is rejected, and the second one is accepted
+        ref = {'authors': 'Accomazzi, A.',
+               'journal': 'AAS233 Meeting',
+               'volume': '233',
+               'year': '2019',
+               'page': '381.08'}
+        self.current_app.config['REFERENCE_SERVICE_QUERY_BUDGET_QUERIES'] = 2
+        self.assertEqual(str(solve_reference(Hypotheses(ref))), '0.8 bibcode:2019AAS...23338108A scixid:scix:AGA3-9D3P-Y7EF')
+
+        exceeded = METRICS.get().get('resolver.budget.exceeded', 0)
+        self.current_app.config['REFERENCE_SERVICE_QUERY_BUDGET_QUERIES'] = 1
+        with self.assertRaises(NoSolution) as context:
+            solve_reference(Hypotheses(ref))
+        self.assertTrue(str(context.exception).startswith('Query budget exceeded (1 queries in'))
+        self.assertEqual(METRICS.get()['resolver.budget.exceeded'], exceeded + 1)
+
+
+    def test_overflow_refinement(self):
+        """
+        test that a query returning too many records is refined with the unused input fields
+        """
+        input_fields = {'author': 'Accomazzi, A.', 'year': '2019', 'volume': '233', 'page': '381.08', 'bibstem': 'AAS'}
+        self.assertEqual(get_refined_hints({'author': 'Accomazzi, A.', 'year~': '2018 TO 2020'}, input_fields),
+                         {'author': 'Accomazzi, A.', 'year~': '2018 TO 2020', 'volume': '233'})
+        self.assertEqual(get_refined_hints({'author': 'Accomazzi, A.', 'year~': '2018 TO 2020', 'volume': '233', 'page': '381.08', 'bibstem': 'AAS'}, input_fields),
+                         {'author': 'Accomazzi, A.', 'year': '2019', 'volume': '233', 'page': '381.08', 'bibstem': 'AAS'})
+        self.assertEqual(get_refined_hints(input_fields, input_fields), None)
+
+        # overflow unless the query has both volume and page
+        queries = []
+        query = Querier.query
+        def overflow(querier, query_string, filters=None):
+            queries.append(query_string)
+            if 'volume' in query_string and 'page' in query_string:
+                return query(querier, query_string, filters)
+            querier.num_found = self.current_app.config['REFERENCE_SERVICE_MAX_RECORDS_SOLR']
+            return None
+        hypothesis = Hypothesis("fielded-author/year", {'author': 'Accomazzi, A.', 'year': '2019'},
+                                get_score_for_input_fields, input_fields=input_fields,
+                                scoring_context=get_scoring_context())
+        recovered = METRICS.get().get('resolver.overflow.recovered', 0)
+        with mock.patch.object(Querier, 'query', overflow):
+            self.assertEqual(str(solve_for_fields(hypothesis)), '0.8 bibcode:2019AAS...23338108A scixid:scix:AGA3-9D3P-Y7EF')
+            self.assertEqual(len(queries), 3)
+            self.assertEqual(METRICS.get()['resolver.overflow.recovered'], recovered + 1)
+
+            # no more refinements allowed
+            self.current_app.config['REFERENCE_SERVICE_OVERFLOW_REFINEMENTS'] = 1
+            with self.assertRaises(OverflowOrNone):
+                solve_for_fields(hypothesis)
+            self.assertEqual(len(queries), 5)
+
+
+    def test_bibcode_index(self):
+        """
+        test that wildcard bibcodes are matched in the bibcode index, and looked up exactly in solr
+        """
+        bibcode_index = BibcodeIndex(['2019AAS...23338108A\n', '2019AAS...23320704A\n', '2019ApJ...870...12A\n', 'not a bibcode\n'])
+        self.assertEqual(len(bibcode_index), 3)
+        self.assertEqual(bibcode_index.match('2019AAS...233?????A'), ['2019AAS...23320704A', '2019AAS...23338108A'])
+        self.assertEqual(bibcode_index.match('2019?????.23338108?'), ['2019AAS...23338108A'])
+        self.assertEqual(bibcode_index.match('2019?????.233????8?'), None)
+        self.assertEqual(bibcode_index.match('2019?????.23300001?'), [])
+
+        queries = []
+        query = Querier.query
+        def capture(querier, query_string, filters=None):
+            queries.append(query_string)
+            return query(querier, query_string, filters)
+        self.current_app.extensions['bibcode_index'] = bibcode_index
+        hypothesis = Hypothesis("fielded-bibcode", {"bibcode": "2019?????.23338108?"}, get_score_for_input_fields,
+                                input_fields={'author': 'Accomazzi, A.', 'year': '2019', 'volume': '233', 'page': '381.08'},
+                                scoring_context=get_scoring_context())
+        with mock.patch.object(Querier, 'query', capture):
+            self.assertEqual(str(solve_for_fields(hypothesis)), '0.8 bibcode:2019AAS...23338108A scixid:scix:AGA3-9D3P-Y7EF')
+            self.assertEqual(queries, ['identifier:("2019AAS...23338108A")'])
+            # solr is not queried if no bibcode matches
+            hypothesis.hints['bibcode'] = '2019?????.23300001?'
+            with self.assertRaises(NoSolution):
+                solve_for_fields(hypothesis)
+            self.assertEqual(len(queries), 1)
+
+
+    def test_local_index(self):
+        """
+        test querying an embedded index of records instead of solr
+        """
+        self.assertEqual(parse_query('author:("Accomazzi, A" AND "Kurtz, M") AND year:[2018 TO 2020] AND doi:"10.1/a"~'),
+                         [('author', 'group', ['Accomazzi, A', 'Kurtz, M'], 'AND', False),
+                          ('year', 'range', ['2018', '2020'], 'AND', False),
+                          ('doi', 'phrase', ['10.1/a'], 'AND', True)])
+        # the publication is written unquoted, all of its words are the one condition
+        self.assertEqual(parse_query(make_solr_condition('pub', 'astronomical society') + ' AND year:2019'),
+                         [('pub', 'term', ['astronomical society'], 'AND', False),
+                          ('year', 'term', ['2019'], 'AND', False)])
+        self.assertEqual(get_field_limits('author,[fields author=10],year'), {'author': 10, 'year': None})
+
+        docs = get_test_data()['response']['docs']
+        for doc in docs:
+            doc['bibstem'] = ['AAS']
+        local_index = LocalIndex(docs)
+        self.assertEqual(local_index.search('author:("Accomazzi, A")', ['year:2019', 'bibstem:(AAS)'], 'bibcode')[0], 2)
+        self.assertEqual(local_index.search('author:("Accomazzi, A" AND "Kurtz, M") AND year:[* TO 2020]', fields='bibcode'),
+                         (1, [{'bibcode': '2019AAS...23338108A'}]))
+        self.assertEqual(local_index.search('first_author:"Acomazzi, A"~ AND page:("207.04" or "3?7.04")', fields='bibcode')[1],
+                         [{'bibcode': '2019AAS...23320704A'}])
+        self.assertEqual(local_index.search('identifier:"2019?????.23338108?"', fields='bibcode')[0], 1)
+        self.assertEqual(local_index.search('title:"ADS search" AND pub:"astronomical meeting"', fields='bibcode')[0], 1)
+        self.assertEqual(local_index.search('title:"ADS search" AND pub:astronomical meeting', fields='bibcode')[0], 1)
+        self.assertEqual(local_index.search('title:"ADS search" AND pub:astronomical journal', fields='bibcode')[0], 0)
+        self.assertEqual(local_index.search('author:("Kurtz, M") AND year:2018')[0], 0)
+        self.assertEqual(local_index.search('*:*', rows=1, fields='author,[fields author=2]')[1], [{'author': ['Accomazzi, Alberto']}])
+        self.assertEqual(len(local_index.search('author:("Kurtz, M")')[1][0]['author']), 10)
+        self.assertEqual(local_index.lookup(['2019AAS...23320704A', '2000ApJ...000....0X'], 'scix_id'), [{'scix_id': 'scix:6ANE-YQXJ-KRH0'}])
+        # bibcodes differing only in case are different records, DOIs are not case sensitive
+        cased_index = LocalIndex([{'bibcode': '2019A&A...1A', 'identifier': ['10.1051/0004-6361/201935000A']},
+                                  {'bibcode': '2019A&A...1a', 'identifier': []}])
+        self.assertEqual(cased_index.search('identifier:"2019A&A...1a"', fields='bibcode'), (1, [{'bibcode': '2019A&A...1a'}]))
+        self.assertEqual(cased_index.search('identifier:"2019A&A...1?"', fields='bibcode')[0], 2)
+        self.assertEqual(cased_index.search('identifier:"2019A&A....?"', fields='bibcode')[0], 0)
+        self.assertEqual(cased_index.search('identifier:"10.1051/0004-6361/201935000a"', fields='bibcode'),
+                         (1, [{'bibcode': '2019A&A...1A'}]))
+
+        self.current_app.config['REFERENCE_SERVICE_SEARCH_BACKEND'] = 'local'
+        self.current_app.extensions['local_index'] = LocalIndex(docs[:1])
+        self.assertEqual(Querier().backend, self.current_app.extensions['local_index'])
+        hypothesis = Hypothesis("fielded-author/year", {"author": "Accomazzi, A.", "year": "2019"}, get_score_for_input_fields,
+                                input_fields={'author': 'Accomazzi, A.', 'year': '2019', 'volume': '233', 'page': '207.04'},
+                                scoring_context=get_scoring_context())
+        self.assertEqual(str(solve_for_fields(hypothesis)), '1.0 bibcode:2019AAS...23320704A scixid:scix:6ANE-YQXJ-KRH0')
+
+
+    def test_volume_ranges(self):
+        """
+        test that the hypotheses with a volume the journal did not publish in the year are not queried
+        """
+        volume_ranges = VolumeRanges.from_bibcodes(['2019ApJ...870...12A\n', '2019ApJ...887..264B\n', '2019ApJ...882L..30C\n',
+                                                    '2018ApJ...852...10D\n', '2019PhRvD.100j3012E\n', '2019JPhCS1234a2001F\n',
+                                                    '2015ASPC..491...12G\n', '2015ASPC.2015...12G\n', '2019MNRAS.482.1234H\n'])
+        self.assertEqual(volume_ranges.ranges['ApJ'], {'2019': [870, 887, 12, 264], '2018': [852, 852, 10, 10]})
+        self.assertEqual(volume_ranges.get_volume_range('MNRAS', '2019'), (482, 482))
+        self.assertEqual([volume_ranges.get_volume_years('ApJ', volume, slack=1) for volume in ['880', '853', '900', '']],
+                         [(2019, 2019), (2018, 2018), None, None])
+        self.assertTrue(volume_ranges.is_possible('ApJ', '2019', '875', '100'))
+        self.assertTrue(volume_ranges.is_possible('ApJ', '2019', '888', 'L30', slack=1))
+        self.assertFalse(volume_ranges.is_possible('ApJ', '2019', '888', 'L30'))
+        self.assertFalse(volume_ranges.is_possible('ApJ', '2019', '852', slack=1))
+        self.assertFalse(volume_ranges.is_possible('ApJ', '2019', '870', '1000'))
+        self.assertFalse(volume_ranges.is_possible('ApJ', '2017'))
+        # not known, or possibly not complete yet
+        self.assertTrue(volume_ranges.is_possible('AJ', '2019', '1'))
+        self.assertTrue(volume_ranges.is_possible('ApJ', '2020', '1'))
+        self.assertFalse(volume_ranges.is_possible_hypothesis({'bibcode': '2019ApJ...852...10D'}))
+        self.assertTrue(volume_ranges.is_possible_hypothesis({'bibcode': '2019?????.852...10?'}))
+        self.assertTrue(volume_ranges.is_possible_hypothesis({'bibstem': 'PhRv*', 'year': '2019', 'volume': '1'}))
+
+        with tempfile.NamedTemporaryFile(suffix='.json') as ranges_file:
+            volume_ranges.save(ranges_file.name)
+            self.current_app.config['REFERENCE_SERVICE_VOLUME_RANGES'] = ranges_file.name
+            self.assertEqual(load_volume_ranges().ranges, volume_ranges.ranges)
+
+        self.current_app.extensions['volume_ranges'] = volume_ranges
+        reference = {'authors': 'Accomazzi, A.', 'journal': 'ApJ', 'volume': '852', 'page': '12', 'year': '2019',
+                     'refstr': 'Accomazzi, A. 2019, ApJ, 852, 12'}
+        with mock.patch('referencesrv.resolver.hypotheses.get_best_bibstem_for', return_value='ApJ'):
+            names = [hypothesis.name for hypothesis in Hypotheses(reference).iter_hypotheses(get_scoring_context())]
+        self.assertNotIn('fielded-no-author', names)
+        self.assertEqual(names.count('fielded-bibcode'), 1)
+        # no bibstem in the hints, or not in the table
+        self.assertIn('fielded-author/year/volume/page', names)
+        self.assertIn('extra-ApJ->ApJL', names)
+        self.assertEqual(METRICS.get()['resolver.volume_ranges.pruned'] > 0, True)
+
+        # the volumes of ASPC are numbered by year in 2015, even for the records with a volume of their own
+        hypothesis = Hypothesis("fielded-author/pub/year", {}, get_score_for_input_fields,
+                                input_fields={'author': 'Gaia', 'year': '2015', 'volume': '12', 'bibstem': 'ASPC'},
+                                scoring_context=get_scoring_context(), volume_ranges=volume_ranges)
+        result_record = {'bibcode': '2015ASPC..491...12G', 'year': '2015', 'volume': '491'}
+        self.assertEqual(adjust_volume_when_identical_year(result_record, hypothesis), hypothesis)
+        volume_ranges.ranges['ASPC']['2015'] = [2015, 2015, 12, 12]
+        self.assertEqual(adjust_volume_when_identical_year(result_record, hypothesis).hints['volume'], '2015')
+
+
+    def test_scoring_context(self):
+        """
+        test that the scoring thresholds and weights are frozen, and the context is rebuilt only when the config changes
+        """
+        context = get_scoring_context()
+        self.assertEqual(context.max_score, self.current_app.config['EVIDENCE_SCORE_RANGE'][1])
+        self.assertEqual(context.min_score_first_round, self.current_app.config['MIN_SCORE_FIRST_ROUND'])
+        with self.assertRaises(AttributeError):
+            context.max_score = 2
+        # while the config is the same, the context is not built again
+        with mock.patch.object(ScoringContext, '__init__', side_effect=AssertionError):
+            self.assertIs(get_scoring_context(), context)
+        self.current_app.config['MIN_SCORE_FIRST_ROUND'] = 0.5
+        self.assertEqual(get_scoring_context().min_score_first_round, 0.5)
+        self.current_app.config['REFERENCE_SERVICE_AUTHORS_COMPARED_MAX'] = 10
+        self.assertEqual(get_scoring_context().authors_compared_max, 10)
+
+        # evidences scored with a context of their own
+        config = dict(self.current_app.config, MISSING_VOLUME_FACTORY=0.5)
+        evidences = Evidences(ScoringContext(config))
+        add_volume_evidence(evidences, '12', '', None, 'Proceedings, Vol. 12')
+        self.assertEqual(evidences.evidences, [0.5])
+        hypothesis = Hypothesis("fielded-author/year", {}, get_score_for_input_fields, scoring_context=evidences.context)
+        self.assertIs(hypothesis.get_scoring_context(), evidences.context)
+        # the scoring is not done with the config of the app behind the back of the resolution
+        with self.assertRaises(ValueError):
+            Hypothesis("fielded-author/year", {}, get_score_for_input_fields).get_scoring_context()
+
+
+    def test_scoring_without_app(self):
+        """
+        test that a candidate is scored with what the scoring context carries, with no app context pushed
+        """
+        context = ScoringContext(dict(self.current_app.config))
+        record = {'bibcode': '2019ApJ...870...12S', 'doctype': 'article', 'year': '2019', 'volume': '870', 'page': '12',
+                  'author_norm': ['smith, j', 'jones, a'], 'first_author_norm': 'smith, j',
+                  'title': 'The Dust Mass of Galaxies', 'pub': 'The Astrophysical Journal',
+                  'pub_raw': 'The Astrophysical Journal, Volume 870, Issue 1, article id. 12'}
+        hypothesis = Hypothesis("fielded-author/year/volume/page", {}, get_score_for_input_fields,
+                                input_fields={'author': 'Smith, J., Jones, A.', 'year': '2019', 'volume': '870',
+                                              'page': '12', 'pub': 'ApJ'},
+                                scoring_context=context)
+        outcome = {}
+        def score():
+            try:
+                outcome['app'] = has_app_context()
+                evidences = get_score_for_input_fields(record, hypothesis)
+                outcome['score'] = evidences.get_score()
+                outcome['no evidence'] = Evidences(context).get_score()
+            except Exception as e:
+                outcome['error'] = e
+        # a new thread has no app context of its own
+        thread = threading.Thread(target=score)
+        thread.start()
+        thread.join()
+        self.assertNotIn('error', outcome)
+        self.assertFalse(outcome['app'])
+        self.assertGreater(outcome['score'], context.min_score)
+        self.assertEqual(outcome['no evidence'], 0)
+
+
+    def test_score_upper_bounds(self):
+        """
+        test that the upper bounds computed over the columns of the candidates are the ones computed one at a time
+        """
+        solutions = [{'doctype': 'article', 'year': '2019', 'volume': '870', 'page': '12', 'pub_raw': ''},
+                     {'doctype': 'article', 'year': '2018', 'volume': '1870', 'page': '112', 'pub_raw': ''},
+                     {'doctype': 'inproceedings', 'year': '2091', 'volume': '871', 'page': '12', 'pub_raw': ''},
+                     {'doctype': 'article', 'year': '2019', 'volume': '860', 'page': 'L12', 'pub_raw': ''},
+                     {'doctype': 'article', 'year': '2019', 'volume': '2019', 'issue': '870', 'page': '12', 'pub_raw': ''},
+                     {'doctype': 'book', 'year': '', 'volume': '', 'page': '0', 'pub_raw': 'Vol. 870'},
+                     {'doctype': 'catalog', 'year': '2019', 'volume': '870', 'page': '12', 'eid': '12'}]
+        batch = CandidateBatch(solutions, get_scoring_context())
+        self.assertEqual(batch.year.tolist(), [2019, 2018, 2091, 2019, 2019, -1, 2019])
+        self.assertEqual(batch.page.tolist(), [12, 112, 12, -1, 12, 0, 12])
+        self.assertEqual(batch.plain.tolist(), [True, True, True, True, False, True, False])
+
+        for input_fields, page_qualifier in [({'year': '2019', 'volume': '870', 'page': '12'}, ''),
+                                             ({'year': '2019', 'volume': '870', 'page': '12'}, 'L'),
+                                             ({'year': '2019', 'volume': '870'}, None),
+                                             ({'year': '19', 'page': '12-14'}, None)]:
+            hypothesis = Hypothesis("fielded-author/year/volume/page", {}, get_score_for_input_fields,
+                                    input_fields=input_fields, page_qualifier=page_qualifier,
+                                    scoring_context=get_scoring_context())
+            self.assertEqual(get_score_upper_bounds(solutions, hypothesis),
+                             [get_score_upper_bound(solution, hypothesis) for solution in solutions])
+
+        # only the candidates not covered by the columns are bounded one at a time, the ones with a volume
+        # off by one digit or close, a page with a letter, a year for volume, or no year
+        with mock.patch('referencesrv.resolver.scoring.get_score_upper_bound', side_effect=get_score_upper_bound) as bound_mock:
+            get_score_upper_bounds(solutions, Hypothesis("fielded-author/year/volume/page", {}, get_score_for_input_fields,
+                                   input_fields={'year': '2019', 'volume': '870', 'page': '12'}, page_qualifier='',
+                                   scoring_context=get_scoring_context()))
+            self.assertEqual(bound_mock.call_count, 5)
+
+
+    def test_document_features(self):
+        """
+        test that the precomputed features of a document compare the same as the raw fields
+        """
+        document = {'bibcode': '2019ApJ...870...12S', 'year': '2019', 'volume': '870', 'page': '12',
+                    'author_norm': ['smith, j', 'jones, a', 'de la cruz, m'], 'first_author_norm': 'smith, j',
+                    'title': 'The Dust Mass of Galaxies - A Survey', 'pub': 'The Astrophysical Journal',
+                    'pub_raw': 'The Astrophysical Journal, Volume 870, Issue 1, article id. 12'}
+        features = DocumentFeatures(document, get_pub_normalizer())
+        self.assertEqual(features.author_last_names, ['smith', 'jones', 'de la cruz'])
+        self.assertEqual(features.title, normalize_words('The Dust Mass of Galaxies '))
+        self.assertEqual(features.pubs['pub'], cook_reference_pub('the astrophysical journal 2019apj...870...12s'))
+        self.assertEqual((features.year, features.volume, features.page), (2019, 870, 12))
+        self.assertEqual((DocumentFeatures({'year': '19', 'page': 'L12'}, get_pub_normalizer()).year,
+                          DocumentFeatures({'page': 'L12'}, get_pub_normalizer()).page), (-1, -1))
+
+        # with and without the features the comparisons are the same
+        ref_authors = normalize_author_list('Smith, J., Jones, A., Cruz, M.')
+        self.assertEqual(count_matching_authors(ref_authors, document['author_norm'], 100, document['first_author_norm']),
+                         count_matching_authors(ref_authors, document['author_norm'], 100, document['first_author_norm'],
+                                                ads_last_names=features.author_last_names))
+        for ref_title in ['the dust mass of galaxies', 'Dust masses of galaxies', 'Stellar populations']:
+            self.assertEqual(string_similarity(ref_title, document['title'].split('-')[0], -1),
+                             string_similarity(ref_title, document['title'].split('-')[0], -1, features.title))
+        for ref_pub in ['ApJ', 'Astrophys. J.', 'MNRAS']:
+            self.assertEqual(compute_pubstring_statistics(ref_pub, document['pub'], document['bibcode'], get_pub_normalizer()),
+                             compute_pubstring_statistics(ref_pub, document['pub'], document['bibcode'], get_pub_normalizer(),
+                                                          cooked_ads_pub=features.pubs['pub']))
+
+        # the features are computed once per bibcode
+        with mock.patch('referencesrv.resolver.features.DocumentFeatures', wraps=DocumentFeatures) as features_mock:
+            first = get_document_features(dict(document, bibcode='2019ApJ...870...13S'))
+            second = get_document_features(dict(document, bibcode='2019ApJ...870...13S'))
+            self.assertIs(first, second)
+            self.assertEqual(features_mock.call_count, 1)
+
+        # the querier attaches the features to the records, and the scoring reads them off the records
+        solutions = Querier().query('author:("Accomazzi, A") AND year:2019')
+        self.assertTrue(len(solutions) > 0)
+        self.assertTrue(all(isinstance(solution['_features'], DocumentFeatures) for solution in solutions))
+        hypothesis = Hypothesis("fielded-author/year", {}, get_score_for_input_fields,
+                                input_fields={'author': 'Accomazzi, A.', 'year': '2019', 'title': 'ADS'},
+                                scoring_context=get_scoring_context())
+        with mock.patch('referencesrv.resolver.features.get_feature_cache', side_effect=AssertionError):
+            self.assertTrue(get_score_for_input_fields(solutions[0], hypothesis).get_score() > 0)
+
+
+    def test_token_similarity(self):
+        """
+        test comparing titles and publication strings as token sets
+        """
+        title = tokenize_title('The Dust Mass of Galaxies')
+        self.assertEqual(title.tokens, ('the', 'dust', 'mass', 'of', 'galaxies'))
+        self.assertEqual(get_common_prefix_length(title, tokenize_title('the dust masses of galaxies')), 2)
+        # a word that another word starts with is accounted for, ie, mass with masses
+        self.assertEqual(count_missing_prefixes(title, tokenize_title('dust masses of galaxies')), 1)
+
+        # on the scale of string_similarity
+        for ref_title in ['the dust mass of galaxies', 'The Dust Mass', 'Dust masses of galaxies', 'Stellar populations', '']:
+            self.assertEqual(get_title_similarity(tokenize_title(ref_title), title, -1),
+                             string_similarity(ref_title, 'The Dust Mass of Galaxies', -1))
+
+        # the bibstem, volume, and page of the bibcode are words of the publication string
+        pub = tokenize_pub(cook_reference_pub('the astrophysical journal 2019apj...870...12s'))
+        self.assertTrue(pub.has_prefix('apj') and pub.has_prefix('astrophys') and pub.has_prefix('870'))
+        self.assertFalse(pub.has_prefix('mnras'))
+        for ref_pub in ['ApJ', 'Astrophys. J.', 'MNRAS']:
+            self.assertEqual(compute_pubstring_statistics(ref_pub, 'The Astrophysical Journal', '2019ApJ...870...12S', get_pub_normalizer()),
+                             compute_pubstring_statistics(ref_pub, 'The Astrophysical Journal', '2019ApJ...870...12S', get_pub_normalizer(),
+                                                          ads_pub_tokens=pub))
+
+        # the scoring context tells which comparison is used, with the token sets of the features
+        document = {'bibcode': '2019ApJ...870...12S', 'title': 'The Dust Mass of Galaxies - A Survey'}
+        self.assertFalse(get_scoring_context().token_similarity)
+        self.current_app.config['REFERENCE_SERVICE_TOKEN_SIMILARITY'] = True
+        evidences = Evidences(get_scoring_context())
+        add_title_evidence(evidences, 'Dust in galaxies', document['title'], None,
+                           get_document_features(document).get_title_tokens())
+        self.assertEqual(evidences.evidences, [-0.2])
+
+
+    def test_citing_year(self):
+        """
+        test that the year of the citing paper bounds the year of the records queried
+        """
+        self.assertEqual(make_solr_condition("year_max", "2020"), 'year:[* TO 2020]')
+
+        queries = []
+        query = Querier.query
+        def capture(querier, query_string, filters=None):
+            queries.append(query_string)
+            return query(querier, query_string, filters)
+        ref = {'authors': 'Accomazzi, A.',
+               'journal': 'AAS233 Meeting',
+               'volume': '233',
+               'year': '2019',
+               'page': '381.08'}
+        with mock.patch.object(Querier, 'query', capture):
+            r = self.client.post(path='/xml', data=json.dumps({'parsed_reference': [ref], 'citing_bibcode': '2019ApJ...800....1A'}),
+                                 headers={'accept': 'application/json'})
+            self.assertEqual(r.json['resolved'][0]['bibcode'], '2019AAS...23338108A')
+            self.assertTrue(len(queries) > 0)
+            self.assertTrue(all(query_string.endswith(' AND year:[* TO 2020]') for query_string in queries))
+
+
     def test_add_volume_evidence(self):
         """
         test add_volume_evidence
         """
         # both reference and ads missing volume values
-        self.assertEqual(add_volume_evidence(Evidences(), None, None, None, None), None)
-        self.assertEqual(add_volume_evidence(Evidences(), '', '', '', ''), None)
+        self.assertEqual(add_volume_evidence(Evidences(get_scoring_context()), None, None, None, None), None)
+        self.assertEqual(add_volume_evidence(Evidences(get_scoring_context()), '', '', '', ''), None)
         # when one is missing
-        evidences = Evidences()
+        evidences = Evidences(get_scoring_context())
         self.assertEqual(add_volume_evidence(evidences, '233', '', '', ''), None)
         self.assertEqual(evidences.get_score(), 0)
-        evidences = Evidences()
+        evidences = Evidences(get_scoring_context())
         self.assertEqual(add_volume_evidence(evidences, '', '233', '', ''), None)
         self.assertEqual(evidences.get_score(), -1)
         # when matched
-        evidences = Evidences()
+        evidences = Evidences(get_scoring_context())
         self.assertEqual(add_volume_evidence(evidences, '233', '233', '', ''), None)
         self.assertEqual(evidences.get_score(), 1)
         # when unmatched
-        evidences = Evidences()
+        evidences = Evidences(get_scoring_context())
         self.assertEqual(add_volume_evidence(evidences, '223', '233', '', ''), None)
         self.assertEqual(evidences.get_score(), 0.7)
         # when not integer, but matched
-        evidences = Evidences()
+        evidences = Evidences(get_scoring_context())
         self.assertEqual(add_volume_evidence(evidences, '233-3', '233-3', '', ''), None)
         self.assertEqual(evidences.get_score(), 1)
         # when not integer, unmatched
-        evidences = Evidences()
+        evidences = Evidences(get_scoring_context())
         self.assertEqual(add_volume_evidence(evidences, '223-3', '233-3', '', ''), None)
         self.assertEqual(evidences.get_score(), 0)
         # when volume is year and there is an issue
-        evidences = Evidences()
+        evidences = Evidences(get_scoring_context())
         self.assertEqual(add_volume_evidence(evidences, '233', '2018', '233', ''), None)
         self.assertEqual(evidences.get_score(), 1)
 
@@ -507,44 +1050,45 @@ class TestResolver(TestCase):
         """
         test compute_page_delta
         """
-        self.assertEqual(compute_page_delta("23", "23"), 1)
-        self.assertEqual(compute_page_delta("21", "234"), 0)
-        self.assertEqual(compute_page_delta("32", "L32", "L"), 1)
-        self.assertEqual(compute_page_delta("32", "L32", "P"), 1 + self.current_app.config['NO_LETTER_DEMERIT'])
-        self.assertEqual(compute_page_delta("32", "32B"), 1 + self.current_app.config['NO_LETTER_DEMERIT'])
-        self.assertEqual(compute_page_delta("A32", "32"), 1 + self.current_app.config['NO_LETTER_DEMERIT'])
-        self.assertEqual(compute_page_delta("", ""), None)
-        self.assertEqual(compute_page_delta("23", None), 0)
-        self.assertEqual(compute_page_delta(":M20", "23"), 0)
-        self.assertEqual(compute_page_delta(":M20", ":M20"), 1)
-        self.assertEqual(compute_page_delta("233", "23"), 0)
-        self.assertEqual(compute_page_delta("23", "0"), 0)
+        context = get_scoring_context()
+        self.assertEqual(compute_page_delta("23", "23", context), 1)
+        self.assertEqual(compute_page_delta("21", "234", context), 0)
+        self.assertEqual(compute_page_delta("32", "L32", context, "L"), 1)
+        self.assertEqual(compute_page_delta("32", "L32", context, "P"), 1 + context.no_letter_demerit)
+        self.assertEqual(compute_page_delta("32", "32B", context), 1 + context.no_letter_demerit)
+        self.assertEqual(compute_page_delta("A32", "32", context), 1 + context.no_letter_demerit)
+        self.assertEqual(compute_page_delta("", "", context), None)
+        self.assertEqual(compute_page_delta("23", None, context), 0)
+        self.assertEqual(compute_page_delta(":M20", "23", context), 0)
+        self.assertEqual(compute_page_delta(":M20", ":M20", context), 1)
+        self.assertEqual(compute_page_delta("233", "23", context), 0)
+        self.assertEqual(compute_page_delta("23", "0", context), 0)
 
 
     def test_add_page_evidence(self):
         """
         test add_page_evidence
         """
-        self.assertEqual(add_page_evidence(Evidences(), None, None), None)
-        self.assertEqual(add_page_evidence(Evidences(), 23, 0), None)
+        self.assertEqual(add_page_evidence(Evidences(get_scoring_context()), None, None), None)
+        self.assertEqual(add_page_evidence(Evidences(get_scoring_context()), 23, 0), None)
 
 
     def test_compute_pubstring_statistics(self):
         """
         test compute_pubstring_statistics
         """
-        self.assertEqual(compute_pubstring_statistics("A&A", "Astronomy and Astrophysics", "A&A"), (1, 0))
-        self.assertEqual(compute_pubstring_statistics("A&AS", "Astronomy and Astrophysics", "A&A"), (1, 1))
+        self.assertEqual(compute_pubstring_statistics("A&A", "Astronomy and Astrophysics", "A&A", get_pub_normalizer()), (1, 0))
+        self.assertEqual(compute_pubstring_statistics("A&AS", "Astronomy and Astrophysics", "A&A", get_pub_normalizer()), (1, 1))
 
 
     def test_string_similarity(self):
         """
         test string_similarity
         """
-        self.assertEqual(string_similarity(None, None), -1)
-        self.assertEqual(string_similarity('', ''), -1)
+        self.assertEqual(string_similarity(None, None, -1), -1)
+        self.assertEqual(string_similarity('', '', -1), -1)
         self.assertTrue(string_similarity('The NASA Astrophysics Data System’s Decadal Plan for the 2020s',
-                                          'Transitioning from ADS Classic to the new ADS search platform')
+                                          'Transitioning from ADS Classic to the new ADS search platform', -1)
                         < 0.15)
 
 
@@ -552,7 +1096,7 @@ class TestResolver(TestCase):
         """
         test add_publication_evidence
         """
-        evidences = Evidences()
+        evidences = Evidences(get_scoring_context())
         add_publication_evidence(evidences,
                                  'The NASA Astrophysics Data System’s Decadal Plan for the 2020s',
                                  'AAS',
@@ -561,7 +1105,7 @@ class TestResolver(TestCase):
                                  '2019AAS...23320704A',
                                  'AAS')
         self.assertEqual(evidences.get_score(), 1)
-        evidences = Evidences()
+        evidences = Evidences(get_scoring_context())
         add_publication_evidence(evidences,
                                  'Nucl. Instrum. Methods Phys. Res. A',
                                  '',
@@ -570,7 +1114,7 @@ class TestResolver(TestCase):
                                  '1997NIMPA.389...81B',
                                  'NIMPA')
         self.assertEqual(evidences.get_score(), 0.6)
-        evidences = Evidences()
+        evidences = Evidences(get_scoring_context())
         add_publication_evidence(evidences,
                                  'The NASA Astrophysics Data System’s Decadal Plan for the 2020s',
                                  '',
@@ -579,7 +1123,7 @@ class TestResolver(TestCase):
                                  '2019AAS...23320704A',
                                  'AAS')
         self.assertEqual(evidences.get_score(), -1)
-        evidences = Evidences()
+        evidences = Evidences(get_scoring_context())
         add_publication_evidence(evidences,
                                  '',
                                  '',
@@ -590,7 +1134,7 @@ class TestResolver(TestCase):
         self.assertEqual(evidences.get_score(), 0)
         # when there is an error in reference, the author is not parsed properly,
         # and hence journal is not identified correctly, if ads bibstem is in ref_str, do not penalize
-        evidences = Evidences()
+        evidences = Evidences(get_scoring_context())
         add_publication_evidence(evidences,
                                  'iaz',
                                  '',
@@ -599,7 +1143,7 @@ class TestResolver(TestCase):
                                  '2011IAUS..272..310S',
                                  'IAUS')
         self.assertEqual(evidences.get_score(), 0)
-        evidences = Evidences()
+        evidences = Evidences(get_scoring_context())
         add_publication_evidence(evidences, '', '', '', '', '', '')
         self.assertEqual(evidences.get_score(), 0)
 
@@ -632,6 +1176,45 @@ class TestResolver(TestCase):
         self.assertEqual(cook_title_string("a b c, a cat was in the snow"), '')
 
 
+    def test_pub_normalizer(self):
+        """
+        test that the normalizer built once from the config lists normalizes the same as the functions do
+        """
+        pub_normalizer = get_pub_normalizer()
+        self.assertIs(get_pub_normalizer(), pub_normalizer)
+        self.assertEqual(cook_reference_pub('Phys. Rev. D, 99, 1'), 'Physical Review D, 99, 1')
+        self.assertEqual(cook_reference_pub('a&a 600 a1'), 'aanda 600 a1')
+        self.assertEqual(pub_normalizer.compute_cooked_title_string("Untimely results in atomic spec."), 'Untimely results atomic')
+        self.assertEqual(pub_normalizer.compute_has_thesis_indicators(u"Ph.D. Thesis, Caltech"), True)
+        self.assertEqual(pub_normalizer.compute_has_thesis_indicators(u"Dissertations in Astronomy"), True)
+        self.assertEqual(pub_normalizer.compute_has_thesis_indicators(u"Astrophdical Journal"), False)
+
+        # the normalized strings are kept
+        METRICS.reset()
+        for _ in range(3):
+            cook_title_string("Untimely results in atomic spec.")
+        self.assertEqual((METRICS.get()['journalfield.cooked_title.hits'], METRICS.get()['journalfield.cooked_title.misses']), (2, 1))
+
+        # with no whole thesis words configured, only the prefixes are looked for
+        config = dict(self.current_app.config, THESIS_INDICATOR_WORDS=['dissert*'])
+        self.assertEqual(PubNormalizer(config).has_thesis_indicators(u"PhD thesis, Cornell"), False)
+        self.assertEqual(PubNormalizer(config).has_thesis_indicators(u"Dissertation, Cornell"), True)
+
+
+    def test_make_solr_query(self):
+        """
+        test splitting the exact constraints into filter queries
+        """
+        hints = {'author': 'Accomazzi, A', 'year': '2019', 'bibstem': 'AAS'}
+        self.assertEqual(make_solr_query(hints), ('author:("Accomazzi") AND year:"2019" AND bibstem:(AAS)', []))
+        self.current_app.config['REFERENCE_SERVICE_SOLR_FILTER_QUERIES'] = True
+        self.assertEqual(make_solr_query(hints), ('author:("Accomazzi")', ['year:"2019"', 'bibstem:(AAS)']))
+        self.assertEqual(make_solr_query({'year~': '2019', 'doctype': 'book'}), ('*:*', ['year:[2014 TO 2024]', 'doctype:(book)']))
+        self.current_app.config['REFERENCE_SERVICE_SOLR_FILTER_QUERIES'] = False
+        solrquery = Querier()
+        self.assertEqual(solrquery.make_params('author:("Accomazzi, A")', ['year:"2019"'])['fq'], ['year:"2019"'])
+
+
     def test_Querier(self):
         solrquery = Querier()
         self.assertEqual(solrquery.make_params('author:("Accomazzi, A") AND year:"2019" AND bibstem:(AAS)'),
@@ -688,7 +1271,8 @@ class TestResolverHypotheses(TestCase):
         test Hypothesis class
         """
         h = Hypothesis(name="test_arxiv_id", hints={'arxiv':'1905.07407'},
-                       get_score_function=get_score_for_reference_identifier, input_fields={'arxiv':'1905.07407'})
+                       get_score_function=get_score_for_reference_identifier, input_fields={'arxiv':'1905.07407'},
+                       scoring_context=get_scoring_context())
         s = h.get_score({'identifier':['arXiv:1905.07407'], 'bibcode': '2019arXiv190507407S'}, h)
         self.assertEqual(s['bibcode'], 1)
         self.assertEqual(h.get_detail('has_etal'), None)
@@ -722,25 +1306,144 @@ class TestResolverHypotheses(TestCase):
                             "pub": input_fields["pub"]},
                             get_score_for_input_fields,
                        input_fields=input_fields,
-                       has_etal=False)
+                       has_etal=False, scoring_context=get_scoring_context())
         evidences = get_score_for_input_fields(result_record, hypothesis)
         # matches are authors, year, pub, and volume
         self.assertEqual(evidences.get_score(), 4.0)
 
 
+    def test_select_candidates(self):
+        """
+        test that candidates that cannot compete with the best one are not scored
+        """
+        result_record = {u'bibcode': u'1992JOSAA...9..154F',
+                         u'author': [u'Frisken Gibson, Sarah', u'Lanni, Frederick'],
+                         u'title': u'Experimental test of an analytical model of aberration in an oil-immersion objective lens used in three-dimensional light microscopy',
+                         u'doctype': u'article',
+                         u'pub': u'Journal of the Optical Society of America A',
+                         u'pub_raw': u'Journal of the Optical Society of America A, vol. 9, issue 1, p. 154',
+                         u'volume': u'9',
+                         u'author_norm': ['frisken gibson, s', 'lanni, f'],
+                         u'year': u'1992',
+                         u'first_author_norm': 'frisken gibson, s',
+                         u'identifier': [u'1992JOSAA...9..154F'],
+                         u'page': u'154'}
+        other_record = dict(result_record, bibcode=u'1980JOSAA..30..900F', year=u'1980', volume=u'30', page=u'900')
+        input_fields = {'volume': u'9',
+                        'page': u'154',
+                        'year': u'1992',
+                        'pub': u'J. Opt. Soc. Am. A',
+                        'author': u'S.  Frisken-Gibson,F.  Lanni',
+                        'refstr': u'S.  Frisken-Gibson,F.  Lanni, 1992, J. Opt. Soc. Am. A, 9, 154'}
+        hypothesis = Hypothesis("testing", {}, get_score_for_input_fields, input_fields=input_fields, has_etal=False,
+                                scoring_context=get_scoring_context())
+        self.assertEqual(get_score_upper_bound(result_record, hypothesis), 6.0)
+        self.assertTrue(get_score_upper_bound(other_record, hypothesis) < get_score_for_input_fields(result_record, hypothesis).get_score())
+
+        pruned = METRICS.get().get('resolver.candidates.pruned', 0)
+        scored = select_candidates([other_record, result_record], hypothesis)
+        self.assertEqual(len(scored), 1)
+        self.assertEqual(scored[-1][1]['bibcode'], u'1992JOSAA...9..154F')
+        self.assertEqual(scored[-1][0].get_score(), get_score_for_input_fields(result_record, hypothesis).get_score())
+        self.assertEqual(METRICS.get()['resolver.candidates.pruned'], pruned + 1)
+
+
+    def test_select_candidates_page_vetoed(self):
+        """
+        test that when no candidate is acceptable, of the ones vetoed by page only, the best scored is kept,
+        the first one solr returned among equally scored, and is the one the stash is given
+        """
+        def get_score(record, hypothesis):
+            evidences = Evidences(hypothesis.get_scoring_context())
+            evidences.add_evidence(record['authors'], 'authors')
+            evidences.add_evidence(-1, 'page')
+            return evidences
+        records = [{'bibcode': '2019ApJ...870...11A', 'authors': 0.5},
+                   {'bibcode': '2019ApJ...870...12A', 'authors': 0.9},
+                   {'bibcode': '2019ApJ...870...13A', 'authors': 0.9},
+                   {'bibcode': '2019ApJ...870...14A', 'authors': 0.7}]
+        hypothesis = Hypothesis("testing", {}, get_score, input_fields={'year': '2019'},
+                                scoring_context=get_scoring_context())
+        scored = select_candidates(records, hypothesis)
+        self.assertEqual([solution['bibcode'] for _, solution in scored], ['2019ApJ...870...12A'])
+        with self.assertRaises(Undecidable) as context:
+            inspect_doubtful_solutions(scored, 'year:2019', hypothesis)
+        self.assertEqual(context.exception.considered_solutions[0][1], '2019ApJ...870...12A')
+
+
+    def test_evidence_memo(self):
+        """
+        test that hypotheses of the same reference reuse the evidence components of a record
+        """
+        result_record = {u'bibcode': u'1992JOSAA...9..154F',
+                         u'author': [u'Frisken Gibson, Sarah', u'Lanni, Frederick'],
+                         u'title': u'Experimental test of an analytical model of aberration in an oil-immersion objective lens used in three-dimensional light microscopy',
+                         u'doctype': u'article',
+                         u'pub': u'Journal of the Optical Society of America A',
+                         u'pub_raw': u'Journal of the Optical Society of America A, vol. 9, issue 1, p. 154',
+                         u'volume': u'9',
+                         u'author_norm': ['frisken gibson, s', 'lanni, f'],
+                         u'year': u'1992',
+                         u'first_author_norm': 'frisken gibson, s',
+                         u'identifier': [u'1992JOSAA...9..154F'],
+                         u'page': u'154'}
+        input_fields = {'volume': u'9',
+                        'year': u'1992',
+                        'pub': u'J. Opt. Soc. Am. A',
+                        'author': u'S.  Frisken-Gibson,F.  Lanni'}
+        evidence_memo = EvidenceMemo()
+        without_memo = get_score_for_input_fields(result_record,
+                                                  Hypothesis("testing", {}, get_score_for_input_fields, input_fields=input_fields,
+                                                             scoring_context=get_scoring_context()))
+        for name in ["testing-author/year", "testing-author/year/volume"]:
+            hypothesis = Hypothesis(name, {}, get_score_for_input_fields, input_fields=input_fields, evidence_memo=evidence_memo,
+                                    scoring_context=get_scoring_context())
+            evidences = get_score_for_input_fields(result_record, hypothesis)
+            self.assertEqual(str(evidences), str(without_memo))
+        self.assertEqual((evidence_memo.hits, evidence_memo.misses), (3, 3))
+
+
+    def test_evidences(self):
+        """
+        test that the sum, the vetoes, and the labels kept as the evidences are added are as computed from all of them
+        """
+        evidences = Evidences(get_scoring_context())
+        component = Evidences(get_scoring_context())
+        component.add_evidence(0.1, 'authors')
+        component.add_evidence(-0.2, 'title')
+        evidences.add_evidence(0.7, 'year')
+        evidences + component
+        evidences.add_evidence(0.3, 'page')
+        evidences.add_evidence(0.4, 'page')
+        self.assertFalse(hasattr(evidences, '__dict__'))
+        self.assertEqual(str(evidences), 'Evidences(year=0.7, authors=0.1, title=-0.2, page=0.3, page=0.4)')
+        self.assertEqual(evidences.get_score(), sum([0.7, 0.1, -0.2, 0.3, 0.4]))
+        self.assertEqual(evidences.avg(), 0.3)
+        self.assertEqual((evidences['page'], evidences['title'], evidences['volume']), (0.4, -0.2, None))
+        self.assertEqual((evidences.has_veto(), evidences.single_veto_from('title'), evidences.single_veto_from('page')), (True, True, False))
+        evidences.add_evidence(0, 'volume')
+        self.assertEqual((evidences.has_veto(), evidences.single_veto_from('title')), (True, False))
+
+        # ordered by score, against other evidences and numbers
+        other = Evidences(get_scoring_context())
+        other.add_evidence(1, 'year')
+        self.assertTrue(other < evidences and evidences > 1 and not Evidences(get_scoring_context()) > other)
+        self.assertEqual(sorted([evidences, other, component]), [component, other, evidences])
+
+
     def test_inspect_doubtful_solutions(self):
         """
         test doubtful solutions, when there is more than one possible solution without a doubt (i.e., all fields have
         in evidences have positive values
         :return:
         """
-        e1 = Evidences()
+        e1 = Evidences(get_scoring_context())
         e1.add_evidence(0.11, 'authors')
         e1.add_evidence(0.15, 'year')
-        e2 = Evidences()
+        e2 = Evidences(get_scoring_context())
         e2.add_evidence(0.05, 'authors')
         e2.add_evidence(0.21, 'year')
-        e3 = Evidences()
+        e3 = Evidences(get_scoring_context())
         e3.add_evidence(0.05, 'authors')
         e3.add_evidence(0.21, 'year')
         e3.add_evidence(-1, 'page')
@@ -753,7 +1456,7 @@ class TestResolverHypotheses(TestCase):
                             "year": input_fields["year"]},
                        get_score_for_input_fields,
                        input_fields=input_fields,
-                       has_etal=False)
+                       has_etal=False, scoring_context=get_scoring_context())
 
         with self.assertRaises(Exception) as context:
             inspect_doubtful_solutions(scored_solutions=[(e1, {u'bibcode': u'1992JOSAA...9..154F'})],
@@ -773,18 +1476,18 @@ class TestResolverHypotheses(TestCase):
         """
         test inspect_ambiguous_solutions
         """
-        e1 = Evidences()
+        e1 = Evidences(get_scoring_context())
         e1.add_evidence(0.11, 'authors')
         e1.add_evidence(0.15, 'year')
-        e2 = Evidences()
+        e2 = Evidences(get_scoring_context())
         e2.add_evidence(0.05, 'authors')
         e2.add_evidence(0.21, 'year')
         e2.add_evidence(0.1, 'volume')
-        e3 = Evidences()
+        e3 = Evidences(get_scoring_context())
         e3.add_evidence(0.05, 'authors')
         e3.add_evidence(0.21, 'year')
         e3.add_evidence(-1, 'page')
-        e4 = Evidences()
+        e4 = Evidences(get_scoring_context())
         e4.add_evidence(0.05, 'authors')
         e4.add_evidence(0.21, 'year')
 
@@ -797,7 +1500,7 @@ class TestResolverHypotheses(TestCase):
                             "year": input_fields["year"]},
                        get_score_for_input_fields,
                        input_fields=input_fields,
-                       has_etal=False)
+                       has_etal=False, scoring_context=get_scoring_context())
         scored_solutions = [(e1, {u'bibcode': u'1992JOSAA...9..154F'})]
         self.assertEqual(inspect_ambiguous_solutions(scored_solutions=scored_solutions,
                                         query_string='the_query', hypothesis=hypothesis),
@@ -829,19 +1532,19 @@ class TestResolverHypotheses(TestCase):
         """
 
         """
-        e1 = Evidences()
+        e1 = Evidences(get_scoring_context())
         e1.add_evidence(0.0, 'authors')
         e1.add_evidence(0.3, 'year')
         e1.add_evidence(0, 'page')
         e1.add_evidence(-0.6, 'pubstring')
         e1.add_evidence(0, 'volume')
-        e2 = Evidences()
+        e2 = Evidences(get_scoring_context())
         e2.add_evidence(1.0, 'authors')
         e2.add_evidence(1.0, 'year')
         e2.add_evidence(0, 'page')
         e2.add_evidence(0.6, 'pubstring')
         e2.add_evidence(1, 'volume')
-        e3 = Evidences()
+        e3 = Evidences(get_scoring_context())
         e3.add_evidence(1.0, 'authors')
         e3.add_evidence(1.0, 'year')
         e3.add_evidence(1.0, 'page')
@@ -863,7 +1566,7 @@ class TestResolverHypotheses(TestCase):
                                     "year": solution["year"]},
                                 get_score_for_input_fields,
                                 input_fields=solution,
-                                has_etal=False)
+                                has_etal=False, scoring_context=get_scoring_context())
 
         with self.assertRaises(Exception) as context:
             choose_solution(candidates=[], query_string='the_query', hypothesis=hypothesis)
@@ -894,7 +1597,7 @@ class TestResolverHypotheses(TestCase):
         hypothesis = Hypothesis("testing-fielded-DOI", {
                                     "doi": ref["doi"]},
                                 get_score_for_reference_identifier,
-                                input_fields=ref)
+                                input_fields=ref, scoring_context=get_scoring_context())
         self.assertEqual(get_score_for_reference_identifier(solution, hypothesis).get_score(), 1)
 
         # if it does not match
@@ -902,7 +1605,7 @@ class TestResolverHypotheses(TestCase):
         hypothesis = Hypothesis("testing-fielded-DOI", {
                                     "doi": ref["doi"]},
                                 get_score_for_reference_identifier,
-                                input_fields=ref)
+                                input_fields=ref, scoring_context=get_scoring_context())
         self.assertEqual(get_score_for_reference_identifier(solution, hypothesis).get_score(), -1)
 
         # reference is arxiv id which is available in eid in solr
@@ -913,7 +1616,7 @@ class TestResolverHypotheses(TestCase):
         hypothesis = Hypothesis("testing-fielded-arxiv", {
                                     "arxiv": ref["arxiv"]},
                                 get_score_for_reference_identifier,
-                                input_fields=ref)
+                                input_fields=ref, scoring_context=get_scoring_context())
         self.assertEqual(get_score_for_reference_identifier(solution, hypothesis).get_score(), 1)
 
         # if it does not match
@@ -921,7 +1624,7 @@ class TestResolverHypotheses(TestCase):
         hypothesis = Hypothesis("testing-fielded-arxiv", {
                                     "arxiv": ref["arxiv"]},
                                 get_score_for_reference_identifier,
-                                input_fields=ref)
+                                input_fields=ref, scoring_context=get_scoring_context())
         self.assertEqual(get_score_for_reference_identifier(solution, hypothesis).get_score(), -1)
 
 
@@ -957,7 +1660,7 @@ class TestResolverHypotheses(TestCase):
                         input_fields=ref,
                         page_qualifier=ref.get("qualifier"),
                         has_etal=False,
-                        normalized_authors=normalized_authors)
+                        normalized_authors=normalized_authors, scoring_context=get_scoring_context())
         # Evidences(authors=1, year=0.75, doctype=1, pubstring=1.0)
         self.assertEqual(get_book_score_for_input_fields(solution, hypothesis).get_score(), 3.75)
 
@@ -989,7 +1692,7 @@ class TestResolverHypotheses(TestCase):
                             "year": ref["year"]},
                         get_thesis_score_for_input_fields,
                         input_fields=ref,
-                        normalized_authors=normalized_authors)
+                        normalized_authors=normalized_authors, scoring_context=get_scoring_context())
         # Evidences(doctype=1, author=1.0, year=1.0, affiliation=1.0)
         self.assertEqual(get_thesis_score_for_input_fields(solution, hypothesis).get_score(), 4)
 
@@ -1004,7 +1707,7 @@ class TestResolverHypotheses(TestCase):
                             "year": ref["year"]},
                         get_thesis_score_for_input_fields,
                         input_fields=ref,
-                        normalized_authors=normalized_authors)
+                        normalized_authors=normalized_authors, scoring_context=get_scoring_context())
         # Evidences(doctype=1, author=0.7, year=1.0, affiliation=1.0)
         self.assertEqual(get_thesis_score_for_input_fields(solution, hypothesis).get_score(), 3.7)
 
@@ -1017,7 +1720,7 @@ class TestResolverHypotheses(TestCase):
                             "year": ref["year"]},
                         get_thesis_score_for_input_fields,
                         input_fields=ref,
-                        normalized_authors=normalized_authors)
+                        normalized_authors=normalized_authors, scoring_context=get_scoring_context())
         # Evidences(doctype=1, author=1.0, year=0.75, affiliation=1.0)
         self.assertEqual(get_thesis_score_for_input_fields(solution, hypothesis).get_score(), 3.75)
 
@@ -1042,7 +1745,7 @@ class TestResolverHypotheses(TestCase):
                             "year": ref["year"]},
                         get_thesis_score_for_input_fields,
                         input_fields=ref,
-                        normalized_authors=normalized_authors)
+                        normalized_authors=normalized_authors, scoring_context=get_scoring_context())
         # Evidences(doctype=1, author=1.0, year=1.0, affiliation=1.0)
         self.assertEqual(get_thesis_score_for_input_fields(solution, hypothesis).get_score(), 4)
 
@@ -1118,7 +1821,7 @@ class TestResolverHypotheses(TestCase):
                         input_fields=ref,
                         page_qualifier='',
                         has_etal='et al' in ref["authors"],
-                        normalized_authors=normalized_authors)
+                        normalized_authors=normalized_authors, scoring_context=get_scoring_context())
         self.assertEqual(get_score_for_input_fields(solution, hypothesis).get_score(), 4.0)
 
 
@@ -1188,6 +1891,29 @@ class TestResolverHypotheses(TestCase):
         self.assertEqual(next(hypothesis).name, 'volume-year-identical')
 
 
+    def test_journal_rules(self):
+        """
+        test that only the rules a reference triggers are evaluated, in the order they are registered, and counted
+        """
+        METRICS.reset()
+        # the BAAS rule, the repeated year, and two of the conference series
+        hypotheses = list(iter_journal_specific_hypotheses('BAAS', '2019', 'Doe, J', 'Proc. SPIE, ASP Conf. Ser.',
+                                                           '51', '440', 'Doe, J 2019, BAAS, 2019, 51, 440'))
+        self.assertEqual([hypothesis.name for hypothesis in hypotheses],
+                         ['extra-BAAS->DDA', 'extra-BAAS->AAS', 'extra-BAAS->DPS', 'volume-year-identical',
+                          'fielded-confser-ASPC', 'fielded-confser-SPIE'])
+        self.assertEqual([hypothesis.get_detail('rule') for hypothesis in hypotheses[2:]],
+                         ['BAAS', 'volume-year', 'confser-ASPC', 'confser-SPIE'])
+        metrics = METRICS.get()
+        self.assertEqual((metrics['specialrules.BAAS.fired'], metrics['specialrules.confser-SPIE.fired']), (1, 1))
+        self.assertTrue('specialrules.JOSS.fired' not in metrics)
+
+        # none of the patterns is in the journal, so none is searched for on its own
+        with mock.patch.object(JOURNAL_RULES.by_pattern[0], 'pattern') as pattern_mock:
+            self.assertEqual(list(iter_journal_specific_hypotheses(None, '2019', 'Doe, J', 'Astron. J.', '51', '440', 'Doe, J 2019, AJ, 51, 440')), [])
+            self.assertEqual(pattern_mock.search.call_count, 0)
+
+
     def test_get_score_for_baas_match(self):
         """
         test get_score_for_baas_match
@@ -1220,13 +1946,14 @@ class TestResolverHypotheses(TestCase):
         hypothesis = Hypothesis("testing", None,
                        get_score_for_input_fields,
                        input_fields=input_fields,
-                       expected_bibstem=get_best_bibstem_for(input_fields["pub"]))
+                       expected_bibstem=get_best_bibstem_for(input_fields["pub"]),
+                       scoring_context=get_scoring_context())
         self.assertEqual(get_score_for_baas_match(solution, hypothesis).get_score(), 1.0)
         # no matching expected_bibcode
         hypothesis = Hypothesis("testing", None,
                        get_score_for_input_fields,
                        input_fields=input_fields,
-                       expected_bibstem="no match")
+                       expected_bibstem="no match", scoring_context=get_scoring_context())
         self.assertEqual(get_score_for_baas_match(solution, hypothesis).get_score(), -1)
 
 
@@ -1291,5 +2018,436 @@ class TestResolverSolrQueryCase(TestCase):
 
 
 
+class TestResolverIdentifierIndex(TestCase):
+    """
+    test the local identifier index that is consulted before querying solr
+    """
+    def create_app(self):
+        self.current_app = app.create_app(**{
+            'REFERENCE_SERVICE_LIVE': False
+           })
+        return self.current_app
+
+
+    def setUp(self):
+        """
+        build the index from the stub export file
+        """
+        self.tmp_dir = tempfile.mkdtemp()
+        self.index_file = os.path.join(self.tmp_dir, 'identifiers.sqlite')
+        export_file = os.path.join(os.path.dirname(__file__), 'stubdata/identifiers.jsonl')
+        self.count = build_identifier_index(export_file, self.index_file)
+        self.current_app.extensions['identifier_index'] = IdentifierIndex(self.index_file)
+
+
+    def tearDown(self):
+        """
+        cleanup
+        """
+        self.current_app.extensions['identifier_index'] = None
+        os.remove(self.index_file)
+        os.rmdir(self.tmp_dir)
+
+
+    def test_get_index_keys(self):
+        """
+        test normalizing identifiers of a solr record
+        """
+        self.assertEqual(get_index_keys({'bibcode': '2019arXiv190507407S', 'identifier': ['arXiv:1905.07407', '2019arXiv190507407S']}),
+                         ('2019arXiv190507407S', {'arxiv:1905.07407'}))
+        # bibcodes are case sensitive, DOIs are not
+        self.assertEqual(get_index_keys({'bibcode': '2019A&A...1A', 'identifier': ['2019A&A...1a', '10.1051/0004-6361/201935000'],
+                                         'doi': ['10.1051/0004-6361/201935000']}),
+                         ('2019A&A...1A', {'2019A&A...1a', '10.1051/0004-6361/201935000'}))
+
+
+    def test_lookup(self):
+        """
+        test looking up identifiers the way the hypotheses send them
+        """
+        identifier_index = self.current_app.extensions['identifier_index']
+        self.assertEqual(identifier_index.lookup_hint('doi', '10.1007/jhep09(2020)002'), ('2020JHEP...09..002P', 'scix:5KGH-MC98-7AYN'))
+        self.assertEqual(identifier_index.lookup_hint('arxiv', '1905.08255'), ('2020JHEP...09..002P', 'scix:5KGH-MC98-7AYN'))
+        self.assertEqual(identifier_index.lookup_hint('ascl', '1906.010'), ('2019ascl.soft06010K', 'scix:3333-4444-5555'))
+        self.assertEqual(identifier_index.lookup_hint('bibcode', '2019arXiv190508255P'), ('2020JHEP...09..002P', 'scix:5KGH-MC98-7AYN'))
+        self.assertEqual(identifier_index.lookup_hint('bibcode', '2019arxiv190508255p'), None)
+        self.assertEqual(identifier_index.lookup_hint('doi', '10.1007/JHEP09(2020)002'), ('2020JHEP...09..002P', 'scix:5KGH-MC98-7AYN'))
+        # alternate identifier claimed by two records is left for solr to decide
+        self.assertEqual(identifier_index.lookup_hint('bibcode', '2019AAS...233.20704A'), None)
+        self.assertEqual(identifier_index.lookup_hint('doi', '10.1000/not.indexed'), None)
+        self.assertEqual(identifier_index.lookup_hint('year', '2019'), None)
+        stats = identifier_index.get_stats()
+        self.assertEqual(stats['count'], self.count)
+        self.assertTrue(stats['built'] > 0)
+
+
+    def test_solve_reference(self):
+        """
+        test that identifier hypotheses are answered from the index without going to solr
+        """
+        ref = {'authors': 'Penington, G.',
+               'year': '2020',
+               'doi': '10.1007/JHEP09(2020)002',
+               'refstr': 'Penington, G. 2020, doi:10.1007/JHEP09(2020)002'}
+        self.assertEqual(str(solve_reference(Hypotheses(ref))), '1.0 bibcode:2020JHEP...09..002P scixid:scix:5KGH-MC98-7AYN')
+
+        # the record found in the index is bound by the year of the citing paper, as the solr queries are
+        hypothesis = Hypothesis("fielded-doi", {'doi': ref['doi']}, get_score_for_input_fields,
+                                scoring_context=get_scoring_context(), citing_year=2018)
+        with self.assertRaises(NoSolution):
+            solve_from_identifier_index(hypothesis)
+        hypothesis.details['citing_year'] = 2019
+        self.assertEqual(str(solve_from_identifier_index(hypothesis)), '1.0 bibcode:2020JHEP...09..002P scixid:scix:5KGH-MC98-7AYN')
+
+
+
+class TestResolverSolrResilience(TestCase):
+    """
+    test retries, hedged requests, and the circuit breaker of the solr querier
+    """
+    def create_app(self):
+        self.current_app = app.create_app(**{
+            'REFERENCE_SERVICE_LIVE': False,
+            'REFERENCE_SERVICE_SOLR_RETRIES': 1,
+            'REFERENCE_SERVICE_SOLR_RETRY_BACKOFF': 0,
+            'REFERENCE_SERVICE_SOLR_BREAKER_THRESHOLD': 2,
+            'REFERENCE_SERVICE_SOLR_HEDGE_MIN_SAMPLES': 10,
+           })
+        return self.current_app
+
+
+    def get_response(self, status_code):
+        """
+        mock solr response with one record
+        """
+        response = mock.Mock()
+        response.status_code = status_code
+        response.text = json.dumps({'responseHeader': {'status': 0, 'QTime': 1, 'params': {}},
+                                    'response': {'start': 0, 'numFound': 1, 'docs': [{'bibcode': '2019ascl.soft06010K'}]}})
+        return response
+
+
+    def get_querier(self):
+        """
+        querier that sends requests to the mocked client
+        """
+        solrquery = Querier()
+        solrquery.connect_solr = True
+        return solrquery
+
+
+    def test_retry(self):
+        """
+        test that an overloaded response is retried
+        """
+        retries = METRICS.get().get('solr.retries', 0)
+        with mock.patch.object(self.current_app.client, 'get') as get_mock:
+            get_mock.side_effect = [self.get_response(503), self.get_response(200)]
+            solutions = self.get_querier().query('identifier:"2019ascl.soft06010K"')
+            self.assertEqual(solutions[0]['bibcode'], '2019ascl.soft06010K')
+            self.assertEqual(get_mock.call_count, 2)
+        self.assertEqual(METRICS.get()['solr.retries'], retries + 1)
+
+
+    def test_post(self):
+        """
+        test that a query with long parameters is sent as POST
+        """
+        with mock.patch.object(self.current_app.client, 'get') as get_mock, \
+                mock.patch.object(self.current_app.client, 'post') as post_mock:
+            get_mock.return_value = post_mock.return_value = self.get_response(200)
+            querier = self.get_querier()
+            # the fields requested are long enough already
+            querier.post_length = len(urllib.parse.urlencode(querier.make_params('identifier:"2019ascl.soft06010K"'))) + 100
+            querier.query('identifier:"2019ascl.soft06010K"')
+            querier.query('author:(%s)' % ' AND '.join(['"Author%d"' % i for i in range(20)]))
+            self.assertEqual(get_mock.call_count, 1)
+            self.assertEqual(post_mock.call_count, 1)
+            self.assertTrue('Author19' in post_mock.call_args[1]['data']['q'])
+
+
+    def test_circuit_breaker(self):
+        """
+        test that the breaker opens after repeated failures, fails fast, and closes after a successful trial request
+        """
+        with mock.patch.object(self.current_app.client, 'get') as get_mock:
+            get_mock.return_value = self.get_response(503)
+            with self.assertRaises(Solr):
+                self.get_querier().query('identifier:"2019ascl.soft06010K"')
+            self.assertEqual(get_mock.call_count, 2)
+            circuit_breaker = get_resilience()['circuit_breaker']
+            self.assertEqual(circuit_breaker.state, CircuitBreaker.OPEN)
+            self.assertEqual(METRICS.get()['solr.breaker.state'], 'open')
+            with self.assertRaises(Solr):
+                self.get_querier().query('identifier:"2019ascl.soft06010K"')
+            self.assertEqual(get_mock.call_count, 2)
+
+            # after the cooldown one trial request goes through
+            circuit_breaker.opened_at -= circuit_breaker.cooldown
+            get_mock.return_value = self.get_response(200)
+            self.assertEqual(len(self.get_querier().query('identifier:"2019ascl.soft06010K"')), 1)
+            self.assertEqual(circuit_breaker.state, CircuitBreaker.CLOSED)
+
+
+    def test_circuit_breaker_trial_error(self):
+        """
+        test that a trial request failing with an error other than a request error opens the breaker again,
+        and that a trial request never heard of does not keep the breaker half open
+        """
+        circuit_breaker = get_resilience()['circuit_breaker']
+        with mock.patch.object(self.current_app.client, 'get') as get_mock:
+            get_mock.return_value = self.get_response(503)
+            with self.assertRaises(Solr):
+                self.get_querier().query('identifier:"2019ascl.soft06010K"')
+            circuit_breaker.opened_at -= circuit_breaker.cooldown
+            get_mock.side_effect = ValueError('not a response')
+            with self.assertRaises(ValueError):
+                self.get_querier().query('identifier:"2019ascl.soft06010K"')
+            self.assertEqual(circuit_breaker.state, CircuitBreaker.OPEN)
+
+        circuit_breaker.opened_at -= circuit_breaker.cooldown
+        self.assertTrue(circuit_breaker.allow())
+        self.assertFalse(circuit_breaker.allow())
+        circuit_breaker.trial_at -= circuit_breaker.cooldown
+        self.assertTrue(circuit_breaker.allow())
+        self.assertEqual(circuit_breaker.state, CircuitBreaker.HALF_OPEN)
+
+
+    def test_hedge(self):
+        """
+        test that a second request is sent when the first is slower than usual, and the faster one is used
+        """
+        latency_window = get_resilience()['latency_window']
+        for _ in range(10):
+            latency_window.add(0.01)
+        responses = [self.get_response(200), self.get_response(200)]
+        responses[1].text = responses[1].text.replace('2019ascl.soft06010K', '2019ascl.soft06010L')
+        def get(**kwargs):
+            if get_mock.call_count == 1:
+                time.sleep(0.5)
+                return responses[0]
+            return responses[1]
+        hedge_won = METRICS.get().get('solr.hedge.won', 0)
+        with mock.patch.object(self.current_app.client, 'get') as get_mock:
+            get_mock.side_effect = get
+            solutions = self.get_querier().query('identifier:"2019ascl.soft06010K"')
+            self.assertEqual(solutions[0]['bibcode'], '2019ascl.soft06010L')
+            self.assertEqual(get_mock.call_count, 2)
+        self.assertEqual(METRICS.get()['solr.hedge.won'], hedge_won + 1)
+
+
+
+class TestResolverTwoPhase(TestCase):
+    """
+    test querying for bibcodes first, and hydrating the records not in the document cache
+    """
+    def create_app(self):
+        self.current_app = app.create_app(**{
+            'REFERENCE_SERVICE_LIVE': False,
+            'REFERENCE_SERVICE_SOLR_TWO_PHASE': True,
+           })
+        return self.current_app
+
+
+    def get_response(self, params):
+        """
+        mock solr, having two records matching the query
+        """
+        docs = [{'bibcode': '2019ascl.soft06010K', 'scix_id': 'scix:3333-4444-5555',
+                 'author': ['Kurtz, Michael'], 'author_norm': ['Kurtz, M'], 'first_author_norm': 'Kurtz, M',
+                 'title': ['A title'], 'page': ['1906.010'], 'bibstem': ['ascl']},
+                {'bibcode': '2019ascl.soft06011A', 'scix_id': 'scix:3333-4444-6666',
+                 'author': ['Accomazzi, Alberto'], 'author_norm': ['Accomazzi, A'], 'first_author_norm': 'Accomazzi, A',
+                 'title': ['Another title'], 'page': ['1906.011'], 'bibstem': ['ascl']}]
+        if params['fl'] == 'bibcode,scix_id':
+            docs = [{'bibcode': doc['bibcode'], 'scix_id': doc['scix_id']} for doc in docs]
+        else:
+            docs = [doc for doc in docs if doc['bibcode'] in params['q']]
+        response = mock.Mock()
+        response.status_code = 200
+        response.text = json.dumps({'responseHeader': {'status': 0, 'QTime': 1, 'params': {}},
+                                    'response': {'start': 0, 'numFound': len(docs), 'docs': docs}})
+        return response
+
+
+    def test_hydrate(self):
+        """
+        test that only the records not seen before are fetched in full
+        """
+        with mock.patch.object(self.current_app.client, 'get') as get_mock:
+            get_mock.side_effect = lambda **kwargs: self.get_response(kwargs['params'])
+            solrquery = Querier()
+            solrquery.connect_solr = True
+            solutions = solrquery.query('author:("Kurtz, M") AND year:"2019"')
+            self.assertEqual(get_mock.call_count, 2)
+            self.assertEqual(solrquery.num_requests, 2)
+            self.assertEqual(get_mock.call_args[1]['params']['q'], 'bibcode:("2019ascl.soft06010K" OR "2019ascl.soft06011A")')
+            self.assertEqual([solution['bibcode'] for solution in solutions], ['2019ascl.soft06010K', '2019ascl.soft06011A'])
+            self.assertEqual(solutions[0]['author_norm'], ['kurtz, m'])
+            self.assertEqual(solutions[0]['page'], '1906.010')
+            # all records are cached now
+            self.assertEqual(solrquery.query('author:("Kurtz, M") AND year:"2019"'), solutions)
+            self.assertEqual(get_mock.call_count, 3)
+            self.assertEqual(solrquery.num_requests, 1)
+            self.assertEqual(solrquery.hydration, None)
+            self.assertIs(solrquery.backend, solrquery.backend)
+
+
+    def test_unhydrated(self):
+        """
+        test that when the lookup does not return all the bibcodes probed, the query is sent again for the full records
+        """
+        def get_response(params):
+            if params['q'].startswith('bibcode:'):
+                params = dict(params, q=params['q'].replace('2019ascl.soft06011A', ''))
+            elif params['fl'] != 'bibcode,scix_id':
+                params = dict(params, q='2019ascl.soft06010K 2019ascl.soft06011A')
+            return self.get_response(params)
+        unhydrated = METRICS.get().get('solr.two_phase.unhydrated', 0)
+        with mock.patch.object(self.current_app.client, 'get') as get_mock:
+            get_mock.side_effect = lambda **kwargs: get_response(kwargs['params'])
+            solrquery = Querier()
+            solrquery.connect_solr = True
+            solutions = solrquery.query('author:("Kurtz, M") AND year:"2019"')
+            self.assertEqual(get_mock.call_count, 3)
+            self.assertEqual([solution['bibcode'] for solution in solutions], ['2019ascl.soft06010K', '2019ascl.soft06011A'])
+            self.assertEqual(solrquery.hydration['bibcodes'], 2)
+            self.assertEqual(solrquery.hydration['unhydrated'], ['2019ascl.soft06011A'])
+        self.assertEqual(METRICS.get()['solr.two_phase.unhydrated'], unhydrated + 1)
+
+
+    def test_document_cache(self):
+        """
+        test eviction of the least recently used, and expiration of the document cache
+        """
+        document_cache = DocumentCache(max_size=2, ttl=60)
+        document_cache.put('a', 1)
+        document_cache.put('b', 2)
+        self.assertEqual(document_cache.get('a'), 1)
+        document_cache.put('c', 3)
+        self.assertEqual(document_cache.get('b'), None)
+        self.assertEqual(document_cache.get('a'), 1)
+        self.assertEqual(len(document_cache), 2)
+        document_cache = DocumentCache(max_size=2, ttl=0)
+        document_cache.put('a', 1)
+        self.assertEqual(document_cache.get('a'), None)
+
+
+
+class TestSolrStandin(TestCase):
+
+    def create_app(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.recordings_file = os.path.join(self.tmp_dir, 'recordings.jsonl')
+        with open(self.recordings_file, 'w') as f:
+            f.write(json.dumps({'key': 'identifier:"2019ascl.soft06010K" fl:bibcode rows:100',
+                                'response': {'responseHeader': {'status': 0, 'QTime': 7},
+                                             'response': {'numFound': 1, 'start': 0,
+                                                          'docs': [{'bibcode': '2019ascl.soft06010K'}]}}}) + '\n')
+        return solrstandin.create_app(**{
+            'SOLR_STANDIN_RECORDINGS': self.recordings_file,
+            'SOLR_STANDIN_SEED': 0,
+        })
+
+
+    def tearDown(self):
+        """
+        cleanup
+        """
+        os.remove(self.recordings_file)
+        os.rmdir(self.tmp_dir)
+
+
+    def test_recorded(self):
+        """
+        test that recorded responses are served for the query they were recorded for
+        """
+        r = self.client.get('/v1/search/query', query_string={'q': 'identifier:"2019ascl.soft06010K"', 'fl': 'bibcode', 'rows': 100})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.json['response']['docs'], [{'bibcode': '2019ascl.soft06010K'}])
+        self.assertEqual(self.client.get('/stats').json['counts']['recorded'], 1)
+
+
+    def test_recorded_probe(self):
+        """
+        test that the probe of two-phase querying and the full query of the same search are recorded apart
+        """
+        recordings = solrstandin.Recordings(os.path.join(self.tmp_dir, 'probe.jsonl'))
+        probe = {'q': 'author:("Accomazzi, A")', 'fl': 'bibcode,scix_id', 'rows': '100'}
+        full = {'q': 'author:("Accomazzi, A")', 'fl': 'bibcode,author,year', 'rows': '100', 'start': '0'}
+        self.assertNotEqual(solrstandin.get_query_key(probe), solrstandin.get_query_key(full))
+        self.assertEqual(solrstandin.get_search_key(probe), solrstandin.get_search_key(full))
+        recordings.add(solrstandin.get_query_key(probe), {'docs': [{'bibcode': '2019AAS...23320704A', 'scix_id': 'scix:1'}]})
+        recordings.add(solrstandin.get_query_key(full), {'docs': [{'bibcode': '2019AAS...23320704A', 'year': '2019'}]})
+
+        replayed = solrstandin.Recordings(recordings.filename)
+        os.remove(recordings.filename)
+        self.assertEqual(replayed.get(solrstandin.get_query_key(probe)), {'docs': [{'bibcode': '2019AAS...23320704A', 'scix_id': 'scix:1'}]})
+        self.assertEqual(replayed.get(solrstandin.get_query_key(full)), {'docs': [{'bibcode': '2019AAS...23320704A', 'year': '2019'}]})
+
+
+    def test_synthetic(self):
+        """
+        test that queries not recorded get deterministic docs consistent with the query
+        """
+        self.app.config['SOLR_STANDIN_SYNTHETIC_NUM_FOUND'] = 3
+        params = {'q': 'author:("^Accomazzi, A") AND year:"2019" AND bibstem:"ApJ"', 'rows': 100}
+        r = self.client.post('/v1/search/query', data=params)
+        self.assertEqual(r.status_code, 200)
+        docs = r.json['response']['docs']
+        self.assertEqual(len(docs), 3)
+        for doc in docs:
+            self.assertEqual(len(doc['bibcode']), 19)
+            self.assertEqual(doc['year'], '2019')
+            self.assertEqual(doc['bibstem'], ['ApJ'])
+            self.assertEqual(doc['author'][0], 'Accomazzi, A.')
+        self.assertEqual(self.client.get('/v1/search/query', query_string=params).json['response']['docs'], docs)
+
+
+    def test_synthetic_lookup(self):
+        """
+        test that a lookup of bibcodes returns the synthetic docs a query returned, with the fields asked for
+        """
+        self.app.config['SOLR_STANDIN_SYNTHETIC_NUM_FOUND'] = 2
+        params = {'q': 'author:("^Accomazzi, A") AND year:"2019"', 'rows': 100}
+        docs = self.client.post('/v1/search/query', data=params).json['response']['docs']
+        probed = self.client.post('/v1/search/query', data=dict(params, fl='bibcode,scix_id')).json['response']['docs']
+        self.assertEqual(probed, [{'bibcode': doc['bibcode'], 'scix_id': doc['scix_id']} for doc in docs])
+
+        bibcodes = [doc['bibcode'] for doc in docs] + ['2000ApJ...531..100S']
+        lookup = {'q': 'bibcode:(%s)' % ' OR '.join('"%s"' % bibcode for bibcode in bibcodes),
+                  'fl': 'bibcode,year,author,[fields author=1]', 'rows': 3}
+        hydrated = self.client.post('/v1/search/query', data=lookup).json['response']['docs']
+        self.assertEqual(hydrated[:2], [{'bibcode': doc['bibcode'], 'year': doc['year'], 'author': doc['author'][:1]} for doc in docs])
+        self.assertEqual(hydrated[2]['bibcode'], '2000ApJ...531..100S')
+        self.assertEqual(hydrated[2]['year'], '2000')
+
+
+    def test_error_rate(self):
+        """
+        test injecting errors and resetting the stats
+        """
+        self.app.config['SOLR_STANDIN_ERROR_RATE'] = 1.0
+        r = self.client.get('/v1/search/query', query_string={'q': 'identifier:"2019ascl.soft06010K"'})
+        self.assertEqual(r.status_code, 503)
+        self.assertEqual(self.client.get('/stats').json['counts']['error'], 1)
+        self.assertEqual(self.client.delete('/stats').json['queries'], 0)
+
+
+    def test_clause_cost(self):
+        """
+        test that filter queries cost less once in the filter cache
+        """
+        self.app.config['SOLR_STANDIN_CLAUSE_COST'] = {'q_ms': 2.0, 'fq_miss_ms': 2.0, 'fq_hit_ms': 0.1}
+        filter_cache = solrstandin.FilterCache(2)
+        params = {'q': 'author:("Accomazzi, A") AND page:"1"', 'fq': ['year:"2019"', 'bibstem:(ApJ)']}
+        self.assertEqual(solrstandin.get_clause_cost(params, self.app.config['SOLR_STANDIN_CLAUSE_COST'], filter_cache), (8.0, 0, 2))
+        self.assertEqual(solrstandin.get_clause_cost(params, self.app.config['SOLR_STANDIN_CLAUSE_COST'], filter_cache), (4.2, 2, 0))
+        r = self.client.get('/v1/search/query', query_string=params)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(self.client.get('/stats').json['filter_cache'], {'hits': 0, 'misses': 2})
+
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -16,7 +16,12 @@ from referencesrv.parser.crf import CRFClassifierText, create_text_model, load_t
 from referencesrv.resolver.solve import solve_reference
 from referencesrv.resolver.hypotheses import Hypotheses
 from referencesrv.resolver.sourcematchers import create_source_matcher, load_source_matcher
-from referencesrv.resolver.common import NoSolution, Incomplete
+from referencesrv.resolver.identifierindex import create_identifier_index, load_identifier_index
+from referencesrv.resolver.bibcodeindex import load_bibcode_index
+from referencesrv.resolver.volumeranges import create_volume_ranges, load_volume_ranges
+from referencesrv.resolver.backends import load_local_index
+from referencesrv.resolver.common import NoSolution, Incomplete, ResolutionTrace
+from referencesrv.metrics import METRICS, get_request_metrics
 
 
 bp = Blueprint('reference_service', __name__)
@@ -35,6 +40,12 @@ def text_model():
     if current_app.config['REFERENCE_SERVICE_LIVE']:
         current_app.extensions['text_crf'] = load_text_model()
         current_app.extensions['source_matcher'] = load_source_matcher()
+    # the identifier index is optional, and is used only if configured
+    current_app.extensions['identifier_index'] = load_identifier_index()
+    current_app.extensions['bibcode_index'] = load_bibcode_index()
+    current_app.extensions['volume_ranges'] = load_volume_ranges()
+    if current_app.config['REFERENCE_SERVICE_SEARCH_BACKEND'] == 'local':
+        current_app.extensions['local_index'] = load_local_index()
     # current_app.logger.debug("Loading neccesary pickels in {duration} ms".format(duration=(time.time() - start_time) * 1000))
 
 
@@ -76,16 +87,56 @@ def return_response(results, status, content_type='application/json'):
     return r
 
 
-def cache_resolved_set(reference, resolved):
+def format_request_metrics():
+    """
+    returns the counters of the current request, ie, evidence memo hits and misses, to log along with its timing
+
+    :return:
+    """
+    return ' '.join('{name}={value}'.format(name=name, value=value) for name, value in sorted(get_request_metrics().items()))
+
+
+def get_citing_year(context):
+    """
+    returns the publication year of the citing paper, given either as its year or its bibcode, None if neither is given
+
+    :param context: request args or payload
+    :return:
+    """
+    citing_year = context.get('citing_year', None) or str(context.get('citing_bibcode', ''))[:4]
+    if not citing_year:
+        return None
+    try:
+        return int(citing_year)
+    except ValueError:
+        current_app.logger.error('ignoring citing context, unable to get the year from {citing_year}'.format(citing_year=citing_year))
+        return None
+
+
+def get_cache_key(reference, citing_year=None):
+    """
+    references resolved with citing context are cached apart
+
+    :param reference:
+    :param citing_year:
+    :return:
+    """
+    if citing_year:
+        reference = '%s ;; %s'%(reference, citing_year)
+    return md5(reference.encode('utf-8')).hexdigest()
+
+
+def cache_resolved_set(reference, resolved, citing_year=None):
     """
 
     :param reference:
     :param resolved
+    :param citing_year:
     :return:
     """
     try:
         # save it to cache in MD5 format
-        reference_md5 = md5(reference.encode('utf-8')).hexdigest()
+        reference_md5 = get_cache_key(reference, citing_year)
         redis_db.set(name=current_app.config['REDIS_NAME_PREFIX'] + reference_md5, value=resolved.encode('utf-8'),
                      ex=current_app.config['REDIS_EXPIRATION_TIME'])
     except RedisError as e:
@@ -93,14 +144,15 @@ def cache_resolved_set(reference, resolved):
     except AttributeError as e:
         current_app.logger.error('exception on caching reference={reference}: {error}'.format(reference=reference, error=str(e)))
 
-def cache_resolved_get(reference):
+def cache_resolved_get(reference, citing_year=None):
     """
 
     :param reference:
+    :param citing_year:
     :return:
     """
     try:
-        reference_md5 = md5(reference.encode('utf-8')).hexdigest()
+        reference_md5 = get_cache_key(reference, citing_year)
         resolved = redis_db.get(name=current_app.config['REDIS_NAME_PREFIX'] + reference_md5).decode('utf-8')
         current_app.logger.debug('fetched reference={reference} from cache'.format(reference=reference))
     except RedisError:
@@ -110,17 +162,18 @@ def cache_resolved_get(reference):
         resolved = None
     return resolved
 
-def format_resolved_reference(returned_format, resolved, reference, id, cache=True, comment=None):
+def format_resolved_reference(returned_format, resolved, reference, id, cache=True, comment=None, citing_year=None):
     """
 
     :param returned_format:
     :param resolved:
     :param reference:
     :param cache:
+    :param citing_year:
     :return:
     """
     if cache:
-        cache_resolved_set(reference, resolved)
+        cache_resolved_set(reference, resolved, citing_year)
     if 'application/json' in returned_format:
         resolved = resolved.split()
         bibcode = resolved[1].replace('bibcode:','').strip()
@@ -160,36 +213,40 @@ def check_number_references(references, reference_type):
     return references, truncated_message
 
 
-def text_resolve(reference, returned_format, id):
+def text_resolve(reference, returned_format, id, citing_year=None):
     """
 
     :param reference:
     :param returned_format:
+    :param citing_year: publication year of the citing paper
     :return:
     """
     not_resolved = '0.0 bibcode:%s scixid:%s' % (19 * '.', 19 * '.')
     try:
-        resolved = cache_resolved_get(reference)
+        resolved = cache_resolved_get(reference, citing_year)
         if resolved:
             return format_resolved_reference(returned_format,
                                              resolved=resolved,
                                              reference=reference,
-                                             id=id)
+                                             id=id,
+                                             citing_year=citing_year)
 
         if bool(RE_NUMERIC_VALUE.search(reference)):
             parsed_ref = text_parser(reference)
             if parsed_ref:
                 return format_resolved_reference(returned_format,
-                                                 resolved=str(solve_reference(Hypotheses(parsed_ref))),
+                                                 resolved=str(solve_reference(Hypotheses(parsed_ref, citing_year))),
                                                  reference=reference,
-                                                 id=id)
+                                                 id=id,
+                                                 citing_year=citing_year)
             error_comment = 'NoSolution: unable to parse'
             current_app.logger.error('Exception: {error}'.format(error=error_comment))
             return format_resolved_reference(returned_format,
                                              resolved=not_resolved,
                                              reference=reference,
                                              id=id,
-                                             comment=error_comment)
+                                             comment=error_comment,
+                                             citing_year=citing_year)
         else:
             error_comment = 'ValueError: reference with no year and volume cannot be resolved.'
             current_app.logger.error('Exception: {error}'.format(error=error_comment))
@@ -197,7 +254,8 @@ def text_resolve(reference, returned_format, id):
                                              resolved=not_resolved,
                                              reference=reference,
                                              id=id,
-                                             comment=error_comment)
+                                             comment=error_comment,
+                                             citing_year=citing_year)
     except (NoSolution, Incomplete, ValueError) as e:
         error_comment = 'Exception: {error}'.format(error=str(e))
         current_app.logger.error(error_comment)
@@ -205,7 +263,8 @@ def text_resolve(reference, returned_format, id):
                                          resolved=not_resolved,
                                          reference=reference,
                                          id=id,
-                                         comment=error_comment)
+                                         comment=error_comment,
+                                         citing_year=citing_year)
     except Exception as e:
         error_comment = 'Exception: {error}'.format(error=str(e))
         current_app.logger.error(error_comment)
@@ -213,25 +272,28 @@ def text_resolve(reference, returned_format, id):
                                          resolved=not_resolved,
                                          reference=reference,
                                          id=id,
-                                         comment=error_comment)
+                                         comment=error_comment,
+                                         citing_year=citing_year)
 
-def xml_resolve(parsed_reference, returned_format):
+def xml_resolve(parsed_reference, returned_format, citing_year=None):
     """
 
     :param parsed_reference:
     :param returned_format:
+    :param citing_year: publication year of the citing paper
     :return:
     """
     not_resolved = '0.0 bibcode:%s scixid:%s' % (19 * '.', 19 * '.')
     try:
-        resolved = str(solve_reference(Hypotheses(parsed_reference)))
+        resolved = str(solve_reference(Hypotheses(parsed_reference, citing_year)))
         if resolved.startswith('0.0'):
             raise ValueError("Not Resolved")
         reference_str = parsed_reference.get('refstr', None) or parsed_reference.get('refplaintext', None)
         return format_resolved_reference(returned_format,
                                          resolved=resolved,
                                          reference=reference_str,
-                                         id=parsed_reference.get('id', None))
+                                         id=parsed_reference.get('id', None),
+                                         citing_year=citing_year)
     except Exception as e:
         error_comment = 'Exception: {error}'.format(error=str(e))
         current_app.logger.error('Exception: {error}'.format(error=str(e)))
@@ -244,17 +306,19 @@ def xml_resolve(parsed_reference, returned_format):
                     parsed_ref = text_parser(reference_str)
                     if parsed_ref:
                         return format_resolved_reference(returned_format,
-                                                         resolved=str(solve_reference(Hypotheses(parsed_ref))),
+                                                         resolved=str(solve_reference(Hypotheses(parsed_ref, citing_year))),
                                                          reference=reference_str,
                                                          id=parsed_reference.get('id', None),
-                                                         cache=True)
+                                                         cache=True,
+                                                         citing_year=citing_year)
                     error_comment = 'NoSolution: unable to parse'
                     current_app.logger.error('Exception: {error}'.format(error=error_comment))
                     return format_resolved_reference(returned_format,
                                                      resolved=not_resolved,
                                                      reference=reference_str,
                                                      id=parsed_reference.get('id', None),
-                                                     comment=error_comment)
+                                                     comment=error_comment,
+                                                     citing_year=citing_year)
 
                 except (NoSolution, Incomplete, ValueError) as e:
                     error_comment = 'Exception: {error}'.format(error=str(e))
@@ -263,7 +327,8 @@ def xml_resolve(parsed_reference, returned_format):
                                                      resolved=not_resolved,
                                                      reference=reference_str,
                                                      id=parsed_reference.get('id', None),
-                                                     comment=error_comment)
+                                                     comment=error_comment,
+                                                     citing_year=citing_year)
                 except Exception as e:
                     error_comment = 'Exception: {error}'.format(error=str(e))
                     current_app.logger.error(error_comment)
@@ -271,7 +336,8 @@ def xml_resolve(parsed_reference, returned_format):
                                                      resolved=not_resolved,
                                                      reference=reference_str,
                                                      id=parsed_reference.get('id', None),
-                                                     comment=error_comment)
+                                                     comment=error_comment,
+                                                     citing_year=citing_year)
             else:
                 error_comment = 'ValueError: reference with no year and volume cannot be resolved.'
                 current_app.logger.error('Exception: {error}'.format(error=error_comment))
@@ -279,13 +345,15 @@ def xml_resolve(parsed_reference, returned_format):
                                                  resolved=not_resolved,
                                                  reference=reference_str,
                                                  id=parsed_reference.get('id', None),
-                                                 comment=error_comment)
+                                                 comment=error_comment,
+                                                 citing_year=citing_year)
         else:
             return format_resolved_reference(returned_format,
                                              resolved=not_resolved,
                                              reference=parsed_reference.get('refstr', None),
                                              id=parsed_reference.get('id', None),
-                                             comment=error_comment)
+                                             comment=error_comment,
+                                             citing_year=citing_year)
 
 
 @advertise(scopes=[], rate_limit=[1000, 3600 * 24])
@@ -302,9 +370,10 @@ def text_get(reference):
 
     current_app.logger.info('received GET request with reference=`{reference}` to resolve in text mode'.format(reference=reference))
 
-    # start_time = time.time()
-    result = text_resolve(reference, returned_format, None)
-    # current_app.logger.debug("GET request processed in {duration} ms".format(duration=(time.time() - start_time) * 1000))
+    start_time = time.time()
+    result = text_resolve(reference, returned_format, None, get_citing_year(request.args))
+    current_app.logger.debug("GET request processed in {duration} ms {metrics}".format(duration=(time.time() - start_time) * 1000,
+                                                                                      metrics=format_request_metrics()))
 
     return return_response({'resolved': result}, 200, 'application/json; charset=UTF8')
 
@@ -338,11 +407,16 @@ def text_post():
     else:
         ids = [None]*len(references)
 
-    # start_time = time.time()
+    # citing context applies to all the references of the request
+    citing_year = get_citing_year(payload)
+
+    start_time = time.time()
     results = []
     for reference, id in zip(references, ids):
-        results.append(text_resolve(reference, returned_format, id))
-    # current_app.logger.debug("POST request with {num} reference(s) processed in {duration} ms".format(num=len(references), duration=(time.time() - start_time) * 1000))
+        results.append(text_resolve(reference, returned_format, id, citing_year))
+    current_app.logger.debug("POST request with {num} reference(s) processed in {duration} ms {metrics}".format(num=len(references),
+                                                                                                              duration=(time.time() - start_time) * 1000,
+                                                                                                              metrics=format_request_metrics()))
 
     if returned_format == 'application/json':
         response = {'resolved': results}
@@ -381,9 +455,16 @@ def xml_post():
 
     returned_format = request.headers.get('Accept', 'text/plain')
 
+    # citing context applies to all the references of the request
+    citing_year = get_citing_year(payload)
+
+    start_time = time.time()
     results = []
     for parsed_reference in parsed_references:
-        results.append(xml_resolve(parsed_reference, returned_format))
+        results.append(xml_resolve(parsed_reference, returned_format, citing_year))
+    current_app.logger.debug("POST request with {num} parsed reference(s) processed in {duration} ms {metrics}".format(num=len(parsed_references),
+                                                                                                                     duration=(time.time() - start_time) * 1000,
+                                                                                                                     metrics=format_request_metrics()))
 
     if returned_format == 'application/json':
         response = {'resolved': results}
@@ -397,6 +478,56 @@ def xml_post():
     return return_response(response, 200, 'application/text; charset=UTF8')
 
 
+@advertise(scopes=[], rate_limit=[1000, 3600 * 24])
+@bp.route('/explain', methods=['POST'])
+def explain():
+    """
+    endpoint to resolve a single reference, either text or parsed, and return a trace of the resolution,
+    ie, the parsed fields, and for each hypothesis tried, the solr query, numFound, time, evidences
+    of the candidates, and the reason it was accepted or rejected
+
+    the resolved cache is not consulted, so that the resolution is always traced
+
+    :return:
+    """
+    try:
+        payload = request.get_json(force=True)  # post data in json
+    except:
+        payload = dict(request.form)  # post data in form encoding
+
+    if not payload:
+        return {'error': 'no information received'}, 400
+    if 'reference' in payload:
+        reference = payload['reference']
+        if not isinstance(reference, str):
+            return {'error': 'only one reference can be explained at a time'}, 400
+        try:
+            parsed_reference = text_parser(reference)
+        except Exception as e:
+            return return_response({'Error': 'unable to parse: %s'%str(e)}, 400, 'application/json; charset=UTF8')
+        if not parsed_reference:
+            return return_response({'Error': 'unable to parse'}, 400, 'application/json; charset=UTF8')
+    elif 'parsed_reference' in payload:
+        parsed_reference = payload['parsed_reference']
+        if not isinstance(parsed_reference, dict):
+            return {'error': 'only one reference can be explained at a time'}, 400
+    else:
+        return {'error': 'no reference found in payload (parameter name is either `reference` or `parsed_reference`)'}, 400
+
+    current_app.logger.info('received POST request to explain the resolution of reference={reference}'.format(reference=parsed_reference))
+
+    trace = ResolutionTrace(parsed=parsed_reference)
+    start_time = time.time()
+    try:
+        solution = solve_reference(Hypotheses(parsed_reference, get_citing_year(payload)), trace)
+        trace.result = {'resolved': str(solution), 'hypothesis': solution.source_hypothesis}
+    except Exception as e:
+        trace.result = {'error': '{name}: {error}'.format(name=type(e).__name__, error=str(e))}
+    result = trace.as_dict()
+    result['ms'] = round((time.time() - start_time) * 1000, 3)
+    return return_response(result, 200, 'application/json; charset=UTF8')
+
+
 @advertise(scopes=['ads:reference-service'], rate_limit=[1000, 3600 * 24])
 @bp.route('/pickle_crf', methods=['PUT'])
 def pickle_crf():
@@ -427,6 +558,61 @@ def pickle_source_matcher():
         return return_response({'Error: %s'%str(e)}, 400, 'text/plain; charset=UTF8')
 
 
+@advertise(scopes=['ads:reference-service'], rate_limit=[1000, 3600 * 24])
+@bp.route('/identifier_index', methods=['PUT'])
+def rebuild_identifier_index():
+    """
+    endpoint to be called locally only whenever a new bulk export of identifiers is available
+
+    :return:
+    """
+    try:
+        stats = create_identifier_index()
+        return return_response({'OK': stats}, 200, 'application/json; charset=UTF8')
+    except Exception as e:
+        return return_response({'Error': 'Error: %s'%str(e)}, 400, 'text/plain; charset=UTF8')
+
+
+@advertise(scopes=['ads:reference-service'], rate_limit=[1000, 3600 * 24])
+@bp.route('/identifier_index', methods=['GET'])
+def identifier_index_freshness():
+    """
+    endpoint to return when the identifier index was built, and how many identifiers it holds
+
+    :return:
+    """
+    identifier_index = current_app.extensions.get('identifier_index', None)
+    if identifier_index is None:
+        return return_response({'Error': 'identifier index is not available'}, 404, 'application/json; charset=UTF8')
+    return return_response(identifier_index.get_stats(), 200, 'application/json; charset=UTF8')
+
+
+@advertise(scopes=['ads:reference-service'], rate_limit=[1000, 3600 * 24])
+@bp.route('/volume_ranges', methods=['PUT'])
+def rebuild_volume_ranges():
+    """
+    endpoint to be called locally only whenever a new bibcode list is available
+
+    :return:
+    """
+    try:
+        stats = create_volume_ranges()
+        return return_response({'OK': stats}, 200, 'application/json; charset=UTF8')
+    except Exception as e:
+        return return_response({'Error': 'Error: %s'%str(e)}, 400, 'text/plain; charset=UTF8')
+
+
+@advertise(scopes=['ads:reference-service'], rate_limit=[1000, 3600 * 24])
+@bp.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    endpoint to return the counters and gauges of this process, ie, solr requests, retries, and circuit breaker state
+
+    :return:
+    """
+    return return_response(METRICS.get(), 200, 'application/json; charset=UTF8')
+
+
 @advertise(scopes=[], rate_limit=[1000, 3600 * 24])
 @bp.route('/parse', methods=['POST'])
 def parse_text():
@@ -0,0 +1,20 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import requests
+
+"""
+rebuild the local identifier index from the bulk export file,
+REFERENCE_SERVICE_IDENTIFIER_EXPORT, into REFERENCE_SERVICE_IDENTIFIER_INDEX
+
+the export file has one json document per line with the fields bibcode, scix_id, identifier, and doi
+
+run this whenever a new export is available, the response includes when the index was built
+and how many identifiers it holds, and the same can be fetched later with a GET request
+"""
+
+
+url = "http://localhost:5000/identifier_index"
+r = requests.put(url)
+print('code=',r.status_code,'reason=',r.reason)
+print(r.text)